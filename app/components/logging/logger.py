@@ -11,9 +11,12 @@ SPDX-License-Identifier: AGPL-3.0-or-later
 ########################################################################################################################
 # INCLUDES #############################################################################################################
 ########################################################################################################################
+import atexit
 import logging
 import logging.handlers
+import os
 import pathlib
+import queue
 from app.factory.conf import Config
 
 
@@ -22,8 +25,9 @@ from app.factory.conf import Config
 ########################################################################################################################
 class Logger:
     def __init__(self) -> None:
-        self._fileLogger = _createRotatingFileHandler()
-        self._dbLogger = _createDBLogger()
+        self._handlers: dict[str, QueueFileHandler] = {}
+        self._fileLogger = _createRotatingFileHandler(self._handlers)
+        self._dbLogger = _createDBLogger(self._handlers)
 
     ####################################################################################################################
     # PUBLIC METHODS ###################################################################################################
@@ -40,6 +44,11 @@ class Logger:
     def critical(self, msg: str) -> None:
         self._fileLogger.critical(msg)
 
+    def flush(self) -> None:
+        # wait until the queued records are written to the log files
+        for handler in self._handlers.values():
+            handler.flush()
+
     ####################################################################################################################
     # GETTERS ##########################################################################################################
     ####################################################################################################################
@@ -51,11 +60,80 @@ class Logger:
     def dbLogger(self) -> logging.Logger:
         return self._dbLogger
 
+    @property
+    def droppedRecords(self) -> dict[str, int]:
+        # the records dropped per log file because the queue was full
+        return {logFile: handler.dropped for logFile, handler in self._handlers.items()}
+
+
+########################################################################################################################
+# QUEUE HANDLER ########################################################################################################
+########################################################################################################################
+class QueueFileHandler(logging.handlers.QueueHandler):
+    """
+    Puts the records in a bounded queue, which a background listener writes to the file handler, such that logging
+    never waits for the disk. If the queue is full, the oldest record is dropped and counted. The queue is drained
+    when the interpreter shuts down ; after a fork, the child process starts its own queue and listener.
+    """
+    def __init__(self, fileHandler: logging.Handler, maxSize: int) -> None:
+        super().__init__(queue.Queue(maxSize))
+        self._fileHandler = fileHandler
+        self._maxSize = maxSize
+        self._listener = None
+        self.dropped = 0
+        self._start()
+
+        atexit.register(self.close)
+        if hasattr(os, 'register_at_fork'):
+            os.register_at_fork(after_in_child=self._afterFork)
+
+    def enqueue(self, record: logging.LogRecord) -> None:
+        # called with the lock of the handler held, thus the records are dropped one at a time
+        while True:
+            try:
+                self.queue.put_nowait(record)
+                return
+            except queue.Full:
+                try:
+                    self.queue.get_nowait()
+                    self.queue.task_done()
+                    self.dropped += 1
+                except queue.Empty:
+                    pass
+
+    def flush(self) -> None:
+        if self._listener is not None:
+            self.queue.join()
+        self._fileHandler.flush()
+
+    def close(self) -> None:
+        # write the remaining records, then stop the listener
+        if self._listener is not None:
+            self._listener.stop()
+            self._listener = None
+        self._fileHandler.close()
+        super().close()
+
+    def _start(self) -> None:
+        self._listener = _QueueListener(self.queue, self._fileHandler, respect_handler_level=True)
+        self._listener.start()
+
+    def _afterFork(self) -> None:
+        # the listener thread did not survive the fork and the queue may be locked, thus both are replaced
+        if self._listener is not None:
+            self.queue = queue.Queue(self._maxSize)
+            self._start()
+
+class _QueueListener(logging.handlers.QueueListener):
+    def enqueue_sentinel(self) -> None:
+        # wait for a free slot, rather than failing, if the queue is full when stopping
+        self.queue.put(self._sentinel)
+
 
 ########################################################################################################################
 # HELPERS ##############################################################################################################
 ########################################################################################################################
-def _createRotatingFileHandler() -> logging.Logger:
+def _createRotatingFileHandler(handlers: dict[str, QueueFileHandler]) -> logging.Logger:
     """
     Helper method to create a rotating file handler. Options are read from the configuration file.
     """
@@ -67,7 +145,7 @@ def _createRotatingFileHandler() -> logging.Logger:
             fileHandler.setLevel(logging.INFO)
 
         fileLogger = logging.getLogger('ErtieLogger')
-        fileLogger.addHandler(fileHandler)
+        fileLogger.addHandler(_getQueueHandler(handlers, 'ertie.log', fileHandler))
         if Config.DEBUG is True:
             fileLogger.setLevel(logging.DEBUG)
         else:
@@ -80,7 +158,7 @@ def _createRotatingFileHandler() -> logging.Logger:
         raise RuntimeError('Unable to create the File Logger!') from e
 
 
-def _createDBLogger() -> logging.Logger:
+def _createDBLogger(handlers: dict[str, QueueFileHandler]) -> logging.Logger:
     """
     Helper method to create a rotating file handler for DB queries. Options are read from the configuration file.
     """
@@ -93,7 +171,7 @@ def _createDBLogger() -> logging.Logger:
             fileHandler.setLevel(logging.INFO)
 
         dbLogger = logging.getLogger('sqlalchemy.engine')
-        dbLogger.addHandler(fileHandler)
+        dbLogger.addHandler(_getQueueHandler(handlers, 'db.log', fileHandler))
         if Config.DEBUG is True:
             dbLogger.setLevel(logging.DEBUG)
         else:
@@ -121,6 +199,15 @@ def _getFileHandler(logFile: str) -> logging.handlers.RotatingFileHandler:
     return fileHandler
 
 
+def _getQueueHandler(handlers: dict[str, QueueFileHandler], logFile: str,
+                     fileHandler: logging.Handler) -> QueueFileHandler:
+    # records below the level of the file handler are not even queued
+    queueHandler = QueueFileHandler(fileHandler, Config.LOG_QUEUE_SIZE)
+    queueHandler.setLevel(fileHandler.level)
+    handlers[logFile] = queueHandler
+    return queueHandler
+
+
 def _getLogDirectory() -> pathlib.Path:
     pathToBaseDirectory = pathlib.Path().absolute()
     pathToLogsDirectory = pathToBaseDirectory / 'logs'
@@ -10,4 +10,5 @@ SPDX-License-Identifier: AGPL-3.0-or-later
 
 ########################################################################################################################
 # IMPORTS ##############################################################################################################
-########################################################################################################################
\ No newline at end of file
+########################################################################################################################
+from .search import bpSearch
@@ -0,0 +1,145 @@
+"""
+Fulltext search for Ertië based on Meilisearch.
+
+:Authors:
+    - Gilles Bellot
+
+SPDX-FileCopyrightText: © 2024 Gilles Bellot <gilles.bellot@bell0bytes.eu>
+SPDX-License-Identifier: AGPL-3.0-or-later
+"""
+
+########################################################################################################################
+# INCLUDES #############################################################################################################
+########################################################################################################################
+
+# PYTHON ###############################################################################################################
+import math
+import random
+import statistics
+import time
+
+# FLASK ################################################################################################################
+import click
+import flask
+import sqlalchemy
+import sqlalchemy.pool
+
+# ERTIE ################################################################################################################
+from app.factory.extensions import database, fullTextSearch, searchSync
+from app.factory.conf import Config
+
+########################################################################################################################
+# BLUEPRINT ############################################################################################################
+########################################################################################################################
+bpSearch = flask.Blueprint('search', __name__, cli_group='search')
+
+
+########################################################################################################################
+# COMMANDS #############################################################################################################
+########################################################################################################################
+@bpSearch.cli.command('reindex')
+@click.argument('index')
+@click.option('--batch-size', 'batchSize', default=Config.FULLTEXT_SEARCH_BATCH_SIZE, show_default=True,
+              help='Number of rows fetched from the database per round trip.')
+def reindex(index: str, batchSize: int):
+    """
+    Rebuild INDEX from the database without downtime.
+
+    Writes made by this process while INDEX is rebuilt are replayed on the new index before the swap. Writes made by
+    other processes, i.e. the web workers, between reading the database and the swap only reach the old index and are
+    lost: run the command while the application does not write, or resync the affected documents afterwards.
+    """
+    try:
+        modelClass = _getModel(index)
+        count = fullTextSearch.reindex(index, modelClass, database.db.session, yieldPer=batchSize,
+                                       progress=_reportProgress)
+        click.echo(f'Reindexed {count} {modelClass.__name__} document(s) into {index}.')
+    except click.ClickException:
+        raise
+    except Exception as e:
+        raise click.ClickException(f'Unable to reindex {index}: {e}') from e
+
+@bpSearch.cli.command('settings')
+@click.option('--dry-run', 'dryRun', is_flag=True, help='Only report the changes.')
+def settings(dryRun: bool):
+    """Apply the index settings declared by the searchable models."""
+    try:
+        for modelClass, index in searchSync.registry.items():
+            changes = fullTextSearch.diffSettings(index, modelClass)
+            if not changes:
+                click.echo(f'{index}: up to date.')
+                continue
+
+            # report the changes, and those forcing a full reindex, before applying them
+            reindexing = fullTextSearch.requiresReindex(changes)
+            for setting, (live, declared) in changes.items():
+                note = ' (requires reindexing all documents)' if setting in reindexing else ''
+                click.echo(f'{index}: {setting} {live} -> {declared}{note}')
+            if dryRun is False:
+                fullTextSearch.applySettings(index, changes)
+                click.echo(f'{index}: {len(changes)} setting(s) applied.')
+    except Exception as e:
+        raise click.ClickException(f'Unable to apply the index settings: {e}') from e
+
+@bpSearch.cli.command('benchmark')
+@click.option('--documents', default=10000, show_default=True, type=click.IntRange(min=1),
+              help='Number of synthetic documents to index.')
+@click.option('--queries', default=200, show_default=True, type=click.IntRange(min=1), help='Number of timed queries.')
+def benchmark(documents: int, queries: int):
+    """Compare the indexing throughput and the query latency of the search providers."""
+    generator = random.Random(0)
+    words = [''.join(generator.choice('aeioubcdfglmnprstv') for _ in range(generator.randint(4, 9)))
+             for _ in range(500)]
+    corpus = [{'id': uid, 'name': f'{generator.choice(words)} {generator.choice(words)}',
+               'city': generator.choice(words)} for uid in range(documents)]
+    prefixes = [generator.choice(words)[:3] for _ in range(queries)]
+
+    for name, provider in _benchmarkProviders():
+        if not provider.isHealthy():
+            click.echo(f'{name}: unavailable, skipped.')
+            continue
+        try:
+            started = time.perf_counter()
+            provider.reindex('benchmark', iter(corpus))
+            elapsed = time.perf_counter() - started
+
+            latencies = []
+            for prefix in prefixes:
+                started = time.perf_counter()
+                provider.queryIndex('benchmark', prefix)
+                latencies.append((time.perf_counter() - started) * 1000)
+            latencies.sort()
+            click.echo(f'{name}: {documents} document(s) indexed in {elapsed:.2f} s '
+                       f'({documents / elapsed:.0f} documents/s), query p50 {statistics.median(latencies):.2f} ms, '
+                       f'p95 {latencies[max(0, math.ceil(0.95 * len(latencies)) - 1)]:.2f} ms')
+        except Exception as e:
+            click.echo(f'{name}: failed: {e}')
+        finally:
+            provider.deleteIndex('benchmark')
+
+########################################################################################################################
+# HELPERS ##############################################################################################################
+########################################################################################################################
+def _getModel(index: str) -> type:
+    # find the searchable model registered for the index
+    for modelClass, registeredIndex in searchSync.registry.items():
+        if registeredIndex == index:
+            return modelClass
+    raise click.ClickException(f'No searchable model is registered for the index {index}!')
+
+def _benchmarkProviders() -> list[tuple[str, object]]:
+    # the SQL provider runs on the application database, or on an in-memory SQLite database if it is not supported
+    from app.factory.classes.fullTextSearch.meiliSearch import MeiliSearch
+    from app.factory.classes.fullTextSearch.sqlSearch import SQLSearch
+
+    engine = database.db.engine
+    if engine.dialect.name in ('postgresql', 'sqlite'):
+        providers = [(f'sql ({engine.dialect.name})', SQLSearch(engine))]
+    else:
+        providers = [('sql (in-memory sqlite)', SQLSearch(sqlalchemy.create_engine(
+            'sqlite://', poolclass=sqlalchemy.pool.StaticPool)))]
+    return providers + [('meilisearch', MeiliSearch())]
+
+def _reportProgress(count: int, elapsed: float) -> None:
+    throughput = count / elapsed if elapsed > 0 else 0.0
+    click.echo(f'{count} document(s) indexed ({throughput:.0f} documents/s)')
@@ -8,25 +8,52 @@ SPDX-License-Identifier: AGPL-3.0-or-later
 ########################################################################################################################
 # IMPORTS ##############################################################################################################
 ########################################################################################################################
-from typing import TYPE_CHECKING
+from typing import TYPE_CHECKING, Any, Callable, Iterable, Iterator
 if TYPE_CHECKING:
     import flask
 
+import contextlib
+import itertools
+import os
+import pathlib
+import threading
+import time
 import sqlalchemy                                                   # DB agnostic SQL support
+import sqlalchemy.orm.attributes
+import sqlalchemy.orm.util
 import flask_sqlalchemy                                             # Flask integration with SQLAlchemy
 import flask_migrate                                                # Alembic support for DB migrations
 from app.factory.conf import Config
+from .poolMonitor import MonitoredQueuePool, PoolMonitor           # connection pool telemetry
+from .replicaRouter import ReplicaRouter, RoutingSession            # read replica routing
+from .queryProfiler import QueryProfiler                            # per-request SQL instrumentation
+from .planGuard import PlanCapture                                  # query plan regression guard
+
+########################################################################################################################
+# CONSTANTS ############################################################################################################
+########################################################################################################################
+_excludedTablePrefixes = ('search_',)            # the tables of the SQL search provider, managed at runtime
+_retryableErrors = ('40001', '40P01', 1213)     # serialization failure and deadlock in PostgreSQL, deadlock in MySQL
 
 ########################################################################################################################
 # CLASS ################################################################################################################
 ########################################################################################################################
 class Database:
     def __init__(self) -> None:
+        self._router = ReplicaRouter()
+        self._profiler = QueryProfiler()
         self._db = flask_sqlalchemy.SQLAlchemy(
             metadata=sqlalchemy.MetaData(naming_convention=Config.SQLALCHEMY_NAMING_CONVENTION,
                                          schema=Config.SQLALCHEMY_SCHEMA),
-            session_options={'autoflush': False})
-        self._migrate = flask_migrate.Migrate()
+            session_options={'autoflush': False, 'class_': RoutingSession, 'router': self._router},
+            engine_options={'poolclass': MonitoredQueuePool})
+        self._migrate = flask_migrate.Migrate(include_object=_includeObject)
+        self._poolMonitors: dict[str, PoolMonitor] = {}
+        self._local = threading.local()                             # the depth of the units of work of each thread
+
+        # connections do not survive a fork, thus each worker process starts with fresh, empty pools
+        if hasattr(os, 'register_at_fork'):
+            os.register_at_fork(after_in_child=self._afterFork)
 
     ####################################################################################################################
     # PUBLIC METHODS €##################################################################################################
@@ -35,31 +62,141 @@ class Database:
         self._db.init_app(app)
         self._migrate.init_app(app, self._db)
 
+        # collect the statistics of the connection pool of each engine
+        with app.app_context():
+            self._poolMonitors = {key or 'default': PoolMonitor(engine) for key, engine in self._db.engines.items()}
+
+            # send the reads to the replicas, if there are any
+            self._router.init(self._db.engines)
+
+            # time the statements of a sample of the requests
+            self._profiler.init(app, self._db.engines)
+        self._router.listen(self._db.session)
+
+    def readOnly(self, blueprint: 'flask.Blueprint') -> 'flask.Blueprint':
+        return self._router.readOnly(blueprint)
+
+    # UNIT OF WORK #####################################################################################################
+    @contextlib.contextmanager
+    def transaction(self) -> Iterator[sqlalchemy.orm.Session]:
+        """
+        Unit of work: the helpers called in the block flush rather than commit, and everything is committed at once
+        when the outermost block exits. Nested blocks are savepoints. If the block raises, the transaction, or the
+        savepoint, is rolled back and a RuntimeError is raised. Also usable as a view decorator, i.e.
+        @database.transaction(), for a unit of work per request.
+        """
+        session = self._db.session()
+        depth = self.transactionDepth
+        self._local.depth = depth + 1
+        try:
+            if depth == 0:
+                # the whole transaction reads from the primary
+                self._router.markWrite(session)
+                yield session
+                self._local.depth = 0
+                session.commit()
+            else:
+                with session.begin_nested():
+                    yield session
+        except Exception as e:
+            # the savepoint is already rolled back by now ; the errors of the helpers are not wrapped again
+            self._local.depth = depth
+            if depth == 0:
+                self._db.session.rollback()
+            if isinstance(e, RuntimeError):
+                raise
+            raise RuntimeError from e
+        finally:
+            self._local.depth = depth
+
+    def runInTransaction(self, function: Callable[..., Any], *args, retries: int | None = None, **kwargs) -> Any:
+        """
+        Runs a function in a unit of work and returns its result. If the transaction failed because of a serialization
+        failure or a deadlock, the function is run again, up to `retries` times, with an exponential backoff. Inside
+        another unit of work, the function runs in a savepoint and is not retried, as the outer transaction failed.
+        """
+        retries = Config.DB_TRANSACTION_RETRIES if retries is None else retries
+        for attempt in itertools.count():
+            try:
+                with self.transaction():
+                    return function(*args, **kwargs)
+            except RuntimeError as e:
+                if self.transactionDepth > 0 or attempt >= retries or not _isRetryable(e):
+                    raise
+                time.sleep(Config.DB_TRANSACTION_RETRY_BACKOFF * 2 ** attempt)
+
     # COMMIT ###########################################################################################################
     def addCommitFlushRefresh(self, obj: flask_sqlalchemy.extension.Model) -> None:
         try:
             self._db.session.add(obj)
-            self._db.session.commit()
-            self._db.session.flush()
-            self._db.session.refresh(obj)
+            self._commit(obj, flush=True)
         except Exception as e:
             self._rollbackAndRaise(e)
 
     def commitFlushRefresh(self, obj: flask_sqlalchemy.extension.Model) -> None:
         try:
-            self._db.session.commit()
-            self._db.session.flush()
-            self._db.session.refresh(obj)
+            self._commit(obj, flush=True)
         except Exception as e:
             self._rollbackAndRaise(e)
 
     def commitFlush(self) -> None:
         try:
-            self._db.session.commit()
-            self._db.session.flush()
+            self._commit(flush=True)
+        except Exception as e:
+            self._rollbackAndRaise(e)
+
+    def addCommitReturning(self, obj: flask_sqlalchemy.extension.Model) -> None:
+        self._db.session.add(obj)
+        self.commitReturning()
+
+    def commitReturning(self) -> None:
+        """
+        Flushes and commits without reloading the objects afterwards: the objects are not expired by the commit, such
+        that they remain usable without another SELECT. Models with server-generated columns opt into fetching them
+        with the INSERT and UPDATE statements themselves (RETURNING) with __mapper_args__ = {'eager_defaults': True} ;
+        otherwise these columns are loaded on their next access.
+        """
+        session = self._db.session()
+        expireOnCommit = session.expire_on_commit
+        try:
+            session.flush()
+            if self.transactionDepth == 0:
+                session.expire_on_commit = False
+                session.commit()
+        except Exception as e:
+            self._rollbackAndRaise(e)
+        finally:
+            session.expire_on_commit = expireOnCommit
+
+    # BULK #############################################################################################################
+    def addAll(self, objs: Iterable[flask_sqlalchemy.extension.Model], chunkSize: int | None = None) -> None:
+        """
+        Adds many objects in one transaction. The objects are flushed in chunks, such that the unit of work batches
+        the INSERT statements ; nothing is refreshed.
+        """
+        try:
+            for chunk in _chunks(objs, chunkSize or Config.DB_BULK_CHUNK_SIZE):
+                self._db.session.add_all(chunk)
+                self._db.session.flush()
+            self._commit()
         except Exception as e:
             self._rollbackAndRaise(e)
 
+    def bulkInsert(self, model: type, rows: Iterable[dict[str, Any]], chunkSize: int | None = None) -> int:
+        """
+        Inserts rows given as dictionaries in one transaction, bypassing the unit of work: each chunk is sent as one
+        executemany, batched into multi-row INSERT statements by insertmanyvalues. No objects are created, thus the
+        session events, i.e. the search index synchronisation, do not fire. Returns the number of rows written.
+        """
+        return self._bulkExecute(sqlalchemy.insert(model), rows, chunkSize)
+
+    def bulkUpdate(self, model: type, rows: Iterable[dict[str, Any]], chunkSize: int | None = None) -> int:
+        """
+        Updates rows given as dictionaries, which must contain the primary key, in one transaction and with one
+        executemany per chunk. The session events do not fire. Returns the number of rows written.
+        """
+        return self._bulkExecute(sqlalchemy.update(model), rows, chunkSize)
+
     # ROLLBACK #########################################################################################################
     def rollback(self) -> None:
         self._db.session.rollback()
@@ -68,18 +205,104 @@ class Database:
     def deleteObject(self, obj: flask_sqlalchemy.extension.Model) -> None:
         try:
             self._db.session.delete(obj)
-            self._db.session.commit()
+            self._commit()
         except Exception as e:
             self._rollbackAndRaise(e)
 
-    def deleteObjectAndHistory(self, obj: flask_sqlalchemy.extension.Model) -> None:
+    def deleteObjectAndHistory(self, obj: flask_sqlalchemy.extension.Model,
+                               relationships: Iterable[str] = ('history',)) -> dict[str, int]:
+        return self.deleteMany([obj], relationships)
+
+    def deleteMany(self, objs: Iterable[flask_sqlalchemy.extension.Model],
+                   relationships: Iterable[str] = ('history',)) -> dict[str, int]:
+        """
+        Deletes objects and the rows of their history relationships in one transaction. The history rows are deleted
+        set-based, one DELETE ... WHERE parent IN (...) per table and chunk of parents, without loading them ; the
+        objects themselves go through the session, such that the session events, i.e. the search index
+        synchronisation, still fire. Returns the number of deleted rows per table. Raises a ValueError, before anything
+        is deleted, if one of the relationships is not a plain one-to-many relationship.
+        """
+        groups: dict[type, list] = {}
+        for obj in objs:
+            groups.setdefault(type(obj), []).append(obj)
+
+        # only plain one-to-many relationships, i.e. history.parentId -> parent.uid, can be deleted by their foreign key
+        related: dict[type, list[sqlalchemy.orm.RelationshipProperty]] = {}
+        for modelClass in groups:
+            mapper = sqlalchemy.inspect(modelClass)
+            related[modelClass] = [mapper.relationships[name] for name in relationships if name in mapper.relationships]
+            for relationship in related[modelClass]:
+                if relationship.direction is not sqlalchemy.orm.interfaces.ONETOMANY \
+                        or relationship.secondary is not None or len(relationship.local_remote_pairs) != 1:
+                    raise ValueError(f'{relationship} cannot be deleted set-based!')
+
+        counts: dict[str, int] = {}
         try:
-            # noinspection PyUnresolvedReferences
-            for history in obj.history:
-                self._db.session.delete(history)
-            self.deleteObject(obj)
+            for modelClass, group in groups.items():
+                mapper = sqlalchemy.inspect(modelClass)
+                for relationship in related[modelClass]:
+                    table = relationship.mapper.local_table.name
+                    counts[table] = counts.get(table, 0) + self._deleteRelated(mapper, relationship, group)
+
+                    # the collections are known to be empty now, thus the unit of work need not load them
+                    for obj in group:
+                        sqlalchemy.orm.attributes.set_committed_value(obj, relationship.key,
+                                                                      [] if relationship.uselist else None)
+
+                for obj in group:
+                    self._db.session.delete(obj)
+                counts[mapper.local_table.name] = counts.get(mapper.local_table.name, 0) + len(group)
+            self._commit()
         except Exception as e:
             self._rollbackAndRaise(e)
+        return counts
+
+    # QUERY ############################################################################################################
+    def getByIds(self, model: type, ids: list[Any], options: Iterable[Any] = ()) -> list:
+        """
+        Loads the objects with the given primary keys in one query and returns them in the order of the ids, i.e. the
+        ranking of the search engine. Without options, objects already loaded in the session are not queried again ;
+        ids without a matching row are skipped.
+        """
+        session = self._db.session
+        options = tuple(options)
+        found = {}
+
+        # objects in the identity map need not be loaded again, unless the options must load their relationships
+        missing = []
+        for uid in ids:
+            obj = session.identity_map.get(sqlalchemy.orm.util.identity_key(model, uid)) if not options else None
+            if obj is not None and not sqlalchemy.inspect(obj).expired:
+                found[uid] = obj
+            else:
+                missing.append(uid)
+
+        # load the remaining objects with one IN (...) query
+        if missing:
+            mapper = sqlalchemy.inspect(model)
+            primaryKey = mapper.primary_key[0]
+            # the column key may differ from the name of the mapped attribute
+            attribute = mapper.get_property_by_column(primaryKey).key
+            statement = sqlalchemy.select(model).where(primaryKey.in_(missing)).options(*options)
+            if options:
+                # the options apply to the objects already in the session, too
+                statement = statement.execution_options(populate_existing=True)
+            for obj in session.scalars(statement):
+                found[getattr(obj, attribute)] = obj
+
+        # restore the order of the ids
+        return [found[uid] for uid in ids if uid in found]
+
+    # QUERY PLANS ######################################################################################################
+    def capturePlans(self, snapshot: str, engines: Iterable[sqlalchemy.Engine] | None = None) -> PlanCapture:
+        """
+        Opt-in guard against plan regressions, for tests and benchmarks: the statements sent in the returned context
+        are explained and compared to the snapshot `snapshot`.json in DB_PLAN_SNAPSHOT_PATH. Raises a
+        PlanRegressionError on exit if a plan got worse. The engines default to the engines of the current app.
+        """
+        if engines is None:
+            engines = list(self._db.engines.values())
+        return PlanCapture(pathlib.Path(Config.DB_PLAN_SNAPSHOT_PATH) / f'{snapshot}.json', engines)
 
     # HISTORY ##########################################################################################################
     @staticmethod
@@ -98,6 +321,15 @@ class Database:
 
         return why
 
+    @staticmethod
+    def getModifiedAttributes(obj: flask_sqlalchemy.extension.Model,
+                              attributes: Iterable[str] | None = None) -> list[str]:
+        # the attributes with pending changes, according to the attribute history ; only meaningful before a flush
+        # a dotted path, i.e. team.name, changed if its relationship, team, changed
+        state = sqlalchemy.inspect(obj)
+        names = attributes if attributes is not None else state.attrs.keys()
+        return [name for name in names if state.attrs[name.partition('.')[0]].history.has_changes()]
+
     ####################################################################################################################
     # GETTERS ##########################################################################################################
     ####################################################################################################################
@@ -109,10 +341,99 @@ class Database:
     def migrate(self) -> flask_migrate.Migrate:
         return self._migrate
 
+    @property
+    def transactionDepth(self) -> int:
+        # the number of nested units of work of the current thread ; 0 outside of a unit of work
+        return getattr(self._local, 'depth', 0)
+
+    @property
+    def replicaStatus(self) -> dict[str, dict[str, Any]]:
+        # the health and the replication lag of each read replica
+        return self._router.status
+
+    @property
+    def queryReport(self) -> dict[str, dict[str, Any]]:
+        # the statements of the sampled requests, aggregated per endpoint
+        return self._profiler.report
+
+    @property
+    def poolStatistics(self) -> dict[str, dict[str, Any]]:
+        # checkout wait times, saturation and connection churn of the pool of each engine, per process
+        return {key: monitor.statistics for key, monitor in self._poolMonitors.items()}
+
     ####################################################################################################################
     # PRIVATE METHODS ##################################################################################################
     ####################################################################################################################
+    def _deleteRelated(self, mapper: sqlalchemy.orm.Mapper, relationship: sqlalchemy.orm.RelationshipProperty,
+                       objs: list) -> int:
+        local, remote = relationship.local_remote_pairs[0]
+        key = mapper.get_property_by_column(local).key
+
+        count = 0
+        for chunk in _chunks((getattr(obj, key) for obj in objs), Config.DB_BULK_CHUNK_SIZE):
+            statement = sqlalchemy.delete(relationship.mapper).where(remote.in_(chunk)) \
+                .execution_options(synchronize_session=False)
+            count += self._db.session.execute(statement).rowcount
+        return count
+
+    def _bulkExecute(self, statement, rows: Iterable[dict[str, Any]], chunkSize: int | None) -> int:
+        count = 0
+        try:
+            for chunk in _chunks(rows, chunkSize or Config.DB_BULK_CHUNK_SIZE):
+                self._db.session.execute(statement, chunk)
+                count += len(chunk)
+            self._commit()
+        except Exception as e:
+            self._rollbackAndRaise(e)
+        return count
+
+    def _afterFork(self) -> None:
+        # drop the connections inherited from the parent process without closing them, as the parent still uses them
+        for monitor in self._poolMonitors.values():
+            monitor.engine.dispose(close=False)
+            monitor.reset()
+
+    def _commit(self, *objs: flask_sqlalchemy.extension.Model, flush: bool = False) -> None:
+        # commit and reload the given objects ; in a unit of work, only flush, as the block commits and expires nothing
+        if self.transactionDepth > 0:
+            self._db.session.flush()
+            return
+        self._db.session.commit()
+        if flush:
+            self._db.session.flush()
+        for obj in objs:
+            self._db.session.refresh(obj)
+
     def _rollbackAndRaise(self, exception: Exception):
-        # rollback the session and raise a runtime exception
-        self._db.session.rollback()
-        raise RuntimeError from exception
\ No newline at end of file
+        # rollback the session and raise a runtime exception ; in a unit of work, the block rolls back
+        if self.transactionDepth == 0:
+            self._db.session.rollback()
+        raise RuntimeError from exception
+########################################################################################################################
+# HELPERS ##############################################################################################################
+########################################################################################################################
+def _includeObject(obj, name: str, typeName: str, reflected: bool, compareTo) -> bool:
+    # keep Alembic autogenerate from dropping the tables, and their indices, which are not declared as models
+    table = obj if typeName == 'table' else getattr(obj, 'table', None)
+    return table is None or not table.name.startswith(_excludedTablePrefixes)
+
+def _isRetryable(exception: BaseException | None) -> bool:
+    # whether a serialization failure or a deadlock caused the exception, according to the SQLSTATE of the driver
+    while exception is not None:
+        if isinstance(exception, sqlalchemy.exc.DBAPIError):
+            original = exception.orig
+            code = getattr(original, 'pgcode', None) or getattr(original, 'sqlstate', None) \
+                or next(iter(getattr(original, 'args', ())), None)
+            return code in _retryableErrors
+        exception = exception.__cause__
+    return False
+
+def _chunks(items: Iterable, size: int) -> Iterator[list]:
+    chunk = []
+    for item in items:
+        chunk.append(item)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
@@ -0,0 +1,185 @@
+"""
+Capture of the query plans of the statements sent to the database, compared to stored snapshots to catch regressions.
+
+SPDX-FileCopyrightText: © 2024 Gilles Bellot <gilles.bellot@bell0bytes.eu>
+SPDX-License-Identifier: AGPL-3.0-or-later
+"""
+
+########################################################################################################################
+# IMPORTS ##############################################################################################################
+########################################################################################################################
+import hashlib
+import json
+import logging
+import pathlib
+import re
+import threading
+import sqlalchemy
+import sqlalchemy.event
+from app.factory.conf import Config
+
+from typing import Any, Iterable
+
+########################################################################################################################
+# CONSTANTS ############################################################################################################
+########################################################################################################################
+_explainable = re.compile(r'^\s*(SELECT|WITH|UPDATE|DELETE)\b', re.IGNORECASE)
+_sqliteStep = re.compile(r'^(SCAN|SEARCH) (?:TABLE )?(\w+)')
+_sqliteIndex = re.compile(r'USING (?:COVERING )?INDEX (\w+)')
+_savepoint = 'ertie_plan_capture'                                   # isolates EXPLAIN on PostgreSQL
+
+########################################################################################################################
+# EXCEPTIONS ###########################################################################################################
+########################################################################################################################
+class PlanRegressionError(RuntimeError):
+    """Raised when the plan of a statement got worse than its snapshot."""
+
+########################################################################################################################
+# CLASS ################################################################################################################
+########################################################################################################################
+class PlanCapture:
+    """
+    Context manager which explains each distinct statement sent through the engines while it is active, with EXPLAIN
+    on PostgreSQL and EXPLAIN QUERY PLAN on SQLite, and compares the plans to the snapshot file on exit. A plan
+    regressed if it scans a table sequentially which was not scanned before, no longer uses an index it used before
+    or estimates more than DB_PLAN_ROW_FACTOR times the rows it estimated before. New statements are added to the
+    snapshot ; with DB_PLAN_UPDATE, the snapshot is replaced rather than checked.
+    """
+    def __init__(self, path: pathlib.Path, engines: Iterable[sqlalchemy.Engine], update: bool | None = None) -> None:
+        self._path = pathlib.Path(path)
+        self._engines = list(engines)
+        self._update = Config.DB_PLAN_UPDATE if update is None else update
+        self._plans: dict[str, dict[str, Any]] = {}
+        self._lock = threading.Lock()
+
+    ####################################################################################################################
+    # GETTERS ##########################################################################################################
+    ####################################################################################################################
+    @property
+    def plans(self) -> dict[str, dict[str, Any]]:
+        return self._plans
+
+    ####################################################################################################################
+    # CONTEXT MANAGER ##################################################################################################
+    ####################################################################################################################
+    def __enter__(self) -> 'PlanCapture':
+        for engine in self._engines:
+            sqlalchemy.event.listen(engine, 'before_cursor_execute', self._beforeExecute)
+        return self
+
+    def __exit__(self, exceptionType, exception, traceback) -> None:
+        for engine in self._engines:
+            sqlalchemy.event.remove(engine, 'before_cursor_execute', self._beforeExecute)
+        if exceptionType is None:
+            self.check()
+
+    ####################################################################################################################
+    # PUBLIC METHODS €##################################################################################################
+    ####################################################################################################################
+    def compare(self, snapshot: dict[str, dict[str, Any]]) -> list[str]:
+        # describe how the captured plans regressed compared to the snapshot
+        regressions = []
+        for key, plan in self._plans.items():
+            previous = snapshot.get(key)
+            if previous is None:
+                continue
+            statement = plan['statement']
+            for table in sorted(set(plan['scans']) - set(previous['scans'])):
+                regressions.append(f'New sequential scan of {table}: {statement}')
+            for index in sorted(set(previous['indexes']) - set(plan['indexes'])):
+                regressions.append(f'Index {index} no longer used: {statement}')
+            if previous['rows'] is not None and plan['rows'] is not None \
+                    and plan['rows'] > max(previous['rows'], 1) * Config.DB_PLAN_ROW_FACTOR:
+                regressions.append(f'Row estimate grew from {previous["rows"]} to {plan["rows"]}: {statement}')
+        return regressions
+
+    def check(self) -> None:
+        snapshot = json.loads(self._path.read_text()) if self._path.is_file() else {}
+        regressions = [] if self._update else self.compare(snapshot)
+        if regressions:
+            raise PlanRegressionError('Query plan regression(s):\n' + '\n'.join(regressions))
+
+        # record the new statements, or all of them when updating
+        snapshot = {**snapshot, **self._plans} if self._update else {**self._plans, **snapshot}
+        self._path.parent.mkdir(parents=True, exist_ok=True)
+        self._path.write_text(json.dumps(snapshot, indent=2, sort_keys=True) + '\n')
+
+    ####################################################################################################################
+    # PRIVATE METHODS ##################################################################################################
+    ####################################################################################################################
+    def _beforeExecute(self, connection, cursor, statement, parameters, context, executemany) -> None:
+        # explain each shape once, with the parameters of its first execution
+        key = hashlib.sha1(statement.encode(), usedforsecurity=False).hexdigest()[:16]
+        if key in self._plans or not _explainable.match(statement):
+            return
+        if executemany:
+            parameters = parameters[0]
+
+        dialect = connection.dialect.name
+        if dialect not in ('postgresql', 'sqlite'):
+            return
+
+        # EXPLAIN runs in the transaction of the statement ; on PostgreSQL, an error would abort the transaction,
+        # thus it runs in a savepoint of its own
+        savepoint = dialect == 'postgresql' and not getattr(connection.connection.dbapi_connection, 'autocommit', False)
+        explain = connection.connection.cursor()
+        try:
+            if savepoint:
+                explain.execute(f'SAVEPOINT {_savepoint}')
+            if dialect == 'postgresql':
+                explain.execute(f'EXPLAIN (FORMAT JSON) {statement}', parameters)
+                plan = _postgresqlPlan(explain.fetchone()[0])
+            else:
+                explain.execute(f'EXPLAIN QUERY PLAN {statement}', parameters)
+                plan = _sqlitePlan([row[-1] for row in explain.fetchall()])
+            if savepoint:
+                explain.execute(f'RELEASE SAVEPOINT {_savepoint}')
+        except Exception as e:
+            # the statement itself is sent all the same, only its plan is missing
+            if savepoint:
+                explain.execute(f'ROLLBACK TO SAVEPOINT {_savepoint}')
+                explain.execute(f'RELEASE SAVEPOINT {_savepoint}')
+            logging.getLogger('ErtieLogger').warning(f'Unable to explain {statement}: {e}')
+            return
+        finally:
+            explain.close()
+
+        with self._lock:
+            self._plans.setdefault(key, {'statement': statement, **plan})
+
+########################################################################################################################
+# HELPERS ##############################################################################################################
+########################################################################################################################
+def _postgresqlPlan(document: Any) -> dict[str, Any]:
+    # psycopg2 decodes the JSON plan ; other drivers may return it as a string
+    if isinstance(document, str):
+        document = json.loads(document)
+    root = document[0]['Plan']
+
+    scans, indexes = set(), set()
+    nodes = [root]
+    while nodes:
+        node = nodes.pop()
+        if node['Node Type'] == 'Seq Scan':
+            scans.add(node['Relation Name'])
+        if 'Index Name' in node:
+            indexes.add(node['Index Name'])
+        nodes.extend(node.get('Plans', ()))
+    return {'scans': sorted(scans), 'indexes': sorted(indexes), 'rows': root.get('Plan Rows')}
+
+def _sqlitePlan(details: list[str]) -> dict[str, Any]:
+    # i.e. 'SCAN member', 'SEARCH member USING INDEX ix_member_name (name=?)', 'SEARCH member USING INTEGER PRIMARY KEY'
+    scans, indexes = set(), set()
+    for detail in details:
+        step = _sqliteStep.match(detail)
+        if step is None or detail == 'SCAN CONSTANT ROW':
+            continue
+        table = step.group(2)
+        index = _sqliteIndex.search(detail)
+        if index is not None:
+            indexes.add(index.group(1))
+        elif 'PRIMARY KEY' in detail:
+            indexes.add(f'{table} primary key')
+        elif step.group(1) == 'SCAN':
+            scans.add(table)
+    return {'scans': sorted(scans), 'indexes': sorted(indexes), 'rows': None}
@@ -0,0 +1,144 @@
+"""
+Connection pool telemetry: checkout wait times, saturation and connection churn.
+
+SPDX-FileCopyrightText: © 2024 Gilles Bellot <gilles.bellot@bell0bytes.eu>
+SPDX-License-Identifier: AGPL-3.0-or-later
+"""
+
+########################################################################################################################
+# IMPORTS ##############################################################################################################
+########################################################################################################################
+import threading
+import time
+import sqlalchemy
+import sqlalchemy.event
+import sqlalchemy.exc
+import sqlalchemy.pool
+
+from typing import Any
+
+########################################################################################################################
+# POOL #################################################################################################################
+########################################################################################################################
+class MonitoredQueuePool(sqlalchemy.pool.QueuePool):
+    """
+    Queue pool which reports the time each checkout took to its monitor, i.e. the time spent waiting for a free
+    connection, opening a new one or pinging it. The monitor survives the recreation of the pool by Engine.dispose.
+    """
+    monitor: 'PoolMonitor | None' = None
+
+    @property
+    def capacity(self) -> int | None:
+        # the maximum number of connections ; None if the overflow is unlimited
+        return self.size() + self._max_overflow if self._max_overflow > -1 else None
+
+    def recreate(self) -> 'MonitoredQueuePool':
+        pool = super().recreate()
+        pool.monitor = self.monitor
+        return pool
+
+    def connect(self):
+        start = time.perf_counter()
+        try:
+            connection = super().connect()
+        except sqlalchemy.exc.TimeoutError:
+            if self.monitor is not None:
+                self.monitor.recordCheckout(time.perf_counter() - start, timedOut=True)
+            raise
+        if self.monitor is not None:
+            self.monitor.recordCheckout(time.perf_counter() - start)
+        return connection
+
+########################################################################################################################
+# MONITOR ##############################################################################################################
+########################################################################################################################
+class PoolMonitor:
+    """
+    Collects the statistics of the connection pool of an engine from the pool events: the connections opened and
+    invalidated, the connections checked out and their peak, and, for monitored queue pools, the checkout wait times
+    and timeouts. The statistics are per process and are reset when the pool is disposed after a fork.
+    """
+    def __init__(self, engine: sqlalchemy.Engine) -> None:
+        self._engine = engine
+        self._lock = threading.Lock()
+        self.reset()
+
+        if isinstance(engine.pool, MonitoredQueuePool):
+            engine.pool.monitor = self
+        for name, listener in (('connect', self._onConnect),
+                               ('checkout', self._onCheckout),
+                               ('checkin', self._onCheckin),
+                               ('invalidate', self._onInvalidate)):
+            sqlalchemy.event.listen(engine, name, listener)
+
+    ####################################################################################################################
+    # GETTERS ##########################################################################################################
+    ####################################################################################################################
+    @property
+    def engine(self) -> sqlalchemy.Engine:
+        return self._engine
+
+    @property
+    def statistics(self) -> dict[str, Any]:
+        pool = self._engine.pool
+        queued = isinstance(pool, sqlalchemy.pool.QueuePool)
+        capacity = pool.capacity if isinstance(pool, MonitoredQueuePool) else None
+        with self._lock:
+            return {'size': pool.size() if queued else None,
+                    'overflow': pool.overflow() if queued else None,
+                    'capacity': capacity,
+                    'checkedOut': self._checkedOut,
+                    'peakCheckedOut': self._peakCheckedOut,
+                    'saturation': self._checkedOut / capacity if capacity else None,
+                    'checkouts': self._checkouts,
+                    'waitTotal': self._waitTotal,
+                    'waitMax': self._waitMax,
+                    'waitAverage': self._waitTotal / self._timedCheckouts if self._timedCheckouts else 0.0,
+                    'timeouts': self._timeouts,
+                    'connects': self._connects,
+                    'invalidations': self._invalidations}
+
+    ####################################################################################################################
+    # PUBLIC METHODS €##################################################################################################
+    ####################################################################################################################
+    def recordCheckout(self, seconds: float, timedOut: bool = False) -> None:
+        with self._lock:
+            self._timedCheckouts += 1
+            self._waitTotal += seconds
+            self._waitMax = max(self._waitMax, seconds)
+            if timedOut:
+                self._timeouts += 1
+
+    def reset(self) -> None:
+        with self._lock:
+            self._checkedOut = 0
+            self._peakCheckedOut = 0
+            self._checkouts = 0
+            self._timedCheckouts = 0
+            self._waitTotal = 0.0
+            self._waitMax = 0.0
+            self._timeouts = 0
+            self._connects = 0
+            self._invalidations = 0
+
+    ####################################################################################################################
+    # PRIVATE METHODS ##################################################################################################
+    ####################################################################################################################
+    def _onConnect(self, dbapiConnection, connectionRecord) -> None:
+        with self._lock:
+            self._connects += 1
+
+    def _onCheckout(self, dbapiConnection, connectionRecord, connectionProxy) -> None:
+        with self._lock:
+            self._checkouts += 1
+            self._checkedOut += 1
+            self._peakCheckedOut = max(self._peakCheckedOut, self._checkedOut)
+
+    def _onCheckin(self, dbapiConnection, connectionRecord) -> None:
+        with self._lock:
+            self._checkedOut = max(0, self._checkedOut - 1)
+
+    def _onInvalidate(self, dbapiConnection, connectionRecord, exception) -> None:
+        # i.e. connections found stale by the pre-ping or lost during a failover
+        with self._lock:
+            self._invalidations += 1
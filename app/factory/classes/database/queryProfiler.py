@@ -0,0 +1,162 @@
+"""
+Per-request SQL instrumentation: query counts, database time, slowest and repeated statements.
+
+SPDX-FileCopyrightText: © 2024 Gilles Bellot <gilles.bellot@bell0bytes.eu>
+SPDX-License-Identifier: AGPL-3.0-or-later
+"""
+
+########################################################################################################################
+# IMPORTS ##############################################################################################################
+########################################################################################################################
+import collections
+import heapq
+import logging
+import random
+import threading
+import time
+import flask
+import sqlalchemy
+import sqlalchemy.event
+from app.factory.conf import Config
+
+from typing import Any
+
+########################################################################################################################
+# CONSTANTS ############################################################################################################
+########################################################################################################################
+_profileKey = 'ertieQueryProfile'                                   # the profile of the current request in flask.g
+_startKey = 'ertieQueryStart'                                       # the start times of the running statements
+_unmatched = '<unmatched>'                                          # the requests which matched no endpoint
+
+########################################################################################################################
+# REQUEST PROFILE ######################################################################################################
+########################################################################################################################
+class RequestProfile:
+    """The statements sent to the database while handling one request."""
+    __slots__ = ('count', 'duration', 'shapes', '_slowest')
+
+    def __init__(self) -> None:
+        self.count = 0
+        self.duration = 0.0
+        self.shapes: collections.Counter[str] = collections.Counter()
+        self._slowest: list[tuple[float, str]] = []                 # min-heap of the slowest statements
+
+    @property
+    def slowest(self) -> list[tuple[float, str]]:
+        return sorted(self._slowest, reverse=True)
+
+    @property
+    def repeated(self) -> dict[str, int]:
+        # statements sent again and again with different parameters, typically lazy loads in a loop, i.e. N+1 queries
+        return {statement: count for statement, count in self.shapes.items()
+                if count >= Config.DB_PROFILER_REPEAT_THRESHOLD}
+
+    def record(self, statement: str, seconds: float) -> None:
+        # the statements are compiled with placeholders, thus identical statements share their shape
+        self.count += 1
+        self.duration += seconds
+        self.shapes[statement] += 1
+        if len(self._slowest) < Config.DB_PROFILER_SLOWEST:
+            heapq.heappush(self._slowest, (seconds, statement))
+        elif seconds > self._slowest[0][0]:
+            heapq.heapreplace(self._slowest, (seconds, statement))
+
+########################################################################################################################
+# PROFILER #############################################################################################################
+########################################################################################################################
+class QueryProfiler:
+    """
+    Times the statements of a sample of the requests, DB_PROFILER_SAMPLE_RATE, with the cursor events of the engines.
+    The query count and the database time of each sampled request are sent in a Server-Timing header and added to a
+    report per endpoint, of at most DB_PROFILER_REPORT_SIZE entries ; repeated statements, i.e. N+1 queries, are
+    logged. Requests which are not sampled only cost a lookup in flask.g per statement.
+    """
+    def __init__(self) -> None:
+        self._report: dict[str, dict[str, Any]] = {}
+        self._lock = threading.Lock()
+
+    ####################################################################################################################
+    # GETTERS ##########################################################################################################
+    ####################################################################################################################
+    @property
+    def report(self) -> dict[str, dict[str, Any]]:
+        # requests, queries, database time, slowest request and slowest statements and N+1 requests per endpoint
+        with self._lock:
+            return {endpoint: {**entry, 'slowest': sorted(entry['slowest'], reverse=True)}
+                    for endpoint, entry in self._report.items()}
+
+    ####################################################################################################################
+    # PUBLIC METHODS €##################################################################################################
+    ####################################################################################################################
+    def init(self, app: flask.Flask, engines: dict[str | None, sqlalchemy.Engine]) -> None:
+        for engine in engines.values():
+            self.listen(engine)
+        app.before_request(self._beforeRequest)
+        app.after_request(self._afterRequest)
+
+    def listen(self, engine: sqlalchemy.Engine) -> None:
+        for name, listener in (('before_cursor_execute', self._beforeExecute),
+                               ('after_cursor_execute', self._afterExecute),
+                               ('handle_error', self._onError)):
+            if not sqlalchemy.event.contains(engine, name, listener):
+                sqlalchemy.event.listen(engine, name, listener)
+
+    def reset(self) -> None:
+        with self._lock:
+            self._report = {}
+
+    ####################################################################################################################
+    # PRIVATE METHODS ##################################################################################################
+    ####################################################################################################################
+    @staticmethod
+    def _profile() -> RequestProfile | None:
+        return flask.g.get(_profileKey) if flask.has_app_context() else None
+
+    def _beforeExecute(self, connection, cursor, statement, parameters, context, executemany) -> None:
+        if self._profile() is not None:
+            connection.info.setdefault(_startKey, []).append(time.perf_counter())
+
+    def _afterExecute(self, connection, cursor, statement, parameters, context, executemany) -> None:
+        profile = self._profile()
+        starts = connection.info.get(_startKey)
+        if profile is not None and starts:
+            profile.record(statement, time.perf_counter() - starts.pop())
+
+    @staticmethod
+    def _onError(context) -> None:
+        # failed statements are not timed
+        starts = context.connection.info.get(_startKey) if context.connection is not None else None
+        if starts:
+            starts.pop()
+
+    @staticmethod
+    def _beforeRequest() -> None:
+        if Config.DB_PROFILER_SAMPLE_RATE > 0 and random.random() < Config.DB_PROFILER_SAMPLE_RATE:
+            flask.g.setdefault(_profileKey, RequestProfile())
+
+    def _afterRequest(self, response: flask.Response) -> flask.Response:
+        profile = flask.g.pop(_profileKey, None)
+        if profile is None:
+            return response
+
+        response.headers.add('Server-Timing', f'db;dur={profile.duration * 1000:.1f};desc="{profile.count} queries"')
+
+        # the paths of unmatched requests are chosen by the clients, thus they share one entry
+        endpoint = flask.request.endpoint or _unmatched
+        repeated = profile.repeated
+        for statement, count in repeated.items():
+            logging.getLogger('ErtieLogger').warning(f'Possible N+1 query in {endpoint}, sent {count} times: '
+                                                     f'{statement}')
+
+        with self._lock:
+            if endpoint not in self._report and len(self._report) >= Config.DB_PROFILER_REPORT_SIZE:
+                return response
+            entry = self._report.setdefault(endpoint, {'requests': 0, 'queries': 0, 'duration': 0.0,
+                                                       'maxDuration': 0.0, 'repeated': 0, 'slowest': []})
+            entry['requests'] += 1
+            entry['queries'] += profile.count
+            entry['duration'] += profile.duration
+            entry['maxDuration'] = max(entry['maxDuration'], profile.duration)
+            entry['repeated'] += 1 if repeated else 0
+            entry['slowest'] = heapq.nlargest(Config.DB_PROFILER_SLOWEST, entry['slowest'] + profile.slowest)
+        return response
@@ -0,0 +1,205 @@
+"""
+Routing of the reads to the read replicas, with lag and health checks and a fallback to the primary.
+
+SPDX-FileCopyrightText: © 2024 Gilles Bellot <gilles.bellot@bell0bytes.eu>
+SPDX-License-Identifier: AGPL-3.0-or-later
+"""
+
+########################################################################################################################
+# IMPORTS ##############################################################################################################
+########################################################################################################################
+import itertools
+import logging
+import os
+import threading
+import time
+import flask
+import sqlalchemy
+import sqlalchemy.event
+import sqlalchemy.sql
+import flask_sqlalchemy.session
+from app.factory.conf import Config
+
+from typing import Any
+
+########################################################################################################################
+# CONSTANTS ############################################################################################################
+########################################################################################################################
+_replicaPrefix = 'replica'                                          # the bind keys of the replicas, i.e. replica0
+_writeKey = 'ertieWrite'                                            # marks sessions with a pending write transaction
+_stickyKey = 'ertiePrimaryUntil'                                    # end of the stickiness window of a client
+
+# the replication lag in seconds ; 0 if the replica replayed everything it received, or if it is not a standby
+_postgresqlLag = sqlalchemy.text('SELECT CASE WHEN NOT pg_is_in_recovery() THEN 0 '
+                                 'WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0 '
+                                 'ELSE EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()) END')
+
+########################################################################################################################
+# SESSION ##############################################################################################################
+########################################################################################################################
+class RoutingSession(flask_sqlalchemy.session.Session):
+    """Session which lets the router choose between the primary and the replicas for the statements of the primary."""
+    def __init__(self, db, router: 'ReplicaRouter | None' = None, **kwargs) -> None:
+        super().__init__(db, **kwargs)
+        self._router = router
+
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        engine = super().get_bind(mapper, clause=clause, bind=bind, **kwargs)
+        if bind is None and self._router is not None:
+            return self._router.route(self, engine, clause)
+        return engine
+
+########################################################################################################################
+# ROUTER ###############################################################################################################
+########################################################################################################################
+class ReplicaRouter:
+    """
+    Sends the plain SELECT statements to a healthy replica, in turns, and everything else to the primary. A session
+    sticks to the primary once it wrote in its transaction, and so does a client for DB_REPLICA_STICKY_WINDOW seconds
+    after its last committed write, such that it reads its own writes. In read-only blueprints, all statements but
+    the writes go to the replicas. A background thread checks the health and lag of the replicas ; replicas which
+    are unreachable or lag behind by more than DB_REPLICA_MAX_LAG seconds are skipped until they caught up.
+    """
+    def __init__(self) -> None:
+        self._primary = None
+        self._replicas: dict[str, sqlalchemy.Engine] = {}
+        self._healthy: tuple[sqlalchemy.Engine, ...] = ()   # replaced as a whole, thus read without locking
+        self._lags: dict[str, float | None] = {}
+        self._turn = itertools.count()
+        self._readOnlyBlueprints: set[str] = set()
+
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._worker = None
+        self._pid = None
+
+    ####################################################################################################################
+    # GETTERS ##########################################################################################################
+    ####################################################################################################################
+    @property
+    def replicas(self) -> dict[str, sqlalchemy.Engine]:
+        return self._replicas
+
+    @property
+    def status(self) -> dict[str, dict[str, Any]]:
+        # the health and the last measured lag of each replica
+        return {key: {'healthy': engine in self._healthy, 'lag': self._lags.get(key)}
+                for key, engine in self._replicas.items()}
+
+    ####################################################################################################################
+    # PUBLIC METHODS €##################################################################################################
+    ####################################################################################################################
+    def init(self, engines: dict[str | None, sqlalchemy.Engine]) -> None:
+        # the default bind is the primary, the binds named replica0, replica1, ... are its replicas
+        self._primary = engines.get(None)
+        self._replicas = {key: engine for key, engine in sorted(engines.items(), key=lambda item: str(item[0]))
+                          if key is not None and key.startswith(_replicaPrefix)}
+        self._healthy = ()
+        self._lags = {}
+        for engine in self._replicas.values():
+            if not sqlalchemy.event.contains(engine, 'handle_error', self._onError):
+                sqlalchemy.event.listen(engine, 'handle_error', self._onError)
+
+    def listen(self, session) -> None:
+        # attach the listeners which track the write transactions to a session, scoped session or sessionmaker
+        for name, listener in (('after_flush', self._afterFlush),
+                               ('after_commit', self._afterCommit),
+                               ('after_soft_rollback', self._afterSoftRollback)):
+            if not sqlalchemy.event.contains(session, name, listener):
+                sqlalchemy.event.listen(session, name, listener)
+
+    def readOnly(self, blueprint: flask.Blueprint) -> flask.Blueprint:
+        # send all statements of the requests of a blueprint to the replicas, except for the writes
+        self._readOnlyBlueprints.add(blueprint.name)
+        return blueprint
+
+    def markWrite(self, session) -> None:
+        # pin the transaction of a session to the primary
+        session.info[_writeKey] = True
+
+    def route(self, session, engine: sqlalchemy.Engine, clause) -> sqlalchemy.Engine:
+        # only the statements of the primary are routed ; other binds keep their engine
+        if engine is not self._primary or not self._replicas:
+            return engine
+        if not self._isRead(clause):
+            self.markWrite(session)
+            return engine
+        if session.info.get(_writeKey) or self._isSticky():
+            return engine
+
+        self._ensureWorker()
+        healthy = self._healthy
+        if not healthy:
+            return engine
+        return healthy[next(self._turn) % len(healthy)]
+
+    def checkReplicas(self) -> None:
+        # measure the lag of each replica and keep the healthy ones
+        healthy = []
+        for key, engine in self._replicas.items():
+            try:
+                with engine.connect() as connection:
+                    lag = float(connection.scalar(_postgresqlLag) or 0.0) \
+                        if engine.dialect.name == 'postgresql' else connection.scalar(sqlalchemy.text('SELECT 0'))
+                self._lags[key] = lag
+                if lag <= Config.DB_REPLICA_MAX_LAG:
+                    healthy.append(engine)
+            except Exception as e:
+                self._lags[key] = None
+                logging.getLogger('ErtieLogger').error(f'Database replica {key} unavailable: {e}')
+        self._healthy = tuple(healthy)
+
+    def close(self) -> None:
+        self._stopped.set()
+
+    ####################################################################################################################
+    # PRIVATE METHODS ##################################################################################################
+    ####################################################################################################################
+    def _isRead(self, clause) -> bool:
+        if clause is None or isinstance(clause, sqlalchemy.sql.expression.UpdateBase):
+            return False
+        if isinstance(clause, sqlalchemy.sql.expression.SelectBase):
+            return getattr(clause, '_for_update_arg', None) is None
+        return flask.has_request_context() and flask.request.blueprint in self._readOnlyBlueprints
+
+    @staticmethod
+    def _isSticky() -> bool:
+        return flask.has_request_context() and flask.session.get(_stickyKey, 0) > time.time()
+
+    def _ensureWorker(self) -> None:
+        # (re)start the health checks lazily ; threads do not survive a fork, so each process gets its own worker
+        if self._worker is not None and self._worker.is_alive() and self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._worker is not None and self._worker.is_alive() and self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            self._worker = threading.Thread(target=self._run, name='ErtieReplicaMonitor', daemon=True)
+            self._worker.start()
+
+    def _run(self) -> None:
+        while not self._stopped.is_set():
+            self.checkReplicas()
+            self._stopped.wait(Config.DB_REPLICA_CHECK_INTERVAL)
+
+    def _onError(self, context) -> None:
+        # skip a replica as soon as it lost its connection, rather than at the next check
+        if context.is_disconnect:
+            self._healthy = tuple(engine for engine in self._healthy if engine is not context.engine)
+
+    def _afterFlush(self, session, flushContext) -> None:
+        self.markWrite(session)
+
+    def _afterCommit(self, session) -> None:
+        # after_commit also fires when a savepoint is released ; the outer transaction stays on the primary
+        if session.in_nested_transaction():
+            return
+
+        # the client reads from the primary until the replicas caught up with its write
+        if session.info.pop(_writeKey, False) and self._replicas and flask.has_request_context():
+            flask.session[_stickyKey] = time.time() + Config.DB_REPLICA_STICKY_WINDOW
+
+    def _afterSoftRollback(self, session, previousTransaction) -> None:
+        # rolling back a savepoint leaves the outer transaction, and its writes, on the primary
+        if not session.in_transaction():
+            session.info.pop(_writeKey, None)
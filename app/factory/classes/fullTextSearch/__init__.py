@@ -4,4 +4,6 @@ Full-Text Search
 SPDX-FileCopyrightText: © 2024 Gilles Bellot <gilles.bellot@bell0bytes.eu>
 SPDX-License-Identifier: AGPL-3.0-or-later
 """
-from .fullTextSearch import FullTextSearch
\ No newline at end of file
+from .fullTextSearch import FullTextSearch
+from .searchSync import SearchSync
+from .sqlFallback import SQLFallback
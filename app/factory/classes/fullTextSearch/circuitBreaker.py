@@ -0,0 +1,110 @@
+"""
+Circuit breaker around the calls to the full-text search engine.
+
+SPDX-FileCopyrightText: © 2024 Gilles Bellot <gilles.bellot@bell0bytes.eu>
+SPDX-License-Identifier: AGPL-3.0-or-later
+"""
+
+########################################################################################################################
+# IMPORTS ##############################################################################################################
+########################################################################################################################
+import logging
+import threading
+from typing import Any, Callable
+
+########################################################################################################################
+# EXCEPTIONS ###########################################################################################################
+########################################################################################################################
+class CircuitOpenError(RuntimeError):
+    """Raised instead of calling the search engine while the circuit is open."""
+
+########################################################################################################################
+# CLASS ################################################################################################################
+########################################################################################################################
+class CircuitBreaker:
+    """
+    Opens after `threshold` consecutive failures, such that further calls fail fast. While open, a background thread
+    probes the engine every `probeInterval` seconds and closes the circuit once the probe and the recovery hook
+    succeed.
+    """
+    def __init__(self, threshold: int, probeInterval: float, probe: Callable[[], bool],
+                 isFailure: Callable[[Exception], bool] = lambda e: True,
+                 onRecovery: Callable[[], None] | None = None) -> None:
+        self._threshold = threshold
+        self._probeInterval = probeInterval
+        self._probe = probe
+        self._isFailure = isFailure
+        self._onRecovery = onRecovery
+
+        self._failures = 0
+        self._open = False
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+
+    ####################################################################################################################
+    # GETTERS ##########################################################################################################
+    ####################################################################################################################
+    @property
+    def isOpen(self) -> bool:
+        return self._open
+
+    @property
+    def failures(self) -> int:
+        return self._failures
+
+    ####################################################################################################################
+    # PUBLIC METHODS €##################################################################################################
+    ####################################################################################################################
+    def call(self, function: Callable, *args, **kwargs) -> Any:
+        if self._open:
+            raise CircuitOpenError('The search engine is unavailable!')
+
+        try:
+            result = function(*args, **kwargs)
+        except Exception as e:
+            if self._isFailure(e):
+                self._recordFailure()
+            raise
+
+        self._failures = 0
+        return result
+
+    def trip(self) -> None:
+        # open the circuit and start probing for recovery
+        with self._lock:
+            if self._open:
+                return
+            self._open = True
+            self._stopped.clear()
+        logging.getLogger('ErtieLogger').error('Search engine unavailable: circuit opened.')
+        threading.Thread(target=self._probeUntilRecovered, name='ErtieCircuitProbe', daemon=True).start()
+
+    def reset(self) -> None:
+        # close the circuit
+        with self._lock:
+            self._failures = 0
+            self._open = False
+            self._stopped.set()
+
+    ####################################################################################################################
+    # PRIVATE METHODS ##################################################################################################
+    ####################################################################################################################
+    def _recordFailure(self) -> None:
+        with self._lock:
+            self._failures += 1
+            tripped = self._failures >= self._threshold
+        if tripped:
+            self.trip()
+
+    def _probeUntilRecovered(self) -> None:
+        while not self._stopped.wait(self._probeInterval):
+            try:
+                # the recovery hook runs before the circuit closes, i.e. to send the writes held during the outage
+                if self._probe() is True:
+                    if self._onRecovery is not None:
+                        self._onRecovery()
+                    self.reset()
+                    logging.getLogger('ErtieLogger').info('Search engine available again: circuit closed.')
+                    return
+            except Exception as e:
+                logging.getLogger('ErtieLogger').error(f'Search engine still unavailable: {e}')
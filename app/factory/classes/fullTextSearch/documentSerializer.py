@@ -0,0 +1,170 @@
+"""
+Compiled per-model serializers turning searchable models into search engine documents.
+
+SPDX-FileCopyrightText: © 2024 Gilles Bellot <gilles.bellot@bell0bytes.eu>
+SPDX-License-Identifier: AGPL-3.0-or-later
+"""
+
+########################################################################################################################
+# IMPORTS ##############################################################################################################
+########################################################################################################################
+import datetime
+import decimal
+import enum
+import json
+import operator
+import threading
+import uuid
+import sqlalchemy
+import sqlalchemy.exc
+
+from typing import Any, Callable, Iterable
+
+# orjson is pinned in the requirements ; the standard library encoder remains the fallback if it is not installed
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+########################################################################################################################
+# CONSTANTS ############################################################################################################
+########################################################################################################################
+_plainTypes = (str, int, float, bool, type(None))
+_converters: dict[type, Callable[[Any], Any]] = {datetime.datetime: datetime.datetime.isoformat,
+                                                 datetime.date: datetime.date.isoformat,
+                                                 datetime.time: datetime.time.isoformat,
+                                                 decimal.Decimal: float,
+                                                 uuid.UUID: str}
+_plain = object()                                                   # marks the columns which need no conversion
+
+########################################################################################################################
+# CLASS ################################################################################################################
+########################################################################################################################
+class DocumentSerializer:
+    """
+    Registry of document extractors, compiled once per model class (and per set of fields for partial documents).
+    Column types are resolved when compiling, such that plain columns are read without any conversion. Dates are
+    converted to ISO 8601 strings, decimals to floats, enums to their values and UUIDs to strings. Dotted fields, i.e.
+    'team.name', follow relationships ; collections yield lists.
+    """
+    def __init__(self) -> None:
+        self._extractors: dict[tuple[type, tuple[str, ...] | None], Callable[[Any], dict]] = {}
+        self._lock = threading.Lock()
+
+    ####################################################################################################################
+    # PUBLIC METHODS €##################################################################################################
+    ####################################################################################################################
+    def serialize(self, model, fields: Iterable[str] | None = None) -> dict:
+        # the document id is the uid of the model ; each searchable field, or each of the given fields, gets an entry
+        fields = tuple(fields) if fields is not None else None
+        key = (type(model), fields)
+        extractor = self._extractors.get(key)
+        if extractor is None:
+            extractor = _compile(type(model), fields if fields is not None else model.__searchable__)
+            with self._lock:
+                extractor = self._extractors.setdefault(key, extractor)
+        return extractor(model)
+
+    @staticmethod
+    def encode(document: Any) -> bytes:
+        # encode a document, or a list of documents, as compact JSON
+        if orjson is not None:
+            return orjson.dumps(document, default=_convert)
+        return json.dumps(document, default=_convert, separators=(',', ':'), ensure_ascii=False).encode()
+
+    @staticmethod
+    def encodeBatch(encodedDocuments: list[bytes]) -> bytes:
+        # join documents which were encoded one by one into a JSON array, without encoding them again
+        return b'[' + b','.join(encodedDocuments) + b']'
+
+########################################################################################################################
+# HELPERS ##############################################################################################################
+########################################################################################################################
+def _compile(modelClass: type, fields: Iterable[str]) -> Callable[[Any], dict]:
+    columns = _columnTypes(modelClass)
+
+    # plain attributes are read at once, the nested ones one by one
+    keys = ['id'] + [field for field in fields if '.' not in field]
+    getter = operator.attrgetter('uid', *keys[1:])
+    conversions = [(position, key, _columnConverter(columns.get(key)))
+                   for position, key in enumerate(keys) if position > 0 and columns.get(key) is not _plain]
+    nested = [(field, _nestedGetter(field)) for field in fields if '.' in field]
+
+    def extract(model) -> dict:
+        values = getter(model)
+        if len(keys) == 1:
+            values = (values,)
+        document = dict(zip(keys, values))
+        for position, key, converter in conversions:
+            document[key] = converter(values[position])
+        for key, get in nested:
+            document[key] = get(model)
+        return document
+
+    return extract
+
+def _columnTypes(modelClass: type) -> dict[str, Any]:
+    # the python type of each column ; _plain if it does not need a conversion, None if it is unknown
+    try:
+        mapper = sqlalchemy.inspect(modelClass)
+    except sqlalchemy.exc.NoInspectionAvailable:
+        return {}
+
+    types = {}
+    for attribute in mapper.column_attrs:
+        try:
+            pythonType = attribute.columns[0].type.python_type
+        except (NotImplementedError, AttributeError, IndexError):
+            pythonType = None
+        types[attribute.key] = _plain if pythonType in _plainTypes else pythonType
+    return types
+
+def _columnConverter(pythonType: type | None) -> Callable[[Any], Any]:
+    converter = _converters.get(pythonType)
+    if converter is not None:
+        return lambda value: None if value is None else converter(value)
+    if isinstance(pythonType, type) and issubclass(pythonType, enum.Enum):
+        return lambda value: None if value is None else _convert(value.value)
+    return _convert
+
+def _nestedGetter(path: str) -> Callable[[Any], Any]:
+    # follow the relationships of a dotted path ; the values of collections are gathered in a flat list
+    head, _, rest = path.partition('.')
+    getRest = _nestedGetter(rest) if rest else _convert
+
+    def get(obj) -> Any:
+        value = getattr(obj, head)
+        if rest and value is None:
+            return None
+        if rest and isinstance(value, (list, tuple, set)):
+            values = []
+            for item in value:
+                result = getRest(item)
+                if isinstance(result, list):
+                    values.extend(result)
+                else:
+                    values.append(result)
+            return values
+        return getRest(value)
+
+    return get
+
+def _convert(value: Any) -> Any:
+    # convert a value of unknown type to a JSON compatible value
+    if type(value) in _plainTypes:
+        return value
+    converter = _converters.get(type(value))
+    if converter is not None:
+        return converter(value)
+    if isinstance(value, enum.Enum):
+        return _convert(value.value)
+    if isinstance(value, (list, tuple, set, frozenset)):
+        return [_convert(item) for item in value]
+    if isinstance(value, dict):
+        return {str(key): _convert(item) for key, item in value.items()}
+    for baseType, converter in _converters.items():
+        if isinstance(value, baseType):
+            return converter(value)
+    if isinstance(value, _plainTypes):
+        return value
+    return str(value)
@@ -8,12 +8,25 @@ SPDX-License-Identifier: AGPL-3.0-or-later
 ########################################################################################################################
 # IMPORTS ##############################################################################################################
 ########################################################################################################################
+import collections
+import concurrent.futures
+import threading
+import sqlalchemy
 from app.factory.conf import Config
+from app.factory.classes.fullTextSearch.circuitBreaker import CircuitBreaker, CircuitOpenError
+from app.factory.classes.fullTextSearch.indexingQueue import IndexingQueue
+from app.factory.classes.fullTextSearch.queryCache import QueryCache, MemoryQueryCache, SQLiteQueryCache
 
-from typing import TYPE_CHECKING
+from typing import TYPE_CHECKING, Any, Callable, Iterable
 if TYPE_CHECKING:
     from app.factory.extensions import db
 
+########################################################################################################################
+# CONSTANTS ############################################################################################################
+########################################################################################################################
+_queryDefaults = {'resync': False, 'page': None, 'hitsPerPage': None, 'limit': None, 'offset': None,
+                  'attributesToRetrieve': None, 'exactTotal': False, 'filter': None, 'sort': None, 'facets': None}
+
 ########################################################################################################################
 # CLASS ################################################################################################################
 ########################################################################################################################
@@ -24,6 +37,39 @@ class FullTextSearch:
             # create a meilisearch object
             from app.factory.classes.fullTextSearch.meiliSearch import MeiliSearch
             self._engine = MeiliSearch()
+        elif Config.FULLTEXT_SEARCH_PROVIDER == 'sql':
+            # search inside the application database
+            from app.factory.classes.fullTextSearch.sqlSearch import SQLSearch
+            self._engine = SQLSearch()
+
+        self._breaker = None
+        self._fallback = None
+        self._queue = self._outageQueue = None
+        self._cache = None
+
+        # the writes in flight and the invalidations per index, such that stale results are not cached
+        self._writing: collections.Counter[str] = collections.Counter()
+        self._generations: collections.Counter[str] = collections.Counter()
+        self._lock = threading.Lock()
+        if self._engine is None:
+            # Ertië runs without full-text search if no provider is configured
+            return
+
+        # the circuit breaker fails fast while the engine is unavailable
+        self._breaker = CircuitBreaker(threshold=Config.FULLTEXT_SEARCH_BREAKER_THRESHOLD,
+                                       probeInterval=Config.FULLTEXT_SEARCH_BREAKER_PROBE_INTERVAL,
+                                       probe=self._engine.isHealthy, isFailure=self._engine.isTransientError,
+                                       onRecovery=self._onRecovery)
+        if hasattr(self._engine, 'useCircuitBreaker'):
+            self._engine.useCircuitBreaker(self._breaker)
+
+        # the indexing queue moves index writes off the request thread ; the outage queue holds them while the
+        # circuit is open
+        self._queue = IndexingQueue(self._engine, self._breaker, self._afterWrite) \
+            if Config.FULLTEXT_SEARCH_QUEUE is True else None
+
+        # the query cache saves a round trip for repeated searches
+        self._cache = _createQueryCache(Config.FULLTEXT_SEARCH_CACHE)
 
     ####################################################################################################################
     # GETTERS ##########################################################################################################
@@ -40,14 +86,309 @@ class FullTextSearch:
     def index(self) -> str:
         return self._engine.index
 
+    @property
+    def queryCache(self) -> QueryCache | None:
+        return self._cache
+
+    @property
+    def indexingQueue(self) -> IndexingQueue | None:
+        return self._queue
+
+    @property
+    def circuitBreaker(self) -> CircuitBreaker | None:
+        return self._breaker
+
+    @property
+    def consistencyToken(self) -> int | None:
+        # the token of the last write of the calling thread, to pass to queryIndex ; queued writes get a token once
+        # they are flushed, and only on the flushing thread
+        return getattr(self._engine, 'consistencyToken', None)
+
     ####################################################################################################################
     # PUBLIC METHODS €##################################################################################################
     ####################################################################################################################
-    def addToIndex(self, index: str, model: 'db.Model'):
-        return self._engine.addToIndex(index, model)
+    def addToIndex(self, index: str, model: 'db.Model', original: 'db.Model | None' = None):
+        # given the original model, only the searchable fields that changed are sent ; nothing if none changed
+        fields = None
+        if original is not None:
+            # compare the documents, such that dotted paths are resolved like the serializer does
+            document, previous = self._engine.createDocument(model), self._engine.createDocument(original)
+            fields = [field for field in model.__searchable__ if document.get(field) != previous.get(field)]
+            if not fields:
+                return None
+
+        queue = self._writeQueue()
+        if queue is not None:
+            return queue.add(index, self._engine.createDocument(model, fields))
+        return self._write(index, self._engine.addToIndex, model, fields)
+
+    def addManyToIndex(self, index: str, models: Iterable['db.Model']) -> list[int]:
+        queue = self._writeQueue()
+        if queue is not None:
+            return self._queueDocuments(queue, index, (self._engine.createDocument(model) for model in models))
+        return self._write(index, self._engine.addManyToIndex, models)
+
+    def addDocumentsToIndex(self, index: str, documents: list[dict]) -> list[int]:
+        queue = self._writeQueue()
+        if queue is not None:
+            return self._queueDocuments(queue, index, documents)
+        return self._write(index, self._engine.addDocumentsToIndex, documents)
 
     def removeFromIndex(self, index: str, model: 'db.Model'):
-        return self._engine.removeFromIndex(index, model)
+        queue = self._writeQueue()
+        if queue is not None:
+            return queue.remove(index, model.uid)
+        return self._write(index, self._engine.removeFromIndex, model)
+
+    def removeManyFromIndex(self, index: str, models: Iterable['db.Model']) -> list[int]:
+        queue = self._writeQueue()
+        if queue is not None:
+            return self._queueRemovals(queue, index, (model.uid for model in models))
+        return self._write(index, self._engine.removeManyFromIndex, models)
+
+    def removeDocumentsFromIndex(self, index: str, ids: list[int]) -> list[int]:
+        queue = self._writeQueue()
+        if queue is not None:
+            return self._queueRemovals(queue, index, ids)
+        return self._write(index, self._engine.removeDocumentsFromIndex, ids)
+
+    def queryIndex(self, index: str, query: str, resync:bool=False, page: int | None = None,
+                   hitsPerPage: int | None = None, limit: int | None = None, offset: int | None = None,
+                   attributesToRetrieve: list[str] | None = None, exactTotal: bool = False,
+                   filter: str | list | dict | None = None, sort: list[str] | None = None,
+                   facets: list[str] | None = None, consistencyToken: int | None = None):
+        """
+        Returns (ids, total), or (hits, total) when resyncing. The filter is a Meilisearch filter expression, or a
+        dict of field -> value (lists match any of their values). If facets are requested, their distribution is
+        returned as a third element: {field: {value: count}}.
+        Given a consistency token, the search waits (at most FULLTEXT_SEARCH_CONSISTENCY_TIMEOUT seconds) until the
+        writes it stands for are searchable, and bypasses the cache.
+        """
+        options = {'resync': resync, 'page': page, 'hitsPerPage': hitsPerPage, 'limit': limit, 'offset': offset,
+                   'attributesToRetrieve': attributesToRetrieve, 'exactTotal': exactTotal, 'filter': filter,
+                   'sort': sort, 'facets': facets}
+        if consistencyToken is not None:
+            # read your writes: wait for them to be searchable, then refresh the cache
+            consistent = self._waitForTasks(consistencyToken)
+            ticket = self._cacheTicket(index)
+            result, cacheable = self._query(index, query, options)
+            if self._cache is not None and cacheable is True and consistent is True:
+                self._cacheResult(index, self._cache.key(index, query, **options), result, ticket)
+            return result
+
+        if self._cache is None:
+            return self._query(index, query, options)[0]
+
+        # serve repeated searches from the cache ; fallback results are not cached
+        key = self._cache.key(index, query, **options)
+        result = self._cache.get(index, key)
+        if result is None:
+            ticket = self._cacheTicket(index)
+            result, cacheable = self._query(index, query, options)
+            if cacheable is True:
+                self._cacheResult(index, key, result, ticket)
+        return result
+
+    def multiQuery(self, queries: list[tuple[str, str, dict | None]]) -> list:
+        """
+        Runs several queries, i.e. on different indices, and returns their results in the order of the queries.
+        Engines with multi-search answer in one round trip, the others are queried concurrently.
+        """
+        results = [None] * len(queries)
+        keys = [None] * len(queries)
+
+        # serve the cached queries first
+        misses = []
+        for position, (index, query, options) in enumerate(queries):
+            if self._cache is not None:
+                keys[position] = self._cache.key(index, query, **self._queryOptions(options))
+                results[position] = self._cache.get(index, keys[position])
+            if results[position] is None:
+                misses.append(position)
+        if not misses:
+            return results
+
+        # then query the engine, or the fallback while the circuit is open
+        pending = [queries[position] for position in misses]
+        tickets = {queries[position][0]: self._cacheTicket(queries[position][0]) for position in misses}
+        try:
+            answers, cacheable = self._breaker.call(self._multiQuery, pending), True
+        except CircuitOpenError:
+            if self._fallback is None:
+                raise
+            answers = [self._fallback.queryIndex(index, query, **(options or {})) for index, query, options in pending]
+            cacheable = False
+
+        for position, answer in zip(misses, answers):
+            results[position] = answer
+            if self._cache is not None and cacheable is True:
+                index = queries[position][0]
+                self._cacheResult(index, keys[position], answer, tickets[index])
+        return results
 
-    def queryIndex(self, index: str, query: str, resync:bool=False):
-        return self._engine.queryIndex(index=index, query=query, resync=resync)
\ No newline at end of file
+    # REINDEX ##########################################################################################################
+    def reindex(self, index: str, modelClass: type, session: 'sqlalchemy.orm.Session', yieldPer: int | None = None,
+                progress: Callable[[int, float], None] | None = None) -> int:
+        # stream every row with a server-side cursor ; the rows are not kept, so memory usage is constant
+        statement = sqlalchemy.select(modelClass).execution_options(
+            yield_per=yieldPer if yieldPer is not None else Config.FULLTEXT_SEARCH_BATCH_SIZE)
+        documents = (self._engine.createDocument(model) for model in session.scalars(statement))
+        count = self._engine.reindex(index, documents, progress)
+        self._invalidate(index)
+        return count
+
+    # SETTINGS #########################################################################################################
+    def diffSettings(self, index: str, modelClass: type) -> dict[str, tuple[list[str], list[str]]]:
+        # compare the settings declared by the model with the live index
+        return self._breaker.call(self._engine.diffSettings, index, self._engine.declaredSettings(modelClass))
+
+    def applySettings(self, index: str, changes: dict[str, tuple[list[str], list[str]]]) -> list[int]:
+        return self._write(index, self._engine.applySettings, changes)
+
+    def requiresReindex(self, changes: dict) -> list[str]:
+        return self._engine.requiresReindex(changes)
+
+    # FALLBACK #########################################################################################################
+    def enableFallback(self, fallback) -> None:
+        # the fallback answers queryIndex while the circuit is open, i.e. with an SQLFallback
+        self._fallback = fallback
+
+    # INDEXING QUEUE ###################################################################################################
+    def enableIndexingQueue(self) -> IndexingQueue:
+        if self._queue is None:
+            self._queue = IndexingQueue(self._engine, self._breaker, self._afterWrite)
+        return self._queue
+
+    def flush(self) -> list[int]:
+        # synchronously send all queued index writes ; returns the task ids
+        taskIds = []
+        for queue in (self._outageQueue, self._queue):
+            if queue is not None:
+                taskIds += queue.flush()
+        return taskIds
+
+    def shutdown(self) -> None:
+        # drain the indexing queues and stop their workers
+        for queue in (self._outageQueue, self._queue):
+            if queue is not None:
+                queue.close()
+        self._queue = self._outageQueue = None
+
+    ####################################################################################################################
+    # PRIVATE METHODS ##################################################################################################
+    ####################################################################################################################
+    @staticmethod
+    def _queryOptions(options: dict | None) -> dict:
+        # complete the query options with their default values, such that equal queries share a cache key
+        return {**_queryDefaults, **(options or {})}
+
+    def _query(self, index: str, query: str, options: dict) -> tuple[Any, bool]:
+        # returns the result and whether it came from the engine
+        try:
+            return self._breaker.call(self._engine.queryIndex, index=index, query=query, **options), True
+        except CircuitOpenError:
+            if self._fallback is None:
+                raise
+            return self._fallback.queryIndex(index, query, **options), False
+
+    def _waitForTasks(self, token: int) -> bool:
+        # while the circuit is open, the fallback reads the database, which is consistent anyway
+        if not hasattr(self._engine, 'waitForTasks'):
+            return True
+        try:
+            return self._breaker.call(self._engine.waitForTasks, token, Config.FULLTEXT_SEARCH_CONSISTENCY_TIMEOUT)
+        except CircuitOpenError:
+            return False
+
+    def _multiQuery(self, queries: list[tuple[str, str, dict | None]]) -> list:
+        if hasattr(self._engine, 'multiQuery'):
+            return self._engine.multiQuery(queries)
+
+        # engines without multi-search are queried concurrently
+        with concurrent.futures.ThreadPoolExecutor(max_workers=len(queries)) as executor:
+            return list(executor.map(lambda entry: self._engine.queryIndex(index=entry[0], query=entry[1],
+                                                                           **(entry[2] or {})), queries))
+
+    def _writeQueue(self) -> IndexingQueue | None:
+        # writes are queued if the indexing queue is enabled, or held in the outage queue while the circuit is open
+        if self._queue is not None:
+            return self._queue
+        if self._breaker is not None and self._breaker.isOpen:
+            if self._outageQueue is None:
+                self._outageQueue = IndexingQueue(self._engine, self._breaker, self._afterWrite)
+            return self._outageQueue
+        return None
+
+    @staticmethod
+    def _queueDocuments(queue: IndexingQueue, index: str, documents: Iterable[dict]) -> list[int]:
+        for document in documents:
+            queue.add(index, document)
+        return []
+
+    @staticmethod
+    def _queueRemovals(queue: IndexingQueue, index: str, ids: Iterable[int]) -> list[int]:
+        for uid in ids:
+            queue.remove(index, uid)
+        return []
+
+    def _onRecovery(self) -> None:
+        # send the writes held during the outage before the circuit closes
+        if self._outageQueue is not None:
+            self._outageQueue.flush()
+
+    def _write(self, index: str, write: Callable[..., Any], *args) -> Any:
+        result = self._breaker.call(write, index, *args)
+
+        # the writes of single models return nothing ; their task is the last one of the thread
+        taskIds = result if isinstance(result, list) else [self.consistencyToken]
+        self._afterWrite(index, [taskId for taskId in taskIds if taskId is not None])
+        return result
+
+    def _afterWrite(self, index: str, taskIds: list[int]) -> None:
+        # the cached queries of an index are dropped once the write is searchable ; asynchronous engines report
+        # when their tasks are processed, and nothing is cached for the index in the meantime
+        if self._cache is None:
+            return
+        if not taskIds or not hasattr(self._engine, 'onTasksFinished'):
+            self._invalidate(index)
+            return
+        with self._lock:
+            self._writing[index] += 1
+        self._invalidate(index)
+        self._engine.onTasksFinished(taskIds, lambda: self._writeFinished(index))
+
+    def _writeFinished(self, index: str) -> None:
+        with self._lock:
+            self._writing[index] -= 1
+            if self._writing[index] <= 0:
+                del self._writing[index]
+        self._invalidate(index)
+
+    def _invalidate(self, index: str) -> None:
+        # drop the cached queries of an index ; the results of queries which were running meanwhile are not cached
+        if self._cache is not None:
+            with self._lock:
+                self._generations[index] += 1
+                self._cache.invalidate(index)
+
+    def _cacheTicket(self, index: str) -> int | None:
+        # taken before querying ; None while writes to the index are in flight
+        with self._lock:
+            return None if self._writing[index] > 0 else self._generations[index]
+
+    def _cacheResult(self, index: str, key: str, result: Any, ticket: int | None) -> None:
+        # only cache results that no write could have changed since the query started
+        with self._lock:
+            if ticket is not None and self._writing[index] == 0 and self._generations[index] == ticket:
+                self._cache.set(index, key, result)
+
+########################################################################################################################
+# HELPERS ##############################################################################################################
+########################################################################################################################
+def _createQueryCache(backend: str) -> QueryCache | None:
+    if backend == 'memory':
+        return MemoryQueryCache(Config.FULLTEXT_SEARCH_CACHE_SIZE, Config.FULLTEXT_SEARCH_CACHE_TTL)
+    if backend == 'sqlite':
+        return SQLiteQueryCache(Config.FULLTEXT_SEARCH_CACHE_SIZE, Config.FULLTEXT_SEARCH_CACHE_TTL,
+                                Config.FULLTEXT_SEARCH_CACHE_PATH)
+    return None
\ No newline at end of file
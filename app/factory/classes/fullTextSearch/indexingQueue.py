@@ -0,0 +1,178 @@
+"""
+Write-coalescing background indexer for the full-text search engine.
+
+SPDX-FileCopyrightText: © 2024 Gilles Bellot <gilles.bellot@bell0bytes.eu>
+SPDX-License-Identifier: AGPL-3.0-or-later
+"""
+
+########################################################################################################################
+# IMPORTS ##############################################################################################################
+########################################################################################################################
+import atexit
+import logging
+import os
+import threading
+import time
+from app.factory.conf import Config
+
+from typing import Callable
+
+########################################################################################################################
+# CLASS ################################################################################################################
+########################################################################################################################
+class IndexingQueue:
+    """
+    Collects add and remove operations and sends them to the search engine in batches from a background worker.
+    Operations are deduplicated by (index, uid): the last write wins, but partial documents are merged into a pending
+    addition. The batches go through the circuit breaker, and the worker pauses while it is open. Once a batch is sent,
+    onSent is called with the index and the task ids of each write.
+    """
+    def __init__(self, engine, breaker=None, onSent: Callable[[str, list[int]], None] | None = None) -> None:
+        self._engine = engine
+        self._breaker = breaker
+        self._onSent = onSent
+        self._maxSize = Config.FULLTEXT_SEARCH_QUEUE_SIZE
+        self._interval = Config.FULLTEXT_SEARCH_QUEUE_INTERVAL
+
+        # pending operations: (index, uid) -> document to add, or None to remove the document
+        self._pending: dict[tuple[str, int], dict | None] = {}
+        self._firstPending = None
+
+        self._lock = threading.Lock()                   # protects the pending operations
+        self._flushLock = threading.Lock()              # serializes the batches sent to the engine
+        self._wakeUp = threading.Condition(self._lock)
+        self._worker = None
+        self._pid = None
+        self._closed = False
+
+        # drain the queue when the interpreter shuts down
+        atexit.register(self.close)
+
+    ####################################################################################################################
+    # GETTERS ##########################################################################################################
+    ####################################################################################################################
+    @property
+    def pending(self) -> int:
+        return len(self._pending)
+
+    ####################################################################################################################
+    # PUBLIC METHODS €##################################################################################################
+    ####################################################################################################################
+    def add(self, index: str, document: dict) -> None:
+        self._enqueue(index, document['id'], document)
+
+    def remove(self, index: str, uid: int) -> None:
+        self._enqueue(index, uid, None)
+
+    def flush(self) -> list[int]:
+        # synchronously send all pending operations to the engine ; returns the task ids
+        with self._flushLock:
+            with self._lock:
+                batch, self._pending, self._firstPending = self._pending, {}, None
+            return self._send(batch)
+
+    def close(self) -> None:
+        # stop the worker and drain the remaining operations
+        with self._lock:
+            if self._closed:
+                return
+            self._closed = True
+            self._wakeUp.notify_all()
+        if self._worker is not None and self._worker.is_alive():
+            self._worker.join()
+        self.flush()
+
+    ####################################################################################################################
+    # PRIVATE METHODS ##################################################################################################
+    ####################################################################################################################
+    def _enqueue(self, index: str, uid: int, document: dict | None) -> None:
+        with self._lock:
+            if self._closed:
+                raise RuntimeError('The indexing queue has been closed!')
+            self._ensureWorker()
+
+            # partial documents of the same pending addition are merged
+            previous = self._pending.get((index, uid))
+            self._pending[(index, uid)] = {**previous, **document} \
+                if document is not None and previous is not None else document
+            if self._firstPending is None:
+                self._firstPending = time.monotonic()
+
+            # wake up the worker if the size threshold is reached
+            if len(self._pending) >= self._maxSize:
+                self._wakeUp.notify()
+
+    def _ensureWorker(self) -> None:
+        # (re)start the worker lazily ; threads do not survive a fork, so each process gets its own worker
+        if self._worker is not None and self._worker.is_alive() and self._pid == os.getpid():
+            return
+        self._pid = os.getpid()
+        self._worker = threading.Thread(target=self._run, name='ErtieIndexingQueue', daemon=True)
+        self._worker.start()
+
+    def _run(self) -> None:
+        while True:
+            with self._lock:
+                # wait until the size or time threshold is reached and the engine is available, or the queue is closed
+                while not self._closed and (not self._isDue() or self._isPaused()):
+                    timeout = None if self._firstPending is None \
+                        else self._interval if self._isPaused() \
+                        else max(0.0, self._firstPending + self._interval - time.monotonic())
+                    self._wakeUp.wait(timeout)
+                if self._closed:
+                    return
+
+            try:
+                self.flush()
+            except Exception as e:
+                logging.getLogger('ErtieLogger').error(f'Unable to flush the indexing queue: {e}')
+
+    def _isPaused(self) -> bool:
+        return self._breaker is not None and self._breaker.isOpen
+
+    def _isDue(self) -> bool:
+        if self._firstPending is None:
+            return False
+        return len(self._pending) >= self._maxSize or time.monotonic() - self._firstPending >= self._interval
+
+    def _send(self, batch: dict[tuple[str, int], dict | None]) -> list[int]:
+        # group the operations by index and by type
+        additions: dict[str, list[dict]] = {}
+        removals: dict[str, list[int]] = {}
+        for (index, uid), document in batch.items():
+            if document is None:
+                removals.setdefault(index, []).append(uid)
+            else:
+                additions.setdefault(index, []).append(document)
+
+        try:
+            taskIds = []
+            for index, documents in additions.items():
+                taskIds += self._sent(index, self._call(self._engine.addDocumentsToIndex, index, documents))
+            for index, ids in removals.items():
+                taskIds += self._sent(index, self._call(self._engine.removeDocumentsFromIndex, index, ids))
+            return taskIds
+        except Exception as e:
+            # put the operations back ; newer operations win, but newer partial documents are merged into the failed
+            # addition, such that its other fields are not lost
+            with self._lock:
+                for key, document in batch.items():
+                    if key not in self._pending:
+                        self._pending[key] = document
+                    elif document is not None and self._pending[key] is not None:
+                        self._pending[key] = {**document, **self._pending[key]}
+                if self._pending and self._firstPending is None:
+                    self._firstPending = time.monotonic()
+            raise RuntimeError('Unable to send the pending operations to the search engine!') from e
+
+    def _call(self, function: Callable, *args) -> list[int]:
+        # the failures count towards the circuit breaker ; while it is open, the queue is only flushed explicitly, i.e.
+        # by the recovery hook before the circuit closes, thus the engine is called directly
+        if self._breaker is None or self._breaker.isOpen:
+            return function(*args)
+        return self._breaker.call(function, *args)
+
+    def _sent(self, index: str, taskIds: list[int]) -> list[int]:
+        if self._onSent is not None:
+            self._onSent(index, taskIds)
+        return taskIds
@@ -8,22 +8,68 @@ SPDX-License-Identifier: AGPL-3.0-or-later
 ########################################################################################################################
 # INCLUDES #############################################################################################################
 ########################################################################################################################
+import functools
+import re
+import threading
+import time
 import meilisearch
+import meilisearch.errors
 from app.factory.conf import Config
+from app.factory.classes.fullTextSearch.documentSerializer import DocumentSerializer
+from app.factory.classes.fullTextSearch.meiliSearch.taskMonitor import TaskMonitor
+from app.factory.classes.fullTextSearch.meiliSearch.transport import PooledHttpRequests
 
-from typing import TYPE_CHECKING
+from typing import TYPE_CHECKING, Any, Callable, Iterable, Iterator
 if TYPE_CHECKING:
     from app.factory.extensions import db
 
+########################################################################################################################
+# CONSTANTS ############################################################################################################
+########################################################################################################################
+_defaultSettings = {'searchableAttributes': ['*'], 'filterableAttributes': [], 'sortableAttributes': [],
+                    'displayedAttributes': ['*']}
+_reindexingSettings = ('searchableAttributes', 'filterableAttributes', 'sortableAttributes')
+_attributeName = re.compile(r'^[A-Za-z_][A-Za-z0-9_]*(\.[A-Za-z_][A-Za-z0-9_]*)*$')  # i.e. teamId, team.name
+
+########################################################################################################################
+# REBUILD ##############################################################################################################
+########################################################################################################################
+class _Rebuild:
+    """An index being rebuilt: its shadow index and the writes to replay on it, None once they were replayed."""
+    __slots__ = ('shadow', 'writes')
+
+    def __init__(self, shadow: str) -> None:
+        self.shadow = shadow
+        self.writes: list[Callable[[str], Any]] | None = []
+
 ########################################################################################################################
 # CLASS ################################################################################################################
 ########################################################################################################################
 class MeiliSearch:
+    _serializer = DocumentSerializer()
+
     def __init__(self) -> None:
         self._index = Config.FULLTEXT_SEARCH_INDEX
         self._url = Config.FULLTEXT_SEARCH_URL
         self._apiKey = Config.FULLTEXT_SEARCH_API_KEY
-        self._client = meilisearch.Client(url=self._url, api_key=self._apiKey)
+        self._client = meilisearch.Client(url=self._url, api_key=self._apiKey,
+                                          timeout=(Config.FULLTEXT_SEARCH_CONNECT_TIMEOUT,
+                                                   Config.FULLTEXT_SEARCH_READ_TIMEOUT))
+
+        # route all calls through one pooled transport
+        self._http = PooledHttpRequests(self._client.config)
+        self._client.http = self._http
+        self._client.task_handler.http = self._http
+        self._batchSize = Config.FULLTEXT_SEARCH_BATCH_SIZE
+        self._batchBytes = Config.FULLTEXT_SEARCH_BATCH_BYTES
+
+        # the uid of the last task enqueued by each thread is its consistency token
+        self._tasks = TaskMonitor(self._client)
+        self._local = threading.local()
+
+        # the indices being rebuilt by reindex
+        self._rebuilds: dict[str, _Rebuild] = {}
+        self._rebuildLock = threading.Lock()
 
     ####################################################################################################################
     # GETTERS ##########################################################################################################
@@ -36,55 +82,371 @@ class MeiliSearch:
     def url(self) -> str:
         return self._url
 
+    @property
+    def transportMetrics(self) -> dict[str, float]:
+        return self._http.metrics
+
+    @property
+    def consistencyToken(self) -> int | None:
+        # the uid of the last task enqueued by the calling thread ; None if it did not write to the index
+        return getattr(self._local, 'lastTask', None)
+
     ####################################################################################################################
     # PUBLIC METHODS €##################################################################################################
     ####################################################################################################################
-    def addToIndex(self, index: str, model: 'db.Model') -> None:
+    def addToIndex(self, index: str, model: 'db.Model', fields: list[str] | None = None) -> None:
         index = self._indexHelper(index)
 
-        # create the document to add ; existing documents with the same ID will be updated
-        document = {'id': model.uid}
-        for field in model.__searchable__:
-            # for each field that should be searchable, create an entry
-            document[field] = getattr(model, field)
+        # create the document to add ; existing documents with the same ID will be updated, such that a partial
+        # document only changes the given fields
+        document = self.createDocument(model, fields)
 
         # now add the document to the index
-        self._client.index(index).update_documents([document])
+        self._track([self._write(index, lambda target: self._getIndex(target).update_documents([document]))])
+
+    def addManyToIndex(self, index: str, models: Iterable['db.Model']) -> list[int]:
+        return self.addDocumentsToIndex(index, (self.createDocument(model) for model in models))
+
+    def addDocumentsToIndex(self, index: str, documents: Iterable[dict]) -> list[int]:
+        index = self._indexHelper(index)
+
+        # stream the documents to the index in chunks bounded by count and size ; one task per chunk
+        taskIds = []
+        for chunk in self._chunkDocuments(documents):
+            taskIds.append(self._write(index, functools.partial(self._updateDocuments, chunk=chunk)))
+
+        # return the task ids, such that the caller can wait for them
+        return self._track(taskIds)
 
     def removeFromIndex(self, index: str, model: 'db.Model') -> None:
         index = self._indexHelper(index)
 
         # delete document with ID = model.uid
-        self._client.index(index).delete_document(model.uid)
+        self._track([self._write(index, lambda target: self._getIndex(target).delete_document(model.uid))])
+
+    def removeManyFromIndex(self, index: str, models: Iterable['db.Model']) -> list[int]:
+        return self.removeDocumentsFromIndex(index, (model.uid for model in models))
 
-    def queryIndex(self, index: str, query: str, resync:bool=False) -> tuple[list[int], int]:
+    def removeDocumentsFromIndex(self, index: str, ids: Iterable[int]) -> list[int]:
         index = self._indexHelper(index)
+
+        # delete the documents in batches of at most batchSize ids
+        taskIds = []
+        chunk = []
+        for uid in ids:
+            chunk.append(uid)
+            if len(chunk) >= self._batchSize:
+                taskIds.append(self._write(index, functools.partial(self._deleteDocuments, ids=chunk)))
+                chunk = []
+        if chunk:
+            taskIds.append(self._write(index, functools.partial(self._deleteDocuments, ids=chunk)))
+
+        # return the task ids, such that the caller can wait for them
+        return self._track(taskIds)
+
+    def deleteIndex(self, index: str) -> None:
+        # delete the index with all of its documents and settings ; missing indices are ignored
+        self._waitForTasks([self._client.delete_index(self._indexHelper(index)).task_uid], ignoreFailures=True)
+
+    @classmethod
+    def createDocument(cls, model: 'db.Model', fields: list[str] | None = None) -> dict:
+        # the document id is the uid of the model ; each searchable field, or each of the given fields, gets an entry
+        return cls._serializer.serialize(model, fields)
+
+    def queryIndex(self, index: str, query: str, resync:bool=False, page: int | None = None,
+                   hitsPerPage: int | None = None, limit: int | None = None, offset: int | None = None,
+                   attributesToRetrieve: list[str] | None = None, exactTotal: bool = False,
+                   filter: str | list | dict | None = None, sort: list[str] | None = None,
+                   facets: list[str] | None = None) -> tuple:
+        index = self._indexHelper(index)
+        parameters = self._searchParameters(resync=resync, page=page, hitsPerPage=hitsPerPage, limit=limit,
+                                            offset=offset, attributesToRetrieve=attributesToRetrieve,
+                                            exactTotal=exactTotal, filter=filter, sort=sort, facets=facets)
         try:
-            search = self._client.index(index).search(query)
+            search = self._getIndex(index).search(query, parameters)
         except Exception as e:
             raise RuntimeError(e)
 
-        # get estimated hits
-        estimatedTotalHits = search.get('estimatedTotalHits')
+        return self._parseSearch(search, resync, facets is not None)
 
-        # parse the output
-        ids = [int(hit['id']) for hit in search['hits']] if estimatedTotalHits != 0 else []
+    def waitForTasks(self, token: int | None, timeout: float) -> bool:
+        # wait until the writes up to the consistency token are searchable ; returns False on timeout
+        if token is None:
+            return True
+        return self._tasks.wait([token], timeout)
 
-        # return the result
-        if resync is False:
-            # searching -> return the ids to query from the oracle DB
-            return ids, estimatedTotalHits
-        else:
-            # resyncing -> return the actual hits
-            return search['hits'], estimatedTotalHits
+    def useCircuitBreaker(self, breaker) -> None:
+        # the background polls of the tasks go through the circuit breaker of the facade
+        self._tasks.useCircuitBreaker(breaker)
+
+    def onTasksFinished(self, taskIds: list[int], callback: Callable[[], None]) -> None:
+        # call back once the given tasks are processed, i.e. to drop the cached results of an index
+        self._tasks.onFinished(taskIds, callback)
+
+    def multiQuery(self, queries: list[tuple[str, str, dict | None]]) -> list[tuple[list, int]]:
+        # search several indices in one round trip ; the results are returned in the order of the queries
+        body = []
+        for index, query, options in queries:
+            parameters = self._searchParameters(**(options or {}))
+            body.append({'indexUid': self._indexHelper(index), 'q': query, **parameters})
+        try:
+            search = self._client.multi_search(body)
+        except Exception as e:
+            raise RuntimeError(e)
+
+        return [self._parseSearch(result, (options or {}).get('resync', False),
+                                  (options or {}).get('facets') is not None)
+                for result, (index, query, options) in zip(search['results'], queries)]
+
+    # SETTINGS #########################################################################################################
+    @staticmethod
+    def declaredSettings(modelClass: type) -> dict[str, list[str]]:
+        # the settings declared next to __searchable__ ; undeclared settings fall back to the Meilisearch defaults
+        return {'searchableAttributes': list(modelClass.__searchable__),
+                'filterableAttributes': list(getattr(modelClass, '__filterable__', [])),
+                'sortableAttributes': list(getattr(modelClass, '__sortable__', [])),
+                'displayedAttributes': list(getattr(modelClass, '__displayed__', ['*']))}
+
+    def diffSettings(self, index: str, declared: dict[str, list[str]]) -> dict[str, tuple[list[str], list[str]]]:
+        # returns the settings which differ from the live index as {setting: (live, declared)}
+        try:
+            live = self._getIndex(self._indexHelper(index)).get_settings()
+        except meilisearch.errors.MeilisearchApiError as e:
+            if e.status_code != 404:
+                raise RuntimeError(e)
+            live = _defaultSettings
+        except Exception as e:
+            raise RuntimeError(e)
+
+        changes = {}
+        for setting, value in declared.items():
+            current = live.get(setting, _defaultSettings[setting])
+            # the order of the searchable attributes defines their ranking, the other settings are sets
+            same = current == value if setting == 'searchableAttributes' else set(current) == set(value)
+            if not same:
+                changes[setting] = (current, value)
+        return changes
+
+    def applySettings(self, index: str, changes: dict[str, tuple[list[str], list[str]]]) -> list[int]:
+        # only send the settings that changed ; Meilisearch creates the index if need be
+        if not changes:
+            return []
+        body = {setting: declared for setting, (live, declared) in changes.items()}
+        return [self._getIndex(self._indexHelper(index)).update_settings(body).task_uid]
+
+    @staticmethod
+    def requiresReindex(changes: dict) -> list[str]:
+        # the settings which make Meilisearch re-process every document of the index
+        return [setting for setting in changes if setting in _reindexingSettings]
+
+    # HEALTH ###########################################################################################################
+    def isHealthy(self) -> bool:
+        return self._client.is_healthy()
+
+    @staticmethod
+    def isTransientError(exception: Exception) -> bool:
+        # walk the exception chain: connection errors, timeouts and server errors mean that Meilisearch is unavailable
+        while exception is not None:
+            if isinstance(exception, (meilisearch.errors.MeilisearchCommunicationError,
+                                      meilisearch.errors.MeilisearchTimeoutError)):
+                return True
+            if isinstance(exception, meilisearch.errors.MeilisearchApiError) and exception.status_code >= 500:
+                return True
+            exception = exception.__cause__ or exception.__context__
+        return False
+
+    # REINDEX ##########################################################################################################
+    def reindex(self, index: str, documents: Iterable[dict],
+                progress: Callable[[int, float], None] | None = None) -> int:
+        # the documents are bulk-loaded into a shadow index which is then swapped with the live index ; the writes
+        # of this process to the live index are recorded meanwhile and replayed on the shadow index before the swap
+        live = self._indexHelper(index)
+        shadow = self._indexHelper(f'{index}_reindex')
+
+        # start from an empty shadow index with the settings of the live index ; the live index might not exist yet
+        self._waitForTasks([self._client.delete_index(shadow).task_uid], ignoreFailures=True)
+        self._waitForTasks([self._client.create_index(live, {'primaryKey': 'id'}).task_uid], ignoreFailures=True)
+        self._waitForTasks([self._client.create_index(shadow, {'primaryKey': 'id'}).task_uid])
+        settings = self._getIndex(live).get_settings()
+        self._waitForTasks([self._getIndex(shadow).update_settings(settings).task_uid])
+
+        with self._rebuildLock:
+            self._rebuilds[live] = _Rebuild(shadow)
+        try:
+            # stream the documents into the shadow index and report the progress after each chunk
+            count, taskIds, started = 0, [], time.monotonic()
+            for chunk in self._chunkDocuments(documents):
+                taskIds.append(self._updateDocuments(shadow, chunk).task_uid)
+                count += len(chunk)
+                if progress is not None:
+                    progress(count, time.monotonic() - started)
+
+            # the recorded writes are newer than the rows read from the database, thus they are replayed after the
+            # bulk load ; from then on, the writes are sent to both indices
+            with self._rebuildLock:
+                rebuild = self._rebuilds[live]
+                taskIds += [write(shadow).task_uid for write in rebuild.writes]
+                rebuild.writes = None
+            self._waitForTasks(taskIds)
+
+            # atomically swap the indices
+            self._waitForTasks([self._client.swap_indexes([{'indexes': [live, shadow]}]).task_uid])
+        finally:
+            with self._rebuildLock:
+                self._rebuilds.pop(live, None)
+
+        # drop the old documents
+        self._client.delete_index(shadow)
+        return count
 
     ####################################################################################################################
     # PRIVATE METHODS ##################################################################################################
     ####################################################################################################################
+    def _getIndex(self, index: str) -> meilisearch.index.Index:
+        # the client creates a new index object with its own transport on each call, thus share the pooled one
+        index = self._client.index(index)
+        index.http = self._http
+        return index
+
+    def _write(self, index: str, write: Callable[[str], Any]) -> int:
+        # send a write to an index and, while the index is rebuilt, record it for its shadow index or send it there too
+        taskId = write(index).task_uid
+        with self._rebuildLock:
+            rebuild = self._rebuilds.get(index)
+            if rebuild is not None and rebuild.writes is not None:
+                rebuild.writes.append(write)
+                return taskId
+        if rebuild is not None:
+            write(rebuild.shadow)
+        return taskId
+
+    def _track(self, taskIds: list[int]) -> list[int]:
+        # tasks are processed in order, thus waiting for the last one covers all writes of the thread
+        if taskIds:
+            self._local.lastTask = max(taskIds)
+        return taskIds
+
     def _indexHelper(self, index: str) -> str:
         # helper function to select index based on prod / dev / test ; converts indices to lower case
         pre = self._index if self._index is not None else None
 
         # convert index to lowercase
         index = (pre + index).lower() if pre is not None else index.lower()
-        return index
\ No newline at end of file
+        return index
+
+    @staticmethod
+    def _parseSearch(search: dict, resync: bool, facets: bool = False) -> tuple:
+        # get the total hits ; exhaustive when paginating by page, estimated otherwise
+        estimatedTotalHits = search.get('totalHits', search.get('estimatedTotalHits'))
+
+        # parse the output
+        ids = [int(hit['id']) for hit in search['hits']] if estimatedTotalHits != 0 else []
+
+        # return the result ; the facet distribution is appended if facets were requested
+        facetDistribution = (search.get('facetDistribution', {}),) if facets is True else ()
+        if resync is False:
+            # searching -> return the ids to query from the oracle DB
+            return ids, estimatedTotalHits, *facetDistribution
+        else:
+            # resyncing -> return the actual hits
+            return search['hits'], estimatedTotalHits, *facetDistribution
+
+    @staticmethod
+    def _searchParameters(resync: bool = False, page: int | None = None, hitsPerPage: int | None = None,
+                          limit: int | None = None, offset: int | None = None,
+                          attributesToRetrieve: list[str] | None = None, exactTotal: bool = False,
+                          filter: str | list | dict | None = None, sort: list[str] | None = None,
+                          facets: list[str] | None = None) -> dict:
+        parameters = {}
+
+        # only retrieve the ids when searching, as the models are loaded from the database anyway ; the primary key is
+        # always retrieved, as the hits are mapped to their ids
+        if attributesToRetrieve is not None:
+            parameters['attributesToRetrieve'] = attributesToRetrieve if 'id' in attributesToRetrieve \
+                or '*' in attributesToRetrieve else ['id', *attributesToRetrieve]
+        elif resync is False:
+            parameters['attributesToRetrieve'] = ['id']
+
+        # paginating by page returns exhaustive totals ; limit and offset only return estimates
+        if page is not None or exactTotal is True:
+            hitsPerPage = hitsPerPage if hitsPerPage is not None else limit if limit is not None \
+                else Config.RESULTS_PER_PAGE
+            parameters['page'] = page if page is not None else _offsetPage(offset, hitsPerPage)
+            parameters['hitsPerPage'] = hitsPerPage
+        else:
+            if limit is not None:
+                parameters['limit'] = limit
+            if offset is not None:
+                parameters['offset'] = offset
+
+        # narrow, order and count the hits in the engine rather than in Python
+        if filter is not None:
+            parameters['filter'] = MeiliSearch._filterExpression(filter) if isinstance(filter, dict) else filter
+        if sort is not None:
+            parameters['sort'] = sort
+        if facets is not None:
+            parameters['facets'] = facets
+
+        return parameters
+
+    @staticmethod
+    def _filterExpression(filter: dict) -> str:
+        # {'teamId': 3, 'season': [2023, 2024], 'leftAt': None} -> teamId = 3 AND season IN [2023, 2024] AND ...
+        def value(v) -> str:
+            if isinstance(v, bool):
+                return 'true' if v else 'false'
+            if isinstance(v, (int, float)):
+                return str(v)
+            # only backslashes and double quotes are escaped, other characters are sent as they are
+            return '"' + str(v).replace('\\', '\\\\').replace('"', '\\"') + '"'
+
+        conditions = []
+        for field, v in filter.items():
+            if not isinstance(field, str) or _attributeName.match(field) is None:
+                raise RuntimeError(f'Invalid filter attribute: {field!r}')
+            if v is None:
+                conditions.append(f'{field} IS NULL')
+            elif isinstance(v, (list, tuple, set)):
+                conditions.append(f'{field} IN [{", ".join(value(item) for item in v)}]')
+            else:
+                conditions.append(f'{field} = {value(v)}')
+        return ' AND '.join(conditions)
+
+    def _waitForTasks(self, taskIds: list[int], ignoreFailures: bool = False) -> None:
+        # wait for the tasks to be processed ; raise if one of them failed
+        for taskId in taskIds:
+            task = self._client.wait_for_task(taskId, timeout_in_ms=Config.FULLTEXT_SEARCH_TASK_TIMEOUT * 1000)
+            if task.status != 'succeeded' and ignoreFailures is False:
+                raise RuntimeError(f'Meilisearch task {taskId} failed: {task.error}')
+
+    def _chunkDocuments(self, documents: Iterable[dict]) -> Iterator[list[bytes]]:
+        # encode each document once and group them into chunks of at most batchSize documents and batchBytes bytes
+        chunk, chunkBytes = [], 0
+        for document in documents:
+            encoded = self._serializer.encode(document)
+            if chunk and (len(chunk) >= self._batchSize or chunkBytes + len(encoded) + 1 > self._batchBytes):
+                yield chunk
+                chunk, chunkBytes = [], 0
+            chunk.append(encoded)
+            chunkBytes += len(encoded) + 1
+        if chunk:
+            yield chunk
+
+    def _updateDocuments(self, index: str, chunk: list[bytes]):
+        # the chunk is sent as is, such that the client does not encode the documents a second time
+        return self._getIndex(index).update_documents_raw(self._serializer.encodeBatch(chunk),
+                                                          content_type='application/json')
+
+    def _deleteDocuments(self, index: str, ids: list[int]):
+        return self._getIndex(index).delete_documents(ids)
+
+########################################################################################################################
+# HELPERS ##############################################################################################################
+########################################################################################################################
+def _offsetPage(offset: int | None, hitsPerPage: int) -> int:
+    # exact totals are only returned by page, thus the offset must start a page
+    if not offset:
+        return 1
+    if offset % hitsPerPage != 0:
+        raise ValueError(f'The offset {offset} is not a multiple of {hitsPerPage}!')
+    return offset // hitsPerPage + 1
@@ -0,0 +1,171 @@
+"""
+Background monitor of the asynchronous Meilisearch tasks.
+
+SPDX-FileCopyrightText: © 2024 Gilles Bellot <gilles.bellot@bell0bytes.eu>
+SPDX-License-Identifier: AGPL-3.0-or-later
+"""
+
+########################################################################################################################
+# INCLUDES #############################################################################################################
+########################################################################################################################
+import collections
+import itertools
+import logging
+import os
+import threading
+import time
+from app.factory.conf import Config
+from app.factory.classes.fullTextSearch.circuitBreaker import CircuitOpenError
+
+from typing import Callable, Iterable
+
+########################################################################################################################
+# CONSTANTS ############################################################################################################
+########################################################################################################################
+_finishedStatuses = ('succeeded', 'failed', 'canceled')
+_pollBatchSize = 100                                                # task uids per request, keeps the URL short
+_maxBackoff = 5.0                                                   # seconds between polls while polling fails
+
+########################################################################################################################
+# CLASS ################################################################################################################
+########################################################################################################################
+class TaskMonitor:
+    """
+    Polls the status of the tasks that readers are waiting for, or that callbacks are registered for, in batches from
+    a background thread, such that writes never block. Meilisearch processes the tasks in the order they were
+    enqueued, thus once a task is finished, all tasks with a lower uid are finished as well and need not be polled
+    again. Failed polls are retried with an exponential backoff ; while the circuit breaker is open, the tasks are not
+    polled at all.
+    """
+    def __init__(self, client, breaker=None) -> None:
+        self._client = client
+        self._breaker = breaker
+        self._interval = Config.FULLTEXT_SEARCH_TASK_POLL_INTERVAL
+
+        self._pending: set[int] = set()                     # the tasks to poll
+        self._waiters: collections.Counter[int] = collections.Counter()
+        self._callbacks: dict[int, list[Callable[[], None]]] = {}
+        self._finished = -1                                 # the highest uid known to be finished
+        self._lock = threading.Lock()
+        self._changed = threading.Condition(self._lock)
+        self._worker = None
+        self._pid = None
+
+    ####################################################################################################################
+    # GETTERS ##########################################################################################################
+    ####################################################################################################################
+    @property
+    def pending(self) -> int:
+        return len(self._pending)
+
+    @property
+    def finished(self) -> int:
+        return self._finished
+
+    ####################################################################################################################
+    # PUBLIC METHODS €##################################################################################################
+    ####################################################################################################################
+    def wait(self, taskIds: Iterable[int], timeout: float) -> bool:
+        # wait until the given tasks are processed ; returns False if the timeout expired first
+        deadline = time.monotonic() + timeout
+        with self._lock:
+            taskIds = {taskId for taskId in taskIds if taskId > self._finished}
+            if not taskIds:
+                return True
+            self._pending.update(taskIds)
+            self._waiters.update(taskIds)
+            self._ensureWorker()
+            self._changed.notify_all()
+
+            try:
+                while self._pending & taskIds:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        return False
+                    self._changed.wait(remaining)
+                return True
+            finally:
+                # stop polling the tasks nobody waits for anymore
+                self._waiters.subtract(taskIds)
+                for taskId in taskIds:
+                    if self._waiters[taskId] <= 0:
+                        del self._waiters[taskId]
+                        if taskId not in self._callbacks:
+                            self._pending.discard(taskId)
+
+    def useCircuitBreaker(self, breaker) -> None:
+        # the polls count towards the circuit breaker of the search engine
+        self._breaker = breaker
+
+    def onFinished(self, taskIds: Iterable[int], callback: Callable[[], None]) -> None:
+        # call back from the worker once the given tasks are processed, successfully or not
+        taskId = max(taskIds)
+        with self._lock:
+            if taskId > self._finished:
+                self._callbacks.setdefault(taskId, []).append(callback)
+                self._pending.add(taskId)
+                self._ensureWorker()
+                self._changed.notify_all()
+                return
+        callback()
+
+    ####################################################################################################################
+    # PRIVATE METHODS ##################################################################################################
+    ####################################################################################################################
+    def _ensureWorker(self) -> None:
+        # (re)start the worker lazily ; threads do not survive a fork, so each process gets its own worker
+        if self._worker is not None and self._worker.is_alive() and self._pid == os.getpid():
+            return
+        self._pid = os.getpid()
+        self._worker = threading.Thread(target=self._run, name='ErtieTaskMonitor', daemon=True)
+        self._worker.start()
+
+    def _run(self) -> None:
+        failures = 0
+        while True:
+            with self._lock:
+                while not self._pending:
+                    self._changed.wait()
+                taskIds = sorted(self._pending)[:_pollBatchSize]
+
+            try:
+                finished, unknown = self._poll(taskIds) if self._breaker is None \
+                    else self._breaker.call(self._poll, taskIds)
+                failures = 0
+            except CircuitOpenError:
+                # the circuit breaker probes the engine meanwhile
+                finished, unknown = set(), set()
+                failures += 1
+            except Exception as e:
+                logging.getLogger('ErtieLogger').error(f'Unable to poll the search engine tasks: {e}')
+                finished, unknown = set(), set()
+                failures += 1
+
+            with self._lock:
+                self._finished = max([self._finished, *finished])
+                self._pending = {taskId for taskId in self._pending - unknown if taskId > self._finished}
+                callbacks = [self._callbacks.pop(taskId) for taskId in list(self._callbacks)
+                             if taskId <= self._finished or taskId in unknown]
+
+            # the callbacks run before the waiters are woken up
+            for callback in itertools.chain.from_iterable(callbacks):
+                try:
+                    callback()
+                except Exception as e:
+                    logging.getLogger('ErtieLogger').error(f'Search engine task callback failed: {e}')
+
+            with self._lock:
+                self._changed.notify_all()
+                if not self._pending:
+                    continue
+            time.sleep(self._delay(failures))
+
+    def _delay(self, failures: int) -> float:
+        # exponential backoff after failed polls, capped at a few seconds
+        return min(self._interval * 2 ** min(failures, 32), max(self._interval, _maxBackoff))
+
+    def _poll(self, taskIds: list[int]) -> tuple[set[int], set[int]]:
+        # one request for the whole batch ; returns the finished and the unknown, i.e. deleted, tasks
+        tasks = self._client.get_tasks({'uids': [str(taskId) for taskId in taskIds], 'limit': len(taskIds)})
+        finished = {task.uid for task in tasks.results if task.status in _finishedStatuses}
+        return finished, set(taskIds) - {task.uid for task in tasks.results}
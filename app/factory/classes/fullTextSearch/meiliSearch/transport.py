@@ -0,0 +1,117 @@
+"""
+Pooled, timed-out and retrying HTTP transport for the Meilisearch client.
+
+SPDX-FileCopyrightText: © 2024 Gilles Bellot <gilles.bellot@bell0bytes.eu>
+SPDX-License-Identifier: AGPL-3.0-or-later
+"""
+
+########################################################################################################################
+# INCLUDES #############################################################################################################
+########################################################################################################################
+import os
+import random
+import threading
+import time
+from typing import Any, Callable
+
+import requests
+import requests.adapters
+from meilisearch._httprequests import HttpRequests
+from meilisearch.config import Config as MeilisearchConfig
+from meilisearch.errors import MeilisearchApiError, MeilisearchCommunicationError, MeilisearchTimeoutError
+from app.factory.conf import Config
+
+########################################################################################################################
+# CONSTANTS ############################################################################################################
+########################################################################################################################
+_idempotentMethods = ('get', 'put', 'delete')                       # document updates and deletions are idempotent
+_idempotentPaths = ('/search', 'multi-search')                      # searches are sent as POST requests
+_retryStatusCodes = (502, 503, 504)
+
+########################################################################################################################
+# CLASS ################################################################################################################
+########################################################################################################################
+class PooledHttpRequests(HttpRequests):
+    """
+    Replaces the per-call connections of the Meilisearch client with a pooled session. Idempotent calls are retried
+    with jittered exponential backoff. The session is recreated after a fork, such that workers never share sockets.
+    """
+    def __init__(self, config: MeilisearchConfig) -> None:
+        super().__init__(config)
+        self._poolSize = Config.FULLTEXT_SEARCH_POOL_SIZE
+        self._keepAlive = Config.FULLTEXT_SEARCH_KEEP_ALIVE
+        self._retries = Config.FULLTEXT_SEARCH_RETRIES
+        self._backoff = Config.FULLTEXT_SEARCH_RETRY_BACKOFF
+        self._session = None
+        self._pid = None
+        self._lock = threading.Lock()
+        self._metrics = {'calls': 0, 'errors': 0, 'retries': 0, 'totalTime': 0.0, 'maxTime': 0.0}
+
+    ####################################################################################################################
+    # GETTERS ##########################################################################################################
+    ####################################################################################################################
+    @property
+    def metrics(self) -> dict[str, float]:
+        with self._lock:
+            return dict(self._metrics)
+
+    @property
+    def session(self) -> requests.Session:
+        # each process gets its own session and thus its own connection pool
+        if self._session is None or self._pid != os.getpid():
+            self._pid = os.getpid()
+            self._session = _createSession(self._poolSize, self._keepAlive)
+        return self._session
+
+    ####################################################################################################################
+    # PUBLIC METHODS €##################################################################################################
+    ####################################################################################################################
+    def send_request(self, http_method: Callable, path: str, body: Any = None, content_type: str | None = None,
+                     *, serializer=None) -> Any:
+        # route the call through the pooled session ; the session methods keep the names of the requests functions
+        method = getattr(self.session, http_method.__name__)
+        attempts = self._retries + 1 if _isIdempotent(method.__name__, path) else 1
+
+        for attempt in range(attempts):
+            started = time.perf_counter()
+            try:
+                return super().send_request(method, path, body, content_type, serializer=serializer)
+            except (MeilisearchTimeoutError, MeilisearchCommunicationError, MeilisearchApiError) as e:
+                self._record('errors', 1)
+                retryable = not isinstance(e, MeilisearchApiError) or e.status_code in _retryStatusCodes
+                if not retryable or attempt + 1 >= attempts:
+                    raise
+            finally:
+                self._recordLatency(time.perf_counter() - started)
+
+            # back off exponentially with jitter before the next attempt
+            self._record('retries', 1)
+            time.sleep(self._backoff * (2 ** attempt) * random.uniform(0.5, 1.5))
+
+    ####################################################################################################################
+    # PRIVATE METHODS ##################################################################################################
+    ####################################################################################################################
+    def _record(self, metric: str, value: int) -> None:
+        with self._lock:
+            self._metrics[metric] += value
+
+    def _recordLatency(self, elapsed: float) -> None:
+        with self._lock:
+            self._metrics['calls'] += 1
+            self._metrics['totalTime'] += elapsed
+            self._metrics['maxTime'] = max(self._metrics['maxTime'], elapsed)
+
+########################################################################################################################
+# HELPERS ##############################################################################################################
+########################################################################################################################
+def _createSession(poolSize: int, keepAlive: bool) -> requests.Session:
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=poolSize)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    if keepAlive is False:
+        session.headers['Connection'] = 'close'
+    return session
+
+def _isIdempotent(method: str, path: str) -> bool:
+    return method in _idempotentMethods or path.endswith(_idempotentPaths)
@@ -0,0 +1,199 @@
+"""
+Result cache for full-text search queries.
+
+SPDX-FileCopyrightText: © 2024 Gilles Bellot <gilles.bellot@bell0bytes.eu>
+SPDX-License-Identifier: AGPL-3.0-or-later
+"""
+
+########################################################################################################################
+# IMPORTS ##############################################################################################################
+########################################################################################################################
+import abc
+import collections
+import json
+import os
+import pathlib
+import sqlite3
+import threading
+import time
+
+from typing import Any
+
+########################################################################################################################
+# CLASSES ##############################################################################################################
+########################################################################################################################
+class QueryCache(abc.ABC):
+    """
+    Bounded TTL/LRU cache for query results. Entries are grouped by index, such that a write to an index invalidates
+    all of its cached queries. The hit and miss counters are kept per process.
+    """
+    def __init__(self, maxSize: int, ttl: float) -> None:
+        self._maxSize = maxSize
+        self._ttl = ttl
+        self._hits = 0
+        self._misses = 0
+        self._lock = threading.Lock()
+
+    ####################################################################################################################
+    # GETTERS ##########################################################################################################
+    ####################################################################################################################
+    @property
+    def hits(self) -> int:
+        return self._hits
+
+    @property
+    def misses(self) -> int:
+        return self._misses
+
+    @property
+    def statistics(self) -> dict[str, int]:
+        with self._lock:
+            hits, misses = self._hits, self._misses
+        return {'hits': hits, 'misses': misses, 'size': len(self)}
+
+    ####################################################################################################################
+    # PUBLIC METHODS €##################################################################################################
+    ####################################################################################################################
+    @staticmethod
+    def key(index: str, query: str, **options) -> str:
+        return json.dumps([index, query, options], sort_keys=True, default=str)
+
+    def get(self, index: str, key: str) -> Any | None:
+        value = self._get(index, key)
+        with self._lock:
+            if value is None:
+                self._misses += 1
+            else:
+                self._hits += 1
+        return value
+
+    @abc.abstractmethod
+    def set(self, index: str, key: str, value: Any) -> None:
+        ...
+
+    @abc.abstractmethod
+    def invalidate(self, index: str) -> None:
+        ...
+
+    @abc.abstractmethod
+    def clear(self) -> None:
+        ...
+
+    @abc.abstractmethod
+    def __len__(self) -> int:
+        ...
+
+    ####################################################################################################################
+    # PRIVATE METHODS ##################################################################################################
+    ####################################################################################################################
+    @abc.abstractmethod
+    def _get(self, index: str, key: str) -> Any | None:
+        ...
+
+
+class MemoryQueryCache(QueryCache):
+    """
+    In-process cache backed by an ordered dictionary.
+    """
+    def __init__(self, maxSize: int, ttl: float) -> None:
+        super().__init__(maxSize, ttl)
+        self._entries: collections.OrderedDict[str, tuple[str, float, Any]] = collections.OrderedDict()
+
+    def set(self, index: str, key: str, value: Any) -> None:
+        with self._lock:
+            self._entries[key] = (index, time.monotonic() + self._ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self._maxSize:
+                # evict the least recently used entry
+                self._entries.popitem(last=False)
+
+    def invalidate(self, index: str) -> None:
+        with self._lock:
+            for key in [key for key, entry in self._entries.items() if entry[0] == index]:
+                del self._entries[key]
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def _get(self, index: str, key: str) -> Any | None:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            if entry[1] < time.monotonic():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return entry[2]
+
+
+class SQLiteQueryCache(QueryCache):
+    """
+    Cache shared by all workers on a host, backed by a local SQLite file. Values must be JSON serializable ; tuples
+    are returned as tuples.
+    """
+    def __init__(self, maxSize: int, ttl: float, path: str | pathlib.Path) -> None:
+        super().__init__(maxSize, ttl)
+        self._path = pathlib.Path(path)
+        self._path.parent.mkdir(parents=True, exist_ok=True)
+        self._connection = None
+        self._pid = None
+
+    def set(self, index: str, key: str, value: Any) -> None:
+        now = time.time()
+        payload = json.dumps({'tuple': isinstance(value, tuple), 'value': value}, default=str)
+        with self._lock:
+            connection = self._connect()
+            with connection:
+                connection.execute('INSERT OR REPLACE INTO searchCache (key, idx, value, expires, used) '
+                                   'VALUES (?, ?, ?, ?, ?)', (key, index, payload, now + self._ttl, now))
+
+                # evict expired entries, then the least recently used ones
+                connection.execute('DELETE FROM searchCache WHERE expires < ?', (now,))
+                connection.execute('DELETE FROM searchCache WHERE key IN (SELECT key FROM searchCache '
+                                   'ORDER BY used DESC LIMIT -1 OFFSET ?)', (self._maxSize,))
+
+    def invalidate(self, index: str) -> None:
+        with self._lock:
+            connection = self._connect()
+            with connection:
+                connection.execute('DELETE FROM searchCache WHERE idx = ?', (index,))
+
+    def clear(self) -> None:
+        with self._lock:
+            connection = self._connect()
+            with connection:
+                connection.execute('DELETE FROM searchCache')
+
+    def __len__(self) -> int:
+        with self._lock:
+            return self._connect().execute('SELECT COUNT(*) FROM searchCache').fetchone()[0]
+
+    def _get(self, index: str, key: str) -> Any | None:
+        now = time.time()
+        with self._lock:
+            connection = self._connect()
+            row = connection.execute('SELECT value FROM searchCache WHERE key = ? AND expires >= ?',
+                                     (key, now)).fetchone()
+            if row is None:
+                return None
+            with connection:
+                connection.execute('UPDATE searchCache SET used = ? WHERE key = ?', (now, key))
+
+        payload = json.loads(row[0])
+        return tuple(payload['value']) if payload['tuple'] is True else payload['value']
+
+    def _connect(self) -> sqlite3.Connection:
+        # connections must not be shared across a fork, thus each process opens its own
+        if self._connection is None or self._pid != os.getpid():
+            self._pid = os.getpid()
+            self._connection = sqlite3.connect(self._path, timeout=5.0, check_same_thread=False)
+            self._connection.execute('PRAGMA journal_mode=WAL')
+            self._connection.execute('CREATE TABLE IF NOT EXISTS searchCache (key TEXT PRIMARY KEY, idx TEXT, '
+                                     'value TEXT, expires REAL, used REAL)')
+            self._connection.execute('CREATE INDEX IF NOT EXISTS ix_searchCache_idx ON searchCache (idx)')
+        return self._connection
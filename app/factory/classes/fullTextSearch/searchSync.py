@@ -0,0 +1,144 @@
+"""
+Automatic synchronisation of searchable models with the full-text search engine, driven by SQLAlchemy session events.
+
+SPDX-FileCopyrightText: © 2024 Gilles Bellot <gilles.bellot@bell0bytes.eu>
+SPDX-License-Identifier: AGPL-3.0-or-later
+"""
+
+########################################################################################################################
+# IMPORTS ##############################################################################################################
+########################################################################################################################
+import logging
+import sqlalchemy.event
+from app.factory.classes.database import Database
+
+from typing import TYPE_CHECKING
+if TYPE_CHECKING:
+    from app.factory.classes.fullTextSearch import FullTextSearch
+
+########################################################################################################################
+# CLASS ################################################################################################################
+########################################################################################################################
+class SearchSync:
+    """
+    Registry of searchable models. Once a session is attached, the searchable models which were inserted, updated or
+    deleted in a transaction are pushed to the search engine in one batch per index after the commit succeeded.
+    Nothing is sent for rolled back transactions, nor for the changes of rolled back savepoints.
+    """
+    _infoKey = 'ertieSearchSync'
+    _savepointsKey = 'ertieSearchSyncSavepoints'
+
+    def __init__(self, fullTextSearch: 'FullTextSearch') -> None:
+        self._fullTextSearch = fullTextSearch
+        self._registry: dict[type, str] = {}
+
+    ####################################################################################################################
+    # GETTERS ##########################################################################################################
+    ####################################################################################################################
+    @property
+    def registry(self) -> dict[type, str]:
+        return self._registry
+
+    ####################################################################################################################
+    # PUBLIC METHODS €##################################################################################################
+    ####################################################################################################################
+    def init(self, session) -> None:
+        # attach the listeners to a session, scoped session or sessionmaker ; attaching twice is a no-op
+        for name, listener in (('after_flush', self._afterFlush),
+                               ('after_commit', self._afterCommit),
+                               ('after_transaction_create', self._afterTransactionCreate),
+                               ('after_transaction_end', self._afterTransactionEnd),
+                               ('after_soft_rollback', self._afterSoftRollback)):
+            if not sqlalchemy.event.contains(session, name, listener):
+                sqlalchemy.event.listen(session, name, listener)
+
+    def register(self, modelClass: type, index: str | None = None) -> type:
+        # opt a model class into automatic synchronisation ; the index defaults to the table name
+        if not hasattr(modelClass, '__searchable__'):
+            raise ValueError(f'{modelClass.__name__} does not declare __searchable__ fields!')
+        self._registry[modelClass] = index if index is not None else modelClass.__tablename__
+        return modelClass
+
+    def searchable(self, index: str | None = None):
+        # class decorator variant of register
+        return lambda modelClass: self.register(modelClass, index)
+
+    ####################################################################################################################
+    # PRIVATE METHODS ##################################################################################################
+    ####################################################################################################################
+    def _indexOf(self, obj) -> str | None:
+        for cls in type(obj).__mro__:
+            if cls in self._registry:
+                return self._registry[cls]
+        return None
+
+    def _afterFlush(self, session, flushContext) -> None:
+        # snapshot the documents now, as the objects are expired once the transaction is committed
+        engine = self._fullTextSearch.searchEngine
+        if engine is None:
+            return
+        pending = session.info.setdefault(self._infoKey, {})
+        for obj in session.new:
+            index = self._indexOf(obj)
+            if index is not None:
+                pending[(index, obj.uid)] = engine.createDocument(obj)
+        for obj in session.dirty:
+            index = self._indexOf(obj)
+            if index is None:
+                continue
+
+            # only send the searchable fields that changed ; skip the object if none did
+            fields = Database.getModifiedAttributes(obj, obj.__searchable__)
+            if fields:
+                previous = pending.get((index, obj.uid))
+                document = engine.createDocument(obj, fields)
+                pending[(index, obj.uid)] = {**previous, **document} if previous is not None else document
+        for obj in session.deleted:
+            index = self._indexOf(obj)
+            if index is not None:
+                pending[(index, obj.uid)] = None
+
+    def _afterCommit(self, session) -> None:
+        # after_commit also fires when a savepoint is released ; only the outer commit pushes the documents
+        if session.in_nested_transaction():
+            return
+        pending = session.info.pop(self._infoKey, None)
+        if not pending:
+            return
+
+        # group the operations by index and by type
+        additions: dict[str, list[dict]] = {}
+        removals: dict[str, list[int]] = {}
+        for (index, uid), document in pending.items():
+            if document is None:
+                removals.setdefault(index, []).append(uid)
+            else:
+                additions.setdefault(index, []).append(document)
+
+        # the transaction is already committed, thus errors are logged rather than raised
+        try:
+            for index, documents in additions.items():
+                self._fullTextSearch.addDocumentsToIndex(index, documents)
+            for index, ids in removals.items():
+                self._fullTextSearch.removeDocumentsFromIndex(index, ids)
+        except Exception as e:
+            logging.getLogger('ErtieLogger').error(f'Unable to synchronise the search index: {e}')
+
+    def _afterTransactionCreate(self, session, transaction) -> None:
+        # remember the pending operations at the start of a savepoint, to restore them if it is rolled back
+        if transaction.nested:
+            savepoints = session.info.setdefault(self._savepointsKey, {})
+            savepoints[transaction] = dict(session.info.get(self._infoKey, {}))
+
+    def _afterTransactionEnd(self, session, transaction) -> None:
+        if transaction.parent is None:
+            session.info.pop(self._savepointsKey, None)
+
+    def _afterSoftRollback(self, session, previousTransaction) -> None:
+        # a rolled back savepoint only drops its own operations ; after_rollback would also fire for savepoints
+        if previousTransaction.nested:
+            pending = session.info.get(self._savepointsKey, {}).pop(previousTransaction, None)
+            if pending is not None:
+                session.info[self._infoKey] = pending
+        elif not session.in_transaction():
+            session.info.pop(self._infoKey, None)
@@ -0,0 +1,129 @@
+"""
+SQL fallback for full-text searches while the search engine is unavailable.
+
+SPDX-FileCopyrightText: © 2024 Gilles Bellot <gilles.bellot@bell0bytes.eu>
+SPDX-License-Identifier: AGPL-3.0-or-later
+"""
+
+########################################################################################################################
+# IMPORTS ##############################################################################################################
+########################################################################################################################
+import sqlalchemy
+from app.factory.conf import Config
+from app.factory.classes.fullTextSearch.documentSerializer import DocumentSerializer
+
+from typing import Callable
+
+########################################################################################################################
+# CLASS ################################################################################################################
+########################################################################################################################
+class SQLFallback:
+    """
+    Answers queryIndex with a case-insensitive substring match (ILIKE) on the __searchable__ columns of the model
+    registered for an index. There is no ranking: the ids are ordered by the requested sort, then by primary key.
+    Only dict filters are supported, as Meilisearch filter expressions cannot be translated. Dotted fields, i.e.
+    'team.name', are matched and filtered through the relationships, but cannot be sorted or faceted by.
+    """
+    _serializer = DocumentSerializer()
+
+    def __init__(self, session, registry: dict[type, str]) -> None:
+        self._session = session
+        self._registry = registry
+
+    ####################################################################################################################
+    # PUBLIC METHODS €##################################################################################################
+    ####################################################################################################################
+    def queryIndex(self, index: str, query: str, resync: bool = False, page: int | None = None,
+                   hitsPerPage: int | None = None, limit: int | None = None, offset: int | None = None,
+                   filter: dict | None = None, sort: list[str] | None = None, facets: list[str] | None = None,
+                   **options) -> tuple:
+        model = self._modelOf(index)
+        primaryKey = sqlalchemy.inspect(model).primary_key[0]
+
+        # match the query as a substring of any searchable column
+        pattern = '%' + query.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_') + '%'
+        condition = sqlalchemy.or_(*[self._condition(model, field, lambda column: column.ilike(pattern, escape='\\'))
+                                     for field in model.__searchable__])
+        if filter is not None:
+            condition = sqlalchemy.and_(condition, *self._filterConditions(model, filter))
+        ordering = [*self._sortOrder(model, sort or []), primaryKey]
+
+        # paginate like the search engine
+        if page is not None:
+            limit = hitsPerPage if hitsPerPage is not None else limit if limit is not None else Config.RESULTS_PER_PAGE
+            offset = (page - 1) * limit
+        limit = limit if limit is not None else Config.RESULTS_PER_PAGE
+
+        total = self._session.scalar(sqlalchemy.select(sqlalchemy.func.count()).select_from(model).where(condition))
+        facetDistribution = (self._facetDistribution(model, condition, facets),) if facets is not None else ()
+        if resync is False:
+            statement = sqlalchemy.select(primaryKey).where(condition).order_by(*ordering).limit(limit).offset(offset)
+            return list(self._session.scalars(statement)), total, *facetDistribution
+
+        statement = sqlalchemy.select(model).where(condition).order_by(*ordering).limit(limit).offset(offset)
+        hits = [self._serializer.serialize(obj) for obj in self._session.scalars(statement)]
+        return hits, total, *facetDistribution
+
+    ####################################################################################################################
+    # PRIVATE METHODS ##################################################################################################
+    ####################################################################################################################
+    @classmethod
+    def _filterConditions(cls, model: type, filter: dict) -> list:
+        if not isinstance(filter, dict):
+            raise RuntimeError('The SQL fallback only supports filters given as a dict!')
+
+        conditions = []
+        for field, value in filter.items():
+            if value is None:
+                conditions.append(cls._condition(model, field, lambda column: column.is_(None)))
+            elif isinstance(value, (list, tuple, set)):
+                conditions.append(cls._condition(model, field, lambda column, value=value: column.in_(list(value))))
+            else:
+                conditions.append(cls._condition(model, field, lambda column, value=value: column == value))
+        return conditions
+
+    @classmethod
+    def _condition(cls, model: type, field: str, predicate: Callable) -> sqlalchemy.ColumnElement:
+        # follow the relationships of a dotted field ; the condition holds if any related row matches
+        head, _, rest = field.partition('.')
+        if not rest:
+            return predicate(getattr(model, head))
+        relationship = sqlalchemy.inspect(model).relationships.get(head)
+        if relationship is None:
+            raise RuntimeError(f'{head} is not a relationship of {model.__name__}!')
+        condition = cls._condition(relationship.mapper.class_, rest, predicate)
+        attribute = getattr(model, head)
+        return attribute.any(condition) if relationship.uselist else attribute.has(condition)
+
+    @staticmethod
+    def _column(model: type, field: str) -> sqlalchemy.orm.InstrumentedAttribute:
+        if '.' in field:
+            raise RuntimeError(f'The SQL fallback cannot sort or facet by the dotted field {field}!')
+        return getattr(model, field)
+
+    @classmethod
+    def _sortOrder(cls, model: type, sort: list[str]) -> list:
+        # Meilisearch sort rules: 'field:asc' or 'field:desc'
+        ordering = []
+        for rule in sort:
+            field, _, direction = rule.partition(':')
+            column = cls._column(model, field)
+            ordering.append(column.desc() if direction == 'desc' else column.asc())
+        return ordering
+
+    def _facetDistribution(self, model: type, condition, facets: list[str]) -> dict[str, dict[str, int]]:
+        # count the matching rows per value of each facet ; like Meilisearch, null values are not counted
+        distribution = {}
+        for field in facets:
+            column = self._column(model, field)
+            statement = sqlalchemy.select(column, sqlalchemy.func.count()).where(condition, column.is_not(None)) \
+                .group_by(column)
+            distribution[field] = {str(value).lower() if isinstance(value, bool) else str(value): count
+                                   for value, count in self._session.execute(statement)}
+        return distribution
+
+    def _modelOf(self, index: str) -> type:
+        for modelClass, registeredIndex in self._registry.items():
+            if registeredIndex == index:
+                return modelClass
+        raise RuntimeError(f'No searchable model is registered for the index {index}!')
@@ -0,0 +1,7 @@
+"""
+Full-Text Search
+
+SPDX-FileCopyrightText: © 2024 Gilles Bellot <gilles.bellot@bell0bytes.eu>
+SPDX-License-Identifier: AGPL-3.0-or-later
+"""
+from .sqlSearch import SQLSearch
@@ -0,0 +1,385 @@
+"""
+Full-text search inside the database: tsvector and GIN indices on PostgreSQL, FTS5 on SQLite.
+
+SPDX-FileCopyrightText: © 2024 Gilles Bellot <gilles.bellot@bell0bytes.eu>
+SPDX-License-Identifier: AGPL-3.0-or-later
+"""
+
+########################################################################################################################
+# INCLUDES #############################################################################################################
+########################################################################################################################
+import json
+import re
+import time
+import sqlalchemy
+import sqlalchemy.dialects.postgresql
+import sqlalchemy.exc
+from app.factory.conf import Config
+from app.factory.classes.fullTextSearch.documentSerializer import DocumentSerializer
+
+from typing import TYPE_CHECKING, Any, Callable, Iterable, Iterator
+if TYPE_CHECKING:
+    from app.factory.extensions import db
+
+########################################################################################################################
+# CONSTANTS ############################################################################################################
+########################################################################################################################
+_dialects = ('postgresql', 'sqlite')
+
+########################################################################################################################
+# CLASS ################################################################################################################
+########################################################################################################################
+class SQLSearch:
+    """
+    Search provider storing one table of documents per index in the application database, such that no search
+    daemon is needed. Writes are synchronous, i.e. searchable once they return. The hits are ranked in SQL
+    (ts_rank_cd, respectively bm25), thus searchStatement can be joined with the model table to hydrate the hits in
+    one query. Only dict filters are supported.
+    """
+    _serializer = DocumentSerializer()
+
+    def __init__(self, engine: sqlalchemy.Engine | None = None) -> None:
+        self._index = Config.FULLTEXT_SEARCH_INDEX
+        self._engine = engine
+        self._batchSize = Config.FULLTEXT_SEARCH_BATCH_SIZE
+        self._language = Config.FULLTEXT_SEARCH_SQL_LANGUAGE
+        self._createdTables: set[str] = set()
+        if re.fullmatch(r'\w+', self._language) is None:
+            raise RuntimeError(f'Invalid text search configuration: {self._language}!')
+
+    ####################################################################################################################
+    # GETTERS ##########################################################################################################
+    ####################################################################################################################
+    @property
+    def index(self) -> str:
+        return self._index
+
+    @property
+    def url(self) -> str:
+        return self._getEngine().url.render_as_string(hide_password=True)
+
+    ####################################################################################################################
+    # PUBLIC METHODS €##################################################################################################
+    ####################################################################################################################
+    def init(self, engine: sqlalchemy.Engine) -> None:
+        # bind the provider to the application database once, such that threads without an app context can use it
+        self._engine = engine
+
+    def addToIndex(self, index: str, model: 'db.Model', fields: list[str] | None = None) -> None:
+        self.addDocumentsToIndex(index, [self.createDocument(model, fields)])
+
+    def addManyToIndex(self, index: str, models: Iterable['db.Model']) -> list[int]:
+        return self.addDocumentsToIndex(index, (self.createDocument(model) for model in models))
+
+    def addDocumentsToIndex(self, index: str, documents: Iterable[dict]) -> list[int]:
+        # the writes are synchronous, thus there are no tasks to wait for
+        table = self._getTable(index)
+        with self._getEngine().begin() as connection:
+            for chunk in _chunks(documents, self._batchSize):
+                self._upsert(connection, table, chunk)
+        return []
+
+    def removeFromIndex(self, index: str, model: 'db.Model') -> None:
+        self.removeDocumentsFromIndex(index, [model.uid])
+
+    def removeManyFromIndex(self, index: str, models: Iterable['db.Model']) -> list[int]:
+        return self.removeDocumentsFromIndex(index, (model.uid for model in models))
+
+    def removeDocumentsFromIndex(self, index: str, ids: Iterable[int]) -> list[int]:
+        table = self._getTable(index)
+        with self._getEngine().begin() as connection:
+            for chunk in _chunks(ids, self._batchSize):
+                connection.execute(sqlalchemy.delete(table).where(self._idColumn(table).in_(chunk)))
+        return []
+
+    def deleteIndex(self, index: str) -> None:
+        name = self._tableName(index)
+        with self._getEngine().begin() as connection:
+            connection.execute(sqlalchemy.text(f'DROP TABLE IF EXISTS {self._qualifiedName(name)}'))
+        self._createdTables.discard(name)
+
+    @classmethod
+    def createDocument(cls, model: 'db.Model', fields: list[str] | None = None) -> dict:
+        # the document id is the uid of the model ; each searchable field, or each of the given fields, gets an entry
+        return cls._serializer.serialize(model, fields)
+
+    def queryIndex(self, index: str, query: str, resync: bool = False, page: int | None = None,
+                   hitsPerPage: int | None = None, limit: int | None = None, offset: int | None = None,
+                   attributesToRetrieve: list[str] | None = None, exactTotal: bool = False,
+                   filter: dict | None = None, sort: list[str] | None = None,
+                   facets: list[str] | None = None) -> tuple:
+        table = self._getTable(index)
+        identifier, rank, condition = self._match(table, query, filter)
+
+        # paginate like Meilisearch
+        if page is not None or exactTotal is True:
+            limit = hitsPerPage if hitsPerPage is not None else limit if limit is not None else Config.RESULTS_PER_PAGE
+            offset = ((page if page is not None else _offsetPage(offset, limit)) - 1) * limit
+        limit = limit if limit is not None else Config.RESULTS_PER_PAGE
+
+        # the sort rules come first, then the relevancy
+        ordering = [self._field(table, field).desc() if direction == 'desc' else self._field(table, field).asc()
+                    for field, _, direction in (rule.partition(':') for rule in sort or [])]
+        ordering += [rank, identifier] if rank is not None else [identifier]
+
+        try:
+            with self._getEngine().connect() as connection:
+                total = connection.scalar(sqlalchemy.select(sqlalchemy.func.count()).select_from(table)
+                                          .where(condition))
+                statement = sqlalchemy.select(identifier, table.c.document).where(condition) \
+                    .order_by(*ordering).limit(limit).offset(offset)
+                rows = connection.execute(statement).all()
+                facetDistribution = (self._facetDistribution(connection, table, condition, facets),) \
+                    if facets is not None else ()
+        except Exception as e:
+            raise RuntimeError(e)
+
+        if resync is False:
+            return [row[0] for row in rows], total, *facetDistribution
+
+        hits = []
+        for row in rows:
+            document = _loadDocument(row[1])
+            if attributesToRetrieve is not None and '*' not in attributesToRetrieve:
+                document = {key: value for key, value in document.items() if key in attributesToRetrieve}
+            hits.append(document)
+        return hits, total, *facetDistribution
+
+    def searchStatement(self, index: str, query: str, filter: dict | None = None) -> sqlalchemy.Select:
+        """
+        The ranked ids matching the query, to join with the model table, i.e.:
+            hits = searchEngine.searchStatement('members', 'cosmo').subquery()
+            select(Member).join(hits, Member.uid == hits.c.id).order_by(hits.c.rank)
+        Lower ranks are better.
+        """
+        table = self._getTable(index)
+        identifier, rank, condition = self._match(table, query, filter)
+        rank = rank if rank is not None else sqlalchemy.literal_column('0.0')
+        return sqlalchemy.select(identifier.label('id'), rank.label('rank')).where(condition)
+
+    # SETTINGS #########################################################################################################
+    @staticmethod
+    def declaredSettings(modelClass: type) -> dict[str, list[str]]:
+        # every field of a document is searchable, filterable and sortable ; there is nothing to configure
+        return {}
+
+    def diffSettings(self, index: str, declared: dict[str, list[str]]) -> dict[str, tuple[list[str], list[str]]]:
+        return {}
+
+    def applySettings(self, index: str, changes: dict[str, tuple[list[str], list[str]]]) -> list[int]:
+        return []
+
+    @staticmethod
+    def requiresReindex(changes: dict) -> list[str]:
+        return []
+
+    # HEALTH ###########################################################################################################
+    def isHealthy(self) -> bool:
+        try:
+            with self._getEngine().connect() as connection:
+                connection.execute(sqlalchemy.text('SELECT 1'))
+            return True
+        except Exception:
+            return False
+
+    @staticmethod
+    def isTransientError(exception: Exception) -> bool:
+        # walk the exception chain: lost connections and exhausted pools mean that the database is unavailable
+        while exception is not None:
+            if isinstance(exception, (sqlalchemy.exc.OperationalError, sqlalchemy.exc.TimeoutError)):
+                return True
+            if isinstance(exception, sqlalchemy.exc.DBAPIError) and exception.connection_invalidated:
+                return True
+            exception = exception.__cause__ or exception.__context__
+        return False
+
+    # REINDEX ##########################################################################################################
+    def reindex(self, index: str, documents: Iterable[dict],
+                progress: Callable[[int, float], None] | None = None) -> int:
+        # the documents are replaced in one transaction, thus readers see either the old or the new documents
+        table = self._getTable(index)
+        count, started = 0, time.monotonic()
+        with self._getEngine().begin() as connection:
+            connection.execute(sqlalchemy.delete(table))
+            for chunk in _chunks(documents, self._batchSize):
+                self._insert(connection, table, chunk)
+                count += len(chunk)
+                if progress is not None:
+                    progress(count, time.monotonic() - started)
+        return count
+
+    ####################################################################################################################
+    # PRIVATE METHODS ##################################################################################################
+    ####################################################################################################################
+    def _getEngine(self) -> sqlalchemy.Engine:
+        if self._engine is None:
+            raise RuntimeError('The SQL search provider is not bound to a database!')
+        return self._engine
+
+    def _dialect(self) -> str:
+        dialect = self._getEngine().dialect.name
+        if dialect not in _dialects:
+            raise RuntimeError(f'The SQL search provider does not support {dialect}!')
+        return dialect
+
+    def _indexHelper(self, index: str) -> str:
+        # helper function to select index based on prod / dev / test ; converts indices to lower case
+        return (self._index + index).lower() if self._index is not None else index.lower()
+
+    def _tableName(self, index: str) -> str:
+        return 'search_' + re.sub(r'[^a-z0-9_]', '_', self._indexHelper(index))
+
+    def _qualifiedName(self, name: str) -> str:
+        # the search tables live next to the application tables ; SQLite has no schemas
+        if self._dialect() == 'postgresql' and Config.SQLALCHEMY_SCHEMA is not None:
+            return f'{Config.SQLALCHEMY_SCHEMA}.{name}'
+        return name
+
+    def _getTable(self, index: str) -> sqlalchemy.TableClause:
+        name = self._tableName(index)
+        if name not in self._createdTables:
+            self._createTable(name)
+            self._createdTables.add(name)
+
+        if self._dialect() == 'sqlite':
+            return sqlalchemy.table(name, sqlalchemy.column('rowid', sqlalchemy.Integer), sqlalchemy.column('body'),
+                                    sqlalchemy.column('document'))
+        return sqlalchemy.table(name, sqlalchemy.column('id', sqlalchemy.BigInteger), sqlalchemy.column('body'),
+                                sqlalchemy.column('document'), sqlalchemy.column('vector'),
+                                schema=Config.SQLALCHEMY_SCHEMA)
+
+    def _createTable(self, name: str) -> None:
+        qualifiedName = self._qualifiedName(name)
+        if self._dialect() == 'sqlite':
+            statements = [f"CREATE VIRTUAL TABLE IF NOT EXISTS {qualifiedName} USING fts5(body, document UNINDEXED, "
+                          f"tokenize = 'unicode61 remove_diacritics 2')"]
+        else:
+            statements = [f"CREATE TABLE IF NOT EXISTS {qualifiedName} (id BIGINT PRIMARY KEY, "
+                          f"document JSONB NOT NULL, body TEXT NOT NULL, vector TSVECTOR GENERATED ALWAYS AS "
+                          f"(to_tsvector('{self._language}', body)) STORED)",
+                          f"CREATE INDEX IF NOT EXISTS {name}_vector ON {qualifiedName} USING GIN (vector)"]
+        with self._getEngine().begin() as connection:
+            for statement in statements:
+                connection.execute(sqlalchemy.text(statement))
+
+    def _idColumn(self, table: sqlalchemy.TableClause) -> sqlalchemy.ColumnClause:
+        return table.c.rowid if 'rowid' in table.c else table.c.id
+
+    def _match(self, table: sqlalchemy.TableClause, query: str, filter: dict | None) -> tuple:
+        # returns the id column, the rank (lower is better ; None if all documents match) and the condition
+        identifier = self._idColumn(table)
+        terms = re.findall(r'\w+', query or '')
+        conditions = [self._filterCondition(table, field, value) for field, value in _filterItems(filter)]
+        if not terms:
+            return identifier, None, sqlalchemy.and_(sqlalchemy.true(), *conditions)
+
+        # every term must match, the last one as a prefix, as the user might still be typing
+        if self._dialect() == 'sqlite':
+            match = ' '.join(f'"{term}"' for term in terms) + '*'
+            tableName = sqlalchemy.literal_column(table.name)
+            return identifier, sqlalchemy.func.bm25(tableName), \
+                sqlalchemy.and_(tableName.op('MATCH')(match), *conditions)
+
+        tsQuery = sqlalchemy.func.to_tsquery(sqlalchemy.literal_column(f"'{self._language}'"),
+                                             ' & '.join(terms) + ':*')
+        return identifier, -sqlalchemy.func.ts_rank_cd(table.c.vector, tsQuery), \
+            sqlalchemy.and_(table.c.vector.op('@@')(tsQuery), *conditions)
+
+    def _field(self, table: sqlalchemy.TableClause, field: str) -> sqlalchemy.ColumnElement:
+        # a field of the documents, compared with the JSON semantics of the database
+        if self._dialect() == 'sqlite':
+            return sqlalchemy.func.json_extract(table.c.document, f'$."{field}"')
+        return table.c.document.op('->')(field)
+
+    def _filterCondition(self, table: sqlalchemy.TableClause, field: str, value: Any) -> sqlalchemy.ColumnElement:
+        column = self._field(table, field)
+        values = list(value) if isinstance(value, (list, tuple, set)) else [value]
+        if self._dialect() == 'sqlite':
+            # json_extract returns the SQL values of the JSON scalars, i.e. 1 and 0 for booleans and NULL for null
+            if value is None:
+                return column.is_(None)
+            return column.in_([int(item) if isinstance(item, bool) else item for item in values])
+
+        # jsonb values are compared as jsonb ; missing fields are NULL, null fields are 'null'
+        conditions = [column == sqlalchemy.cast(sqlalchemy.literal(json.dumps(item), sqlalchemy.Text),
+                                                sqlalchemy.dialects.postgresql.JSONB) for item in values]
+        if value is None:
+            conditions.append(column.is_(None))
+        return sqlalchemy.or_(*conditions)
+
+    def _facetDistribution(self, connection, table: sqlalchemy.TableClause, condition,
+                           facets: list[str]) -> dict[str, dict[str, int]]:
+        # count the matching documents per value of each facet ; like Meilisearch, null values are not counted
+        distribution = {}
+        for field in facets:
+            column = self._field(table, field)
+            statement = sqlalchemy.select(column, sqlalchemy.func.count()).where(condition, column.is_not(None)) \
+                .group_by(column)
+            distribution[field] = {str(value).lower() if isinstance(value, bool) else str(value): count
+                                   for value, count in connection.execute(statement)}
+        return distribution
+
+    def _upsert(self, connection, table: sqlalchemy.TableClause, documents: list[dict]) -> None:
+        # partial documents are merged into the stored ones, like update_documents does in Meilisearch
+        identifier = self._idColumn(table)
+        ids = [document['id'] for document in documents]
+        stored = {row[0]: _loadDocument(row[1]) for row in
+                  connection.execute(sqlalchemy.select(identifier, table.c.document).where(identifier.in_(ids)))}
+
+        merged = {}
+        for document in documents:
+            merged[document['id']] = {**merged.get(document['id'], stored.get(document['id'], {})), **document}
+        connection.execute(sqlalchemy.delete(table).where(identifier.in_(list(merged))))
+        self._insert(connection, table, list(merged.values()))
+
+    def _insert(self, connection, table: sqlalchemy.TableClause, documents: list[dict]) -> None:
+        if not documents:
+            return
+        identifier = self._idColumn(table)
+        connection.execute(sqlalchemy.insert(table), [{identifier.name: document['id'],
+                                                       'document': self._serializer.encode(document).decode(),
+                                                       'body': _searchableText(document)}
+                                                      for document in documents])
+
+########################################################################################################################
+# HELPERS ##############################################################################################################
+########################################################################################################################
+def _chunks(items: Iterable, size: int) -> Iterator[list]:
+    chunk = []
+    for item in items:
+        chunk.append(item)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+def _offsetPage(offset: int | None, hitsPerPage: int) -> int:
+    # like Meilisearch, exact totals are only returned by page, thus the offset must start a page
+    if not offset:
+        return 1
+    if offset % hitsPerPage != 0:
+        raise ValueError(f'The offset {offset} is not a multiple of {hitsPerPage}!')
+    return offset // hitsPerPage + 1
+
+def _filterItems(filter: dict | None) -> Iterable[tuple[str, Any]]:
+    if filter is None:
+        return []
+    if not isinstance(filter, dict):
+        raise RuntimeError('The SQL search provider only supports filters given as a dict!')
+    return filter.items()
+
+def _loadDocument(document: str | dict) -> dict:
+    # SQLite stores the documents as text, PostgreSQL returns them decoded
+    return json.loads(document) if isinstance(document, str) else document
+
+def _searchableText(document: dict) -> str:
+    # the text indexed for a document: all of its values but the id
+    def values(value) -> Iterator[str]:
+        if isinstance(value, list):
+            for item in value:
+                yield from values(item)
+        elif value is not None and not isinstance(value, bool):
+            yield str(value)
+
+    return ' '.join(text for key, value in document.items() if key != 'id' for text in values(value))
@@ -27,6 +27,15 @@ pathToBaseDirectory = pathlib.Path().absolute()                             # th
 load_dotenv(pathToBaseDirectory.joinpath('.env'))
 load_dotenv(pathToBaseDirectory.joinpath('.flaskenv'))
 
+########################################################################################################################
+# HELPERS ##############################################################################################################
+########################################################################################################################
+def _replicaBinds(uri: str, engineOptions: dict, hosts: list[str]) -> dict[str, dict]:
+    # one bind per read replica, i.e. replica0, replica1, ..., which only differ from the primary by their host
+    return {f'replica{number}': {**engineOptions, 'url': uri,
+                                 'connect_args': {**engineOptions['connect_args'], 'host': host}}
+            for number, host in enumerate(hosts)}
+
 
 ########################################################################################################################
 # MAIN CONFIGURATION CLASS #############################################################################################
@@ -79,11 +88,39 @@ class Config:
     DB_SSL_CERTIFICATE_CLIENT_KEY = os.environ.get('DB_SSL_CERTIFICATE_CLIENT_KEY') # path to the ssl key
     DB_SSL_CERTIFICATE_ROOT = os.environ.get('DB_SSL_CERTIFICATE_ROOT')             # path to the root CA
     DB_SSL_MODE = os.environ.get('DB_SSL_MODE', 'verify-full')      # the SSL mose to use, i.e. verify-full
+    DB_BULK_CHUNK_SIZE = int(os.environ.get('DB_BULK_CHUNK_SIZE', '1000'))  # rows per statement of the bulk writes
+    DB_POOL_SIZE = int(os.environ.get('DB_POOL_SIZE', '5'))         # persistent connections per worker
+    DB_MAX_OVERFLOW = int(os.environ.get('DB_MAX_OVERFLOW', '10'))  # additional connections opened under load
+    DB_POOL_TIMEOUT = float(os.environ.get('DB_POOL_TIMEOUT', '10'))    # seconds to wait for a free connection
+    DB_POOL_RECYCLE = int(os.environ.get('DB_POOL_RECYCLE', '1800'))    # seconds after which connections are replaced
+    DB_POOL_PRE_PING = True if os.environ.get('DB_POOL_PRE_PING', '1') == '1' else False  # test connections on checkout
+    DB_POOL_USE_LIFO = True if os.environ.get('DB_POOL_USE_LIFO', '1') == '1' else False  # let idle connections expire
+    DB_TRANSACTION_RETRIES = int(os.environ.get('DB_TRANSACTION_RETRIES', '3'))  # on serialization failures/deadlocks
+    DB_TRANSACTION_RETRY_BACKOFF = float(os.environ.get('DB_TRANSACTION_RETRY_BACKOFF', '0.05'))    # in seconds
+    DB_PROFILER_SAMPLE_RATE = float(os.environ.get('DB_PROFILER_SAMPLE_RATE', '1' if DEBUG else '0.01'))  # requests
+    DB_PROFILER_SLOWEST = int(os.environ.get('DB_PROFILER_SLOWEST', '5'))   # slowest statements kept per endpoint
+    DB_PROFILER_REPEAT_THRESHOLD = int(os.environ.get('DB_PROFILER_REPEAT_THRESHOLD', '5'))  # N+1 query detection
+    DB_PROFILER_REPORT_SIZE = int(os.environ.get('DB_PROFILER_REPORT_SIZE', '1000'))   # endpoints in the report
+    DB_PLAN_SNAPSHOT_PATH = os.environ.get('DB_PLAN_SNAPSHOT_PATH',
+                                           str(pathToBaseDirectory.joinpath('tests').joinpath('plans')))
+    DB_PLAN_UPDATE = True if os.environ.get('DB_PLAN_UPDATE', '0') == '1' else False  # rewrite the plan snapshots
+    DB_PLAN_ROW_FACTOR = float(os.environ.get('DB_PLAN_ROW_FACTOR', '10'))  # tolerated growth of the row estimates
+    DB_REPLICA_HOSTS = [host for host in os.environ.get('DB_REPLICA_HOSTS', '').split(',') if host] # read replicas
+    DB_REPLICA_MAX_LAG = float(os.environ.get('DB_REPLICA_MAX_LAG', '5'))       # in seconds, then the primary is read
+    DB_REPLICA_CHECK_INTERVAL = float(os.environ.get('DB_REPLICA_CHECK_INTERVAL', '5'))     # in seconds
+    DB_REPLICA_STICKY_WINDOW = float(os.environ.get('DB_REPLICA_STICKY_WINDOW', '5'))  # primary reads after a write
+    DB_POOL_OPTIONS = {'pool_size': DB_POOL_SIZE,
+                       'max_overflow': DB_MAX_OVERFLOW,
+                       'pool_timeout': DB_POOL_TIMEOUT,
+                       'pool_recycle': DB_POOL_RECYCLE,
+                       'pool_pre_ping': DB_POOL_PRE_PING,
+                       'pool_use_lifo': DB_POOL_USE_LIFO} if DB_DIALECT != 'sqlite' else {}
 
     # SQLALCHEMY SETTINGS ##############################################################################################
     SQLALCHEMY_DATABASE_URI = f'{DB_DIALECT}+{DB_DRIVER}://'
     if DB_PASSWORD != '': # pragma: no cover
         SQLALCHEMY_ENGINE_OPTIONS = {'max_identifier_length': 128,
+                                     **DB_POOL_OPTIONS,
                                      'connect_args': {
                                          'host': DB_HOST,
                                          'user': DB_USERNAME,
@@ -93,6 +130,7 @@ class Config:
                                      }
     else:
         SQLALCHEMY_ENGINE_OPTIONS = {'max_identifier_length': 128,
+                                     **DB_POOL_OPTIONS,
                                      'connect_args': {
                                          'host': DB_HOST,
                                          'user': DB_USERNAME,
@@ -103,6 +141,7 @@ class Config:
                                          'sslkey': DB_SSL_CERTIFICATE_CLIENT_KEY,
                                          'sslrootcert': DB_SSL_CERTIFICATE_ROOT}
                                     }
+    SQLALCHEMY_BINDS = _replicaBinds(SQLALCHEMY_DATABASE_URI, SQLALCHEMY_ENGINE_OPTIONS, DB_REPLICA_HOSTS)
     SQLALCHEMY_TRACK_MODIFICATIONS = False
     SQLALCHEMY_ECHO = DEBUG
     SQLALCHEMY_NAMING_CONVENTION = {
@@ -115,10 +154,33 @@ class Config:
     SQLALCHEMY_SCHEMA = 'ertie'
 
     # FULL-TEXT SEARCH SETTINGS ########################################################################################
-    FULLTEXT_SEARCH_PROVIDER = os.environ.get('FULLTEXT_SEARCH_PROVIDER', 'meilisearch')    # the fts provider
+    FULLTEXT_SEARCH_PROVIDER = os.environ.get('FULLTEXT_SEARCH_PROVIDER', 'meilisearch')    # i.e. meilisearch, sql
+    FULLTEXT_SEARCH_SQL_LANGUAGE = os.environ.get('FULLTEXT_SEARCH_SQL_LANGUAGE', 'simple')  # PostgreSQL text search
     FULLTEXT_SEARCH_URL = os.environ.get('FULLTEXT_SEARCH_URL', 'http://localhost')
     FULLTEXT_SEARCH_INDEX = os.environ.get('FULLTEXT_SEARCH_INDEX')
     FULLTEXT_SEARCH_API_KEY = os.environ.get('FULLTEXT_SEARCH_API_KEY')
+    FULLTEXT_SEARCH_POOL_SIZE = int(os.environ.get('FULLTEXT_SEARCH_POOL_SIZE', '10'))          # connections per worker
+    FULLTEXT_SEARCH_KEEP_ALIVE = True if os.environ.get('FULLTEXT_SEARCH_KEEP_ALIVE', '1') == '1' else False
+    FULLTEXT_SEARCH_CONNECT_TIMEOUT = float(os.environ.get('FULLTEXT_SEARCH_CONNECT_TIMEOUT', '2'))   # in seconds
+    FULLTEXT_SEARCH_READ_TIMEOUT = float(os.environ.get('FULLTEXT_SEARCH_READ_TIMEOUT', '10'))        # in seconds
+    FULLTEXT_SEARCH_RETRIES = int(os.environ.get('FULLTEXT_SEARCH_RETRIES', '2'))   # retries of idempotent calls
+    FULLTEXT_SEARCH_RETRY_BACKOFF = float(os.environ.get('FULLTEXT_SEARCH_RETRY_BACKOFF', '0.1'))     # in seconds
+    FULLTEXT_SEARCH_BREAKER_THRESHOLD = int(os.environ.get('FULLTEXT_SEARCH_BREAKER_THRESHOLD', '5'))   # failures
+    FULLTEXT_SEARCH_BREAKER_PROBE_INTERVAL = float(os.environ.get('FULLTEXT_SEARCH_BREAKER_PROBE_INTERVAL', '5'))
+    FULLTEXT_SEARCH_FALLBACK = True if os.environ.get('FULLTEXT_SEARCH_FALLBACK', '1') == '1' else False # SQL search
+    FULLTEXT_SEARCH_BATCH_SIZE = int(os.environ.get('FULLTEXT_SEARCH_BATCH_SIZE', '1000'))      # documents per batch
+    FULLTEXT_SEARCH_BATCH_BYTES = int(os.environ.get('FULLTEXT_SEARCH_BATCH_BYTES', '10485760')) # bytes per batch
+    FULLTEXT_SEARCH_TASK_TIMEOUT = int(os.environ.get('FULLTEXT_SEARCH_TASK_TIMEOUT', '600'))   # in seconds
+    FULLTEXT_SEARCH_QUEUE = True if os.environ.get('FULLTEXT_SEARCH_QUEUE', '0') == '1' else False # background writes
+    FULLTEXT_SEARCH_QUEUE_SIZE = int(os.environ.get('FULLTEXT_SEARCH_QUEUE_SIZE', '500'))       # flush threshold
+    FULLTEXT_SEARCH_QUEUE_INTERVAL = float(os.environ.get('FULLTEXT_SEARCH_QUEUE_INTERVAL', '1.0')) # in seconds
+    FULLTEXT_SEARCH_CACHE = os.environ.get('FULLTEXT_SEARCH_CACHE', 'none')         # i.e. none, memory, sqlite
+    FULLTEXT_SEARCH_CACHE_SIZE = int(os.environ.get('FULLTEXT_SEARCH_CACHE_SIZE', '1024'))      # maximal entries
+    FULLTEXT_SEARCH_CACHE_TTL = float(os.environ.get('FULLTEXT_SEARCH_CACHE_TTL', '60'))        # in seconds
+    FULLTEXT_SEARCH_CACHE_PATH = os.environ.get('FULLTEXT_SEARCH_CACHE_PATH',
+                                                str(pathToBaseDirectory.joinpath('cache').joinpath('search.sqlite')))
+    FULLTEXT_SEARCH_CONSISTENCY_TIMEOUT = float(os.environ.get('FULLTEXT_SEARCH_CONSISTENCY_TIMEOUT', '2')) # seconds
+    FULLTEXT_SEARCH_TASK_POLL_INTERVAL = float(os.environ.get('FULLTEXT_SEARCH_TASK_POLL_INTERVAL', '0.05')) # seconds
 
     # EMAIL SETTINGS ###################################################################################################
     MAIL_SERVER = os.environ.get('MAIL_SERVER')
@@ -152,6 +214,7 @@ class Config:
     # LOG SETTINGS #####################################################################################################
     MAX_LOG_SIZE = int(os.environ.get('MAX_LOG_SIZE'))                      # maximal size per log file
     MAX_LOG_COUNT = int(os.environ.get('MAX_LOG_COUNT'))                    # maximal number of logs to keep in rotation
+    LOG_QUEUE_SIZE = int(os.environ.get('LOG_QUEUE_SIZE', '10000'))         # records waiting to be written per log file
 
     # AUTHENTICATION ###################################################################################################
     AUTH_CLIENT_ID = os.environ.get('AUTH_CLIENT_ID', '123')
@@ -14,6 +14,7 @@ import flask_bootstrap                                              # bootstrap
 import flask_moment                                                 # date and time
 from authlib.integrations.flask_client import OAuth                 # OAuth client for Flask
 from app.factory.classes.fullTextSearch import FullTextSearch       # FullTextSearch Wrapper
+from app.factory.classes.fullTextSearch import SearchSync           # automatic search index synchronisation
 from app.factory.classes.database import Database                   # SQLAlchemy Wrapper
 
 ########################################################################################################################
@@ -24,4 +25,5 @@ bootstrap = flask_bootstrap.Bootstrap5()
 moment = flask_moment.Moment()
 auth = OAuth()
 database = Database()
-fullTextSearch = FullTextSearch()
\ No newline at end of file
+fullTextSearch = FullTextSearch()
+searchSync = SearchSync(fullTextSearch)
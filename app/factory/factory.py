@@ -13,7 +13,7 @@ from typing import Type
 # FLASK & EXTENSIONS ###################################################################################################
 import flask
 import werkzeug.exceptions
-from .extensions import csrf, bootstrap, moment, auth, database
+from .extensions import csrf, bootstrap, moment, auth, database, fullTextSearch, searchSync
 
 # CONFIGURATION ########################################################################################################
 from .conf import Config                                        # the configuration file
@@ -23,6 +23,7 @@ import traceback                                                # exception hist
 from app.components.logging import Logger                       # the logging component
 from app.components.auth import bpAuth                          # the authentication component
 from app.components.main import bpMain                          # the main/index component
+from app.components.search import bpSearch                      # the full-text search component
 
 ########################################################################################################################
 # FLASK APP FACTORY ####################################################################################################
@@ -108,6 +109,19 @@ def createApp(configClass : Type[Config] = Config) -> flask.Flask:
         # initialize the database and its migration
         database.init(app)
 
+        # the SQL search provider searches the application database ; it keeps the engine for the background threads
+        if configClass.FULLTEXT_SEARCH_PROVIDER == 'sql':
+            with app.app_context():
+                fullTextSearch.searchEngine.init(database.db.engine)
+
+        # keep the search index in sync with the searchable models of each committed transaction
+        searchSync.init(database.db.session)
+
+        # answer searches from the database while the search engine is unavailable
+        if configClass.FULLTEXT_SEARCH_FALLBACK is True:
+            from app.factory.classes.fullTextSearch import SQLFallback
+            fullTextSearch.enableFallback(SQLFallback(database.db.session, searchSync.registry))
+
         # log success
         app.logger.info('Database: Operational!')
     except Exception as e:
@@ -115,14 +129,18 @@ def createApp(configClass : Type[Config] = Config) -> flask.Flask:
 
     # BLUEPRINTS #######################################################################################################
     try:
-        # initialize the index / main module
-        app.register_blueprint(bpMain)
+        # initialize the index / main module, which only reads and may thus be answered by the read replicas
+        app.register_blueprint(database.readOnly(bpMain))
         app.logger.info('Index Module: Operational!')
 
         # initialize the authentication module
 
         app.register_blueprint(bpAuth)
-        app.logger.info('Authentication Module: Operational!\n-----')
+        app.logger.info('Authentication Module: Operational!')
+
+        # initialize the full-text search module
+        app.register_blueprint(bpSearch)
+        app.logger.info('Search Module: Operational!\n-----')
     except Exception as e:
         _logAndRaiseException(app.logger, 'Unable to initialize blueprints!.', e)
 
@@ -10,10 +10,21 @@ SPDX-License-Identifier: AGPL-3.0-or-later
 ########################################################################################################################
 # IMPORTS ##############################################################################################################
 ########################################################################################################################
+import pathlib
 import pytest
+import flask
+import sqlalchemy
+import sqlalchemy.orm
 import flask_sqlalchemy.extension
 import flask_migrate
+from app.factory.conf import Config
 from app.factory.extensions import database
+from app.factory.classes.database.poolMonitor import MonitoredQueuePool, PoolMonitor
+from app.factory.classes.database.replicaRouter import ReplicaRouter, RoutingSession, _writeKey
+from app.factory.classes.database.queryProfiler import QueryProfiler
+from app.factory.classes.database.planGuard import PlanCapture, PlanRegressionError, _postgresqlPlan
+from app.factory.classes.fullTextSearch import SearchSync
+from app.factory.classes.fullTextSearch.meiliSearch import MeiliSearch
 
 ########################################################################################################################
 # TESTS ################################################################################################################
@@ -79,16 +90,452 @@ class ObjectWithHistory:
         self.history='test'
         self.name=name
 
-def test_delete_object_and_history(testClient, mocker):
-    with testClient:
-        mocker.patch('sqlalchemy.orm.scoping.scoped_session.delete', return_value='success')
-        mocker.patch('sqlalchemy.orm.scoping.scoped_session.commit', return_value='success')
-        assert database.deleteObjectAndHistory(ObjectWithHistory()) is None
+class Base(sqlalchemy.orm.DeclarativeBase):
+    pass
 
-        with pytest.raises(Exception):
-            mocker.patch('sqlalchemy.orm.scoping.scoped_session.delete', side_effect=Exception)
-            mocker.patch('sqlalchemy.orm.scoping.scoped_session.rollback', return_value='success')
-            database.deleteObjectAndHistory('test')
+class Team(Base):
+    __tablename__ = 'team'
+    uid = sqlalchemy.Column(sqlalchemy.Integer, primary_key=True)
+    members = sqlalchemy.orm.relationship('Member', back_populates='team')
+
+class Member(Base):
+    __tablename__ = 'member'
+    uid = sqlalchemy.Column(sqlalchemy.Integer, primary_key=True)
+    name = sqlalchemy.Column(sqlalchemy.String)
+    teamId = sqlalchemy.Column(sqlalchemy.Integer, sqlalchemy.ForeignKey('team.uid'))
+    team = sqlalchemy.orm.relationship('Team', back_populates='members')
+    history = sqlalchemy.orm.relationship('MemberHistory', cascade='all, delete-orphan')
+
+class MemberHistory(Base):
+    __tablename__ = 'memberHistory'
+    uid = sqlalchemy.Column(sqlalchemy.Integer, primary_key=True)
+    memberId = sqlalchemy.Column(sqlalchemy.Integer, sqlalchemy.ForeignKey('member.uid'), nullable=False)
+    why = sqlalchemy.Column(sqlalchemy.String)
+
+class Match(Base):
+    __tablename__ = 'match'
+    __mapper_args__ = {'eager_defaults': True}
+    uid = sqlalchemy.Column(sqlalchemy.Integer, primary_key=True)
+    venue = sqlalchemy.Column(sqlalchemy.String)
+    version = sqlalchemy.Column(sqlalchemy.Integer, server_default='1', onupdate=sqlalchemy.text('version + 1'))
+
+class Venue(Base):
+    __tablename__ = 'venue'
+    # the column key differs from the attribute name
+    uid = sqlalchemy.Column('id', sqlalchemy.Integer, primary_key=True, key='venueId')
+
+@pytest.fixture()
+def sqliteSession(mocker):
+    engine = sqlalchemy.create_engine('sqlite://')
+    Base.metadata.create_all(engine)
+    session = sqlalchemy.orm.scoped_session(sqlalchemy.orm.sessionmaker(engine))
+    session.add_all([Team(uid=1), *[Member(uid=uid, name=f'Member {uid}', teamId=1) for uid in range(1, 6)]])
+    session.commit()
+    session.expunge_all()
+
+    statements = []
+    sqlalchemy.event.listen(engine, 'before_cursor_execute', lambda *args: statements.append(args[2]))
+    mocker.patch.object(database.db, 'session', session)
+    yield session, statements
+    session.remove()
+
+def test_get_by_ids(sqliteSession):
+    session, statements = sqliteSession
+    members = database.getByIds(Member, [4, 2, 99, 5], options=[sqlalchemy.orm.joinedload(Member.team)])
+    assert [member.uid for member in members] == [4, 2, 5]
+    assert all(member.team.uid == 1 for member in members)
+    assert len(statements) == 1
+
+def test_get_by_ids_identity_map(sqliteSession):
+    session, statements = sqliteSession
+    cached = session.get(Member, 3)
+    statements.clear()
+
+    members = database.getByIds(Member, [3, 1])
+    assert members[0] is cached
+    assert len(statements) == 1
+    assert database.getByIds(Member, [3]) == [cached]
+    assert len(statements) == 1
+
+    # the options apply to the objects in the identity map, too
+    statements.clear()
+    members = database.getByIds(Member, [3, 1], options=[sqlalchemy.orm.joinedload(Member.team)])
+    assert members[0] is cached
+    assert len(statements) == 1
+    assert all(member.team.uid == 1 for member in members)
+    assert len(statements) == 1
+
+def test_get_by_ids_column_key(sqliteSession):
+    session, statements = sqliteSession
+    session.add_all([Venue(uid=1), Venue(uid=2)])
+    session.commit()
+    session.expunge_all()
+    assert [venue.uid for venue in database.getByIds(Venue, [2, 1])] == [2, 1]
+
+def test_add_all(sqliteSession):
+    session, statements = sqliteSession
+    database.addAll([Member(uid=uid, name=f'Member {uid}', teamId=1) for uid in range(10, 15)], chunkSize=2)
+    assert session.scalar(sqlalchemy.select(sqlalchemy.func.count()).select_from(Member)) == 10
+    assert sum(statement.startswith('INSERT') for statement in statements) == 3
+
+    with pytest.raises(RuntimeError):
+        database.addAll([Member(uid=1)])
+    assert session.scalar(sqlalchemy.select(sqlalchemy.func.count()).select_from(Member)) == 10
+
+def test_bulk_insert_and_update(sqliteSession):
+    session, statements = sqliteSession
+    assert database.bulkInsert(Member, ({'uid': uid, 'name': f'Member {uid}'} for uid in range(10, 2010))) == 2000
+    assert sum(statement.startswith('INSERT') for statement in statements) == 2
+    assert session.scalar(sqlalchemy.select(sqlalchemy.func.count()).select_from(Member)) == 2005
+
+    statements.clear()
+    assert database.bulkUpdate(Member, [{'uid': uid, 'teamId': None} for uid in range(1, 6)]) == 5
+    assert sum(statement.startswith('UPDATE') for statement in statements) == 1
+    assert session.scalar(sqlalchemy.select(sqlalchemy.func.count()).select_from(Member)
+                          .where(Member.teamId.is_(None))) == 2005
+
+    with pytest.raises(RuntimeError):
+        database.bulkInsert(Member, [{'uid': 2000}, {'uid': 1}])
+    assert session.scalar(sqlalchemy.select(sqlalchemy.func.count()).select_from(Member)) == 2005
+
+def test_commit_returning(sqliteSession):
+    session, statements = sqliteSession
+    match = Match(venue='Dimmsdale')
+    database.addCommitReturning(match)
+    assert match.uid == 1
+    assert match.version == 1
+
+    match.venue = 'Fairy World'
+    database.commitReturning()
+    assert match.version == 2
+    assert not any(statement.startswith('SELECT') for statement in statements)
+    assert session().expire_on_commit is True
+
+    session.expunge_all()
+    with pytest.raises(RuntimeError):
+        database.addCommitReturning(Match(uid=1))
+    assert session().expire_on_commit is True
+    assert session.scalar(sqlalchemy.select(sqlalchemy.func.count()).select_from(Match)) == 1
+
+def test_delete_object_and_history(sqliteSession):
+    session, statements = sqliteSession
+    session.add_all([MemberHistory(memberId=uid, why=f'Modification {n}') for uid in (1, 2) for n in range(50)])
+    session.commit()
+    member = session.get(Member, 1)
+    statements.clear()
+
+    assert database.deleteObjectAndHistory(member) == {'memberHistory': 50, 'member': 1}
+    assert sum(statement.startswith('DELETE') for statement in statements) == 2
+    assert not any(statement.startswith('SELECT') for statement in statements)
+    assert session.scalar(sqlalchemy.select(sqlalchemy.func.count()).select_from(MemberHistory)) == 50
+
+def test_delete_many(sqliteSession):
+    session, statements = sqliteSession
+    session.add_all([MemberHistory(memberId=uid, why='Modification') for uid in range(1, 6) for n in range(10)])
+    session.commit()
+    members = session.scalars(sqlalchemy.select(Member).where(Member.uid > 2)).all()
+    statements.clear()
+
+    assert database.deleteMany(members) == {'memberHistory': 30, 'member': 3}
+    assert len(statements) == 2
+    assert session.scalar(sqlalchemy.select(sqlalchemy.func.count()).select_from(Member)) == 2
+
+    # any one-to-many relationship can be deleted set-based
+    session.execute(sqlalchemy.delete(MemberHistory))
+    # many-to-one relationships are refused, as deleting them would delete the shared parent
+    with pytest.raises(ValueError):
+        database.deleteMany([session.get(Member, 1)], relationships=['team'])
+    assert session.get(Team, 1) is not None and session.get(Member, 1) is not None
+
+    assert database.deleteMany([session.get(Team, 1)], relationships=['members']) == {'member': 2, 'team': 1}
+    assert session.scalar(sqlalchemy.select(sqlalchemy.func.count()).select_from(Member)) == 0
+
+def test_get_modified_attributes(sqliteSession):
+    session, statements = sqliteSession
+    member = session.get(Member, 1)
+    assert database.getModifiedAttributes(member) == []
+
+    member.teamId = 2
+    assert database.getModifiedAttributes(member) == ['teamId']
+    assert database.getModifiedAttributes(member, ['name']) == []
+
+def test_pool_monitor(tmp_path):
+    engine = sqlalchemy.create_engine(f'sqlite:///{tmp_path}/pool.db', poolclass=MonitoredQueuePool,
+                                      pool_size=1, max_overflow=0, pool_timeout=0.05)
+    monitor = PoolMonitor(engine)
+
+    connection = engine.connect()
+    with pytest.raises(sqlalchemy.exc.TimeoutError):
+        engine.connect()
+    statistics = monitor.statistics
+    assert statistics['checkedOut'] == 1 and statistics['capacity'] == 1 and statistics['saturation'] == 1.0
+    assert statistics['timeouts'] == 1 and statistics['waitMax'] >= 0.05 and statistics['connects'] == 1
+
+    connection.close()
+    assert monitor.statistics['checkedOut'] == 0
+
+    # the monitor survives the recreation of the pool
+    engine.dispose()
+    engine.connect().close()
+    assert monitor.statistics['connects'] == 2 and monitor.statistics['peakCheckedOut'] == 1
+
+def test_pool_after_fork(testApp, mocker):
+    assert testApp.config['SQLALCHEMY_ENGINE_OPTIONS']['pool_size'] == Config.DB_POOL_SIZE
+    assert database.poolStatistics['default']['capacity'] == Config.DB_POOL_SIZE + Config.DB_MAX_OVERFLOW
+
+    with testApp.app_context():
+        engine = database.db.engine
+    dispose = mocker.spy(engine, 'dispose')
+    database._afterFork()
+    dispose.assert_called_once_with(close=False)
+
+def test_transaction(sqliteSession, mocker):
+    session, statements = sqliteSession
+    commits = []
+    sqlalchemy.event.listen(session, 'after_commit', commits.append)
+
+    # the helpers defer to one commit at the end of the block
+    with database.transaction():
+        database.addCommitFlushRefresh(Member(uid=6, name='Member 6'))
+        database.addCommitFlushRefresh(Member(uid=7, name='Member 7'))
+        database.deleteObject(session.get(Member, 5))
+        assert database.transactionDepth == 1
+    assert len(commits) == 1 and database.transactionDepth == 0
+    assert session.scalar(sqlalchemy.select(sqlalchemy.func.count()).select_from(Member)) == 6
+
+    # nested blocks are savepoints
+    with database.transaction():
+        database.addCommitFlushRefresh(Member(uid=8, name='Member 8'))
+        with pytest.raises(RuntimeError):
+            with database.transaction():
+                database.addCommitFlushRefresh(Member(uid=9, name='Member 9'))
+                raise ValueError
+    assert session.get(Member, 8) is not None and session.get(Member, 9) is None
+
+    # errors roll back the whole block
+    with pytest.raises(RuntimeError):
+        with database.transaction():
+            database.addCommitFlushRefresh(Member(uid=10, name='Member 10'))
+            database.addCommitFlushRefresh(Member(uid=1, name='Duplicate'))
+    assert session.get(Member, 10) is None and database.transactionDepth == 0
+
+    # a rolled back savepoint neither drops the index operations nor the primary pinning of the outer transaction
+    mocker.patch.object(Member, '__searchable__', ['name'], create=True)
+    search = mocker.Mock(searchEngine=MeiliSearch)
+    searchSync = SearchSync(search)
+    searchSync.register(Member, 'members')
+    searchSync.init(session)
+    ReplicaRouter().listen(session)
+    with database.transaction():
+        database.addCommitFlushRefresh(Member(uid=11, name='Member 11'))
+        with pytest.raises(RuntimeError):
+            with database.transaction():
+                database.addCommitFlushRefresh(Member(uid=12, name='Member 12'))
+                raise ValueError
+        assert session.info.get(_writeKey) is True
+    search.addDocumentsToIndex.assert_called_once_with('members', [{'id': 11, 'name': 'Member 11'}])
+
+def test_run_in_transaction(sqliteSession, mocker):
+    mocker.patch.object(Config, 'DB_TRANSACTION_RETRY_BACKOFF', 0)
+    deadlock = sqlalchemy.exc.OperationalError('UPDATE', {}, mocker.Mock(pgcode='40P01'))
+    attempts = []
+
+    def rename():
+        attempts.append(1)
+        database.commitFlush()
+        if len(attempts) < 3:
+            raise deadlock
+        return 'renamed'
+
+    # serialization failures and deadlocks are retried, other errors are not
+    assert database.runInTransaction(rename) == 'renamed' and len(attempts) == 3
+    attempts.clear()
+    with pytest.raises(RuntimeError):
+        database.runInTransaction(rename, retries=0)
+    assert len(attempts) == 1
+    with pytest.raises(RuntimeError):
+        database.runInTransaction(mocker.Mock(side_effect=ValueError))
+
+def test_query_profiler(tmp_path, mocker):
+    engine = sqlalchemy.create_engine(f'sqlite:///{tmp_path}/profile.db')
+    Base.metadata.create_all(engine)
+    app = flask.Flask(__name__)
+    profiler = QueryProfiler()
+    profiler.init(app, {None: engine})
+
+    @app.route('/members')
+    def members():
+        # one query per member, i.e. N+1
+        with engine.connect() as connection:
+            for uid in range(6):
+                connection.execute(sqlalchemy.select(Member).where(Member.uid == uid))
+        return 'members'
+
+    @app.route('/teams')
+    def teams():
+        return 'teams'
+
+    # requests which are not sampled are not timed
+    mocker.patch.object(Config, 'DB_PROFILER_SAMPLE_RATE', 0)
+    assert 'Server-Timing' not in app.test_client().get('/members').headers
+    assert profiler.report == {}
+
+    mocker.patch.object(Config, 'DB_PROFILER_SAMPLE_RATE', 1)
+    warning = mocker.patch('logging.Logger.warning')
+    response = app.test_client().get('/members')
+    assert response.headers['Server-Timing'].startswith('db;dur=') and '6 queries' in response.headers['Server-Timing']
+    assert 'Possible N+1 query in members' in warning.call_args.args[0]
+
+    report = profiler.report['members']
+    assert report['requests'] == 1 and report['queries'] == 6 and report['repeated'] == 1
+    assert len(report['slowest']) == Config.DB_PROFILER_SLOWEST and report['duration'] >= report['slowest'][0][0]
+
+    # unmatched requests share one entry, and the report is bounded
+    app.test_client().get('/unknown/1')
+    app.test_client().get('/unknown/2')
+    assert set(profiler.report) == {'members', '<unmatched>'} and profiler.report['<unmatched>']['requests'] == 2
+    mocker.patch.object(Config, 'DB_PROFILER_REPORT_SIZE', 2)
+    app.test_client().get('/teams')
+    assert 'teams' not in profiler.report
+
+def test_capture_plans(tmp_path, mocker):
+    mocker.patch.object(Config, 'DB_PLAN_SNAPSHOT_PATH', str(tmp_path))
+    engine = sqlalchemy.create_engine(f'sqlite:///{tmp_path}/plans.db')
+    Base.metadata.create_all(engine)
+
+    def queryMembers():
+        with engine.connect() as connection:
+            connection.execute(sqlalchemy.text('CREATE INDEX IF NOT EXISTS ix_member_name ON member (name)'))
+            connection.execute(sqlalchemy.select(Member).where(Member.name == 'Frodo'))
+            connection.execute(sqlalchemy.select(Member).where(Member.uid == 1))
+
+    # the first run records the snapshot
+    with database.capturePlans('members', [engine]) as capture:
+        queryMembers()
+    indexes = sorted(index for plan in capture.plans.values() for index in plan['indexes'])
+    assert indexes == ['ix_member_name', 'member primary key'] and (tmp_path / 'members.json').is_file()
+
+    # dropping the index turns the search into a scan
+    with engine.begin() as connection:
+        connection.execute(sqlalchemy.text('DROP INDEX ix_member_name'))
+    engine.dispose()    # as after a migration ; sqlite3 would reuse its cached EXPLAIN statement otherwise
+    with pytest.raises(PlanRegressionError, match='New sequential scan of member'):
+        with database.capturePlans('members', [engine]):
+            with engine.connect() as connection:
+                connection.execute(sqlalchemy.select(Member).where(Member.name == 'Frodo'))
+
+    # unless the snapshots are updated
+    mocker.patch.object(Config, 'DB_PLAN_UPDATE', True)
+    with database.capturePlans('members', [engine]):
+        with engine.connect() as connection:
+            connection.execute(sqlalchemy.select(Member).where(Member.name == 'Frodo'))
+    assert 'ix_member_name' not in (tmp_path / 'members.json').read_text()
+
+def test_postgresql_plans():
+    plan = _postgresqlPlan([{'Plan': {'Node Type': 'Nested Loop', 'Plan Rows': 5000, 'Plans': [
+        {'Node Type': 'Seq Scan', 'Relation Name': 'team', 'Plan Rows': 10},
+        {'Node Type': 'Index Scan', 'Relation Name': 'member', 'Index Name': 'ix_member_teamId', 'Plan Rows': 500}]}}])
+    assert plan == {'scans': ['team'], 'indexes': ['ix_member_teamId'], 'rows': 5000}
+
+    capture = PlanCapture(pathlib.Path('unused.json'), [])
+    capture.plans['key'] = {'statement': 'SELECT', **plan}
+    assert capture.compare({'key': {'statement': 'SELECT', **plan, 'rows': 50}}) == \
+        ['Row estimate grew from 50 to 5000: SELECT']
+
+def test_plan_capture_failure(mocker):
+    # a failed EXPLAIN is rolled back to its savepoint, such that the transaction is not aborted
+    connection = mocker.Mock()
+    connection.dialect.name = 'postgresql'
+    connection.connection.dbapi_connection.autocommit = False
+    cursor = connection.connection.cursor.return_value
+
+    def execute(sql, *args):
+        if sql.startswith('EXPLAIN'):
+            raise sqlalchemy.exc.ProgrammingError(sql, args, ValueError())
+    cursor.execute.side_effect = execute
+    warning = mocker.patch('logging.Logger.warning')
+
+    capture = PlanCapture(pathlib.Path('unused.json'), [])
+    capture._beforeExecute(connection, None, 'SELECT * FROM member', {}, None, False)
+    assert [call.args[0] for call in cursor.execute.call_args_list] == [
+        'SAVEPOINT ertie_plan_capture', 'EXPLAIN (FORMAT JSON) SELECT * FROM member',
+        'ROLLBACK TO SAVEPOINT ertie_plan_capture', 'RELEASE SAVEPOINT ertie_plan_capture']
+    assert capture.plans == {} and warning.called
+
+@pytest.fixture()
+def replicaSession(tmp_path, mocker):
+    # the primary and the replica hold different names, such that the answering engine can be told apart
+    engines = {None: sqlalchemy.create_engine(f'sqlite:///{tmp_path}/primary.db'),
+               'replica0': sqlalchemy.create_engine(f'sqlite:///{tmp_path}/replica.db')}
+    for name, engine in (('primary', engines[None]), ('replica', engines['replica0'])):
+        Base.metadata.create_all(engine)
+        with engine.begin() as connection:
+            connection.execute(sqlalchemy.insert(Member), [{'uid': 1, 'name': name}])
+
+    router = ReplicaRouter()
+    router.init(engines)
+    mocker.patch.object(router, '_ensureWorker')
+    session = sqlalchemy.orm.sessionmaker(class_=RoutingSession, db=mocker.Mock(engines=engines), router=router)()
+    router.listen(session)
+    router.checkReplicas()
+    yield session, router
+    session.close()
+
+def test_replica_routing(testApp, replicaSession):
+    session, router = replicaSession
+    assert router.status == {'replica0': {'healthy': True, 'lag': 0}}
+
+    with testApp.test_request_context('/'):
+        # plain reads go to the replica, writes and everything after them in the transaction to the primary
+        assert session.scalar(sqlalchemy.select(Member.name)) == 'replica'
+        session.add(Member(uid=2, name='new'))
+        session.flush()
+        assert session.scalar(sqlalchemy.select(Member.name).where(Member.uid == 1)) == 'primary'
+        session.commit()
+
+        # the client sticks to the primary for a while after its write
+        assert session.scalar(sqlalchemy.select(Member.name).where(Member.uid == 1)) == 'primary'
+        session.commit()
+        flask.session.clear()
+        assert session.scalar(sqlalchemy.select(Member.name).where(Member.uid == 1)) == 'replica'
+
+        # locking reads go to the primary ; so do text statements, except for the read-only blueprints
+        session.rollback()
+        assert session.scalar(sqlalchemy.select(Member.name).with_for_update()) == 'primary'
+        session.rollback()
+        assert session.scalar(sqlalchemy.text('SELECT name FROM member')) == 'primary'
+        session.rollback()
+        router.readOnly(flask.Blueprint('main', __name__))
+        assert session.scalar(sqlalchemy.text('SELECT name FROM member')) == 'replica'
+
+def test_replica_savepoint(replicaSession):
+    # outside of a request, a released savepoint keeps the write transaction on the primary
+    session, router = replicaSession
+    session.add(Member(uid=2, name='new'))
+    session.flush()
+    with session.begin_nested():
+        session.add(Member(uid=3, name='newer'))
+    assert session.info.get(_writeKey) is True and session.in_transaction()
+    assert session.scalar(sqlalchemy.select(Member.name).where(Member.uid == 3)) == 'newer'
+    session.commit()
+    assert session.info.get(_writeKey) is None
+    assert session.scalar(sqlalchemy.select(Member.name).where(Member.uid == 1)) == 'replica'
+
+def test_replica_fallback(replicaSession, mocker):
+    session, router = replicaSession
+
+    # lagging replicas are skipped until they caught up
+    mocker.patch.object(Config, 'DB_REPLICA_MAX_LAG', -1)
+    router.checkReplicas()
+    assert router.status['replica0']['healthy'] is False
+    assert session.scalar(sqlalchemy.select(Member.name)) == 'primary'
+
+    # so are unreachable replicas
+    mocker.patch.object(Config, 'DB_REPLICA_MAX_LAG', 5)
+    mocker.patch.object(router.replicas['replica0'], 'connect',
+                        side_effect=sqlalchemy.exc.OperationalError('SELECT 0', {}, None))
+    router.checkReplicas()
+    assert router.status['replica0'] == {'healthy': False, 'lag': None}
 
 def test_modifications(testClient):
     with testClient:
@@ -9,7 +9,11 @@ SPDX-License-Identifier: AGPL-3.0-or-later
 ########################################################################################################################
 # IMPORTS ##############################################################################################################
 ########################################################################################################################
+import json
+import pytest
+import meilisearch.errors
 from app.factory.extensions import fullTextSearch
+from app.factory.conf import Config
 
 ########################################################################################################################
 # TESTS ################################################################################################################
@@ -22,19 +26,80 @@ class TestModel:
 class TestIndex:
     @classmethod
     def update_documents(cls, documents):
-        return documents
+        return TaskInfo(1)
 
     @classmethod
     def delete_document(cls, document):
-        return document
+        return TaskInfo(2)
 
     @classmethod
-    def search(cls, query):
+    def search(cls, query, opt_params=None):
         return {'query': query,
                 'estimatedHits': 1,
                 'estimatedTotalHits': 1,
                 'hits': [{'id': 1}]}
 
+class TaskInfo:
+    def __init__(self, taskUid: int):
+        self.task_uid = taskUid
+
+class BatchIndex:
+    def __init__(self):
+        self.batches = []
+
+    def update_documents_raw(self, documents, content_type):
+        self.batches.append(json.loads(documents))
+        return TaskInfo(len(self.batches))
+
+    def delete_documents(self, ids):
+        self.batches.append(ids)
+        return TaskInfo(len(self.batches))
+
+class Task:
+    def __init__(self, status: str = 'succeeded'):
+        self.status = status
+        self.error = None
+
+class ReindexClient:
+    def __init__(self):
+        self.indices = {}
+        self.calls = []
+
+    def index(self, uid):
+        self.calls.append(('index', uid))
+        return self.indices.setdefault(uid, ReindexIndex())
+
+    def delete_index(self, uid):
+        self.calls.append(('delete', uid))
+        return TaskInfo(0)
+
+    def create_index(self, uid, options):
+        self.calls.append(('create', uid))
+        return TaskInfo(0)
+
+    def swap_indexes(self, parameters):
+        self.calls.append(('swap', parameters[0]['indexes']))
+        return TaskInfo(0)
+
+    def wait_for_task(self, uid, timeout_in_ms):
+        return Task('failed' if uid < 0 else 'succeeded')
+
+class ReindexIndex(BatchIndex):
+    def get_settings(self):
+        return {'searchableAttributes': ['name']}
+
+    def update_settings(self, settings):
+        self.settings = settings
+        return TaskInfo(0)
+
+def _testModels(count: int) -> list[TestModel]:
+    models = []
+    for uid in range(count):
+        model = TestModel()
+        model.uid = uid
+        models.append(model)
+    return models
+
 def test_add_to_index(mocker):
     testIndex = TestIndex()
     mocker.patch('meilisearch.client.Client.index', return_value=testIndex)
@@ -47,6 +112,84 @@ def test_remove_from_index(mocker):
     mocker.patch('meilisearch.index.Index.delete_documents', return_value='success')
     assert fullTextSearch.removeFromIndex('ertie_dev', TestModel()) is None
 
+def test_add_many_to_index(mocker):
+    testIndex = BatchIndex()
+    mocker.patch('meilisearch.client.Client.index', return_value=testIndex)
+    mocker.patch.object(fullTextSearch.searchEngine, '_batchSize', 2)
+
+    assert fullTextSearch.addManyToIndex('ertie_dev', _testModels(5)) == [1, 2, 3]
+    assert [len(batch) for batch in testIndex.batches] == [2, 2, 1]
+    assert testIndex.batches[0][0] == {'id': 0, 'name': 'test'}
+
+def test_add_many_to_index_bytes(mocker):
+    testIndex = BatchIndex()
+    mocker.patch('meilisearch.client.Client.index', return_value=testIndex)
+    mocker.patch.object(fullTextSearch.searchEngine, '_batchBytes', 1)
+
+    assert fullTextSearch.addManyToIndex('ertie_dev', _testModels(3)) == [1, 2, 3]
+
+def test_remove_many_from_index(mocker):
+    testIndex = BatchIndex()
+    mocker.patch('meilisearch.client.Client.index', return_value=testIndex)
+    mocker.patch.object(fullTextSearch.searchEngine, '_batchSize', 2)
+
+    assert fullTextSearch.removeManyFromIndex('ertie_dev', _testModels(3)) == [1, 2]
+    assert testIndex.batches == [[0, 1], [2]]
+    assert fullTextSearch.removeManyFromIndex('ertie_dev', []) == []
+
+def test_reindex(mocker):
+    client = ReindexClient()
+    mocker.patch.object(fullTextSearch.searchEngine, '_client', client)
+    mocker.patch.object(fullTextSearch.searchEngine, '_batchSize', 2)
+    progress = []
+
+    documents = ({'id': uid, 'name': 'test'} for uid in range(3))
+    count = fullTextSearch.searchEngine.reindex('members', documents, lambda n, t: progress.append(n))
+    live = fullTextSearch.searchEngine._indexHelper('members')
+    shadow = fullTextSearch.searchEngine._indexHelper('members_reindex')
+
+    assert count == 3
+    assert progress == [2, 3]
+    assert client.indices[shadow].settings == {'searchableAttributes': ['name']}
+    assert [len(batch) for batch in client.indices[shadow].batches] == [2, 1]
+    assert ('swap', [live, shadow]) in client.calls
+    assert client.calls[-1] == ('delete', shadow)
+
+def test_reindex_replays_writes(mocker):
+    client = ReindexClient()
+    mocker.patch.object(fullTextSearch.searchEngine, '_client', client)
+    engine = fullTextSearch.searchEngine
+    live, shadow = engine._indexHelper('members'), engine._indexHelper('members_reindex')
+
+    def documents():
+        # a document changed after it was read, and one removed, while the index is rebuilt
+        yield {'id': 1, 'name': 'old'}
+        engine.addDocumentsToIndex('members', [{'id': 1, 'name': 'new'}])
+        engine.removeDocumentsFromIndex('members', [2])
+        yield {'id': 2, 'name': 'removed'}
+
+    swap = client.swap_indexes
+
+    def swapIndexes(parameters):
+        # writes after the replay go to both indices
+        engine.addDocumentsToIndex('members', [{'id': 3, 'name': 'late'}])
+        return swap(parameters)
+    mocker.patch.object(client, 'swap_indexes', side_effect=swapIndexes)
+
+    assert engine.reindex('members', documents()) == 2
+    assert client.indices[shadow].batches == [[{'id': 1, 'name': 'old'}, {'id': 2, 'name': 'removed'}],
+                                              [{'id': 1, 'name': 'new'}], [2], [{'id': 3, 'name': 'late'}]]
+    assert client.indices[live].batches == [[{'id': 1, 'name': 'new'}], [2], [{'id': 3, 'name': 'late'}]]
+    assert engine._rebuilds == {}
+
+def test_reindex_failed_task(mocker):
+    client = ReindexClient()
+    mocker.patch.object(client, 'swap_indexes', return_value=TaskInfo(-1))
+    mocker.patch.object(fullTextSearch.searchEngine, '_client', client)
+
+    with pytest.raises(RuntimeError):
+        fullTextSearch.searchEngine.reindex('members', iter([{'id': 1}]))
+
 def test_query_index(mocker):
     testIndex = TestIndex()
     mocker.patch('meilisearch.client.Client.index', return_value=testIndex)
@@ -58,4 +201,139 @@ def test_query_index(mocker):
 
     hits, total = fullTextSearch.queryIndex('ertie_dev', 'test', resync=True)
     assert hits == [{'id': 1}]
-    assert total == 1
\ No newline at end of file
+    assert total == 1
+
+def test_query_index_pagination(mocker):
+    search = mocker.patch.object(TestIndex, 'search', return_value={'hits': [{'id': 3}], 'totalHits': 21,
+                                                                     'totalPages': 2, 'page': 2, 'hitsPerPage': 20})
+    mocker.patch('meilisearch.client.Client.index', return_value=TestIndex())
+
+    ids, total = fullTextSearch.queryIndex('ertie_dev', 'test', page=2)
+    assert ids == [3]
+    assert total == 21
+    assert search.call_args.args[1] == {'attributesToRetrieve': ['id'], 'page': 2,
+                                        'hitsPerPage': Config.RESULTS_PER_PAGE}
+
+    fullTextSearch.queryIndex('ertie_dev', 'test', limit=5, exactTotal=True)
+    assert search.call_args.args[1] == {'attributesToRetrieve': ['id'], 'page': 1, 'hitsPerPage': 5}
+
+    # the offset selects the page of the exact totals
+    fullTextSearch.queryIndex('ertie_dev', 'test', limit=20, offset=40, exactTotal=True)
+    assert search.call_args.args[1] == {'attributesToRetrieve': ['id'], 'page': 3, 'hitsPerPage': 20}
+    with pytest.raises(ValueError):
+        fullTextSearch.queryIndex('ertie_dev', 'test', limit=20, offset=30, exactTotal=True)
+
+def test_query_index_limit_and_projection(mocker):
+    search = mocker.patch.object(TestIndex, 'search', return_value={'hits': [{'id': 3, 'name': 'test'}],
+                                                                     'estimatedTotalHits': 40})
+    mocker.patch('meilisearch.client.Client.index', return_value=TestIndex())
+
+    hits, total = fullTextSearch.queryIndex('ertie_dev', 'test', resync=True, limit=10, offset=30,
+                                            attributesToRetrieve=['id', 'name'])
+    assert hits == [{'id': 3, 'name': 'test'}]
+    assert total == 40
+    assert search.call_args.args[1] == {'attributesToRetrieve': ['id', 'name'], 'limit': 10, 'offset': 30}
+
+    fullTextSearch.queryIndex('ertie_dev', 'test', resync=True)
+    assert search.call_args.args[1] == {}
+
+    # the primary key is always retrieved, as the hits are mapped to their ids
+    assert fullTextSearch.queryIndex('ertie_dev', 'test', attributesToRetrieve=['name']) == ([3], 40)
+    assert search.call_args.args[1] == {'attributesToRetrieve': ['id', 'name']}
+
+def test_query_index_filter_sort_facets(mocker):
+    search = mocker.patch.object(TestIndex, 'search', return_value={
+        'hits': [{'id': 3}], 'estimatedTotalHits': 1, 'facetDistribution': {'teamId': {'3': 1}}})
+    mocker.patch('meilisearch.client.Client.index', return_value=TestIndex())
+
+    ids, total, facets = fullTextSearch.queryIndex('ertie_dev', 'test', filter={'teamId': 3, 'active': True,
+                                                                                'season': ['2023', '2024']},
+                                                   sort=['name:asc'], facets=['teamId'])
+    assert ids == [3]
+    assert facets == {'teamId': {'3': 1}}
+    assert search.call_args.args[1] == {'attributesToRetrieve': ['id'], 'sort': ['name:asc'], 'facets': ['teamId'],
+                                        'filter': 'teamId = 3 AND active = true AND season IN ["2023", "2024"]'}
+
+    assert fullTextSearch.queryIndex('ertie_dev', 'test', filter='leftAt IS NULL') == ([3], 1)
+    assert search.call_args.args[1]['filter'] == 'leftAt IS NULL'
+
+def test_filter_expression():
+    # non-ASCII characters are kept, quotes and backslashes are escaped, attribute names are checked
+    engine = fullTextSearch.searchEngine
+    assert engine._filterExpression({'city': 'Ettelbréck', 'team.name': ['Ertië "B"', 'a\\b']}) == \
+           'city = "Ettelbréck" AND team.name IN ["Ertië \\"B\\"", "a\\\\b"]'
+    with pytest.raises(RuntimeError):
+        engine._filterExpression({'city = "x" OR id': 1})
+
+def test_consistency_token(mocker):
+    testIndex = BatchIndex()
+    mocker.patch('meilisearch.client.Client.index', return_value=testIndex)
+    wait = mocker.patch('app.factory.classes.fullTextSearch.meiliSearch.taskMonitor.TaskMonitor.wait',
+                        return_value=True)
+    search = mocker.patch.object(BatchIndex, 'search', create=True,
+                                 return_value={'hits': [{'id': 1}], 'estimatedTotalHits': 1})
+
+    fullTextSearch.addManyToIndex('ertie_dev', _testModels(3))
+    token = fullTextSearch.consistencyToken
+    assert token == 1
+
+    assert fullTextSearch.queryIndex('ertie_dev', 'test', consistencyToken=token) == ([1], 1)
+    assert wait.call_args.args == ([token], Config.FULLTEXT_SEARCH_CONSISTENCY_TIMEOUT)
+    assert search.call_count == 1
+
+    wait.reset_mock()
+    fullTextSearch.queryIndex('ertie_dev', 'test')
+    wait.assert_not_called()
+
+def test_multi_query(mocker):
+    multiSearch = mocker.patch('meilisearch.client.Client.multi_search', return_value={'results': [
+        {'indexUid': 'members', 'hits': [{'id': 1}, {'id': 2}], 'estimatedTotalHits': 2},
+        {'indexUid': 'teams', 'hits': [{'id': 3, 'name': 'test'}], 'totalHits': 1}]})
+
+    results = fullTextSearch.multiQuery([('members', 'cosmo', None),
+                                         ('teams', 'cosmo', {'resync': True, 'page': 1})])
+    assert results == [([1, 2], 2), ([{'id': 3, 'name': 'test'}], 1)]
+
+    body = multiSearch.call_args.args[0]
+    assert body[0] == {'indexUid': fullTextSearch.searchEngine._indexHelper('members'), 'q': 'cosmo',
+                       'attributesToRetrieve': ['id']}
+    assert body[1]['page'] == 1
+    assert body[1]['hitsPerPage'] == Config.RESULTS_PER_PAGE
+
+def test_multi_query_error(mocker):
+    mocker.patch('meilisearch.client.Client.multi_search', side_effect=ConnectionError)
+    with pytest.raises(RuntimeError):
+        fullTextSearch.multiQuery([('members', 'cosmo', None)])
+
+class SettingsModel:
+    __searchable__ = ['name', 'club']
+    __filterable__ = ['active', 'teamId']
+    __sortable__ = ['name']
+
+def test_diff_settings(mocker):
+    testIndex = ReindexIndex()
+    mocker.patch.object(testIndex, 'get_settings', return_value={
+        'searchableAttributes': ['club', 'name'], 'filterableAttributes': ['teamId', 'active'],
+        'sortableAttributes': [], 'displayedAttributes': ['*']})
+    mocker.patch('meilisearch.client.Client.index', return_value=testIndex)
+    engine = fullTextSearch.searchEngine
+
+    changes = engine.diffSettings('members', engine.declaredSettings(SettingsModel))
+    assert changes == {'searchableAttributes': (['club', 'name'], ['name', 'club']),
+                       'sortableAttributes': ([], ['name'])}
+    assert engine.requiresReindex(changes) == ['searchableAttributes', 'sortableAttributes']
+
+    assert engine.applySettings('members', changes) == [0]
+    assert testIndex.settings == {'searchableAttributes': ['name', 'club'], 'sortableAttributes': ['name']}
+    assert engine.applySettings('members', {}) == []
+
+def test_diff_settings_missing_index(mocker):
+    response = mocker.Mock(status_code=404, text='')
+    mocker.patch.object(ReindexIndex, 'get_settings',
+                        side_effect=meilisearch.errors.MeilisearchApiError('not found', response))
+    mocker.patch('meilisearch.client.Client.index', return_value=ReindexIndex())
+    engine = fullTextSearch.searchEngine
+
+    changes = engine.diffSettings('members', {'displayedAttributes': ['*'], 'filterableAttributes': ['active']})
+    assert changes == {'filterableAttributes': ([], ['active'])}
+    assert engine.requiresReindex({'displayedAttributes': None}) == []
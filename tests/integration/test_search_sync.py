@@ -0,0 +1,227 @@
+"""
+Tests for the automatic synchronisation between the database and the FTS component.
+
+SPDX-FileCopyrightText: © 2024 Gilles Bellot <gilles.bellot@bell0bytes.eu>
+SPDX-License-Identifier: AGPL-3.0-or-later
+"""
+
+########################################################################################################################
+# IMPORTS ##############################################################################################################
+########################################################################################################################
+import pytest
+import sqlalchemy
+import sqlalchemy.orm
+from app.factory.classes.fullTextSearch import FullTextSearch, SearchSync, SQLFallback
+from app.factory.classes.fullTextSearch.meiliSearch import MeiliSearch
+
+########################################################################################################################
+# TESTS ################################################################################################################
+########################################################################################################################
+class Base(sqlalchemy.orm.DeclarativeBase):
+    pass
+
+class Member(Base):
+    __tablename__ = 'member'
+    __searchable__ = ['name']
+    uid = sqlalchemy.Column(sqlalchemy.Integer, primary_key=True)
+    name = sqlalchemy.Column(sqlalchemy.String)
+    phone = sqlalchemy.Column(sqlalchemy.String)
+
+class Team(Base):
+    __tablename__ = 'team'
+    uid = sqlalchemy.Column(sqlalchemy.Integer, primary_key=True)
+    name = sqlalchemy.Column(sqlalchemy.String)
+
+class Player(Base):
+    __tablename__ = 'player'
+    __searchable__ = ['name', 'team.name']
+    uid = sqlalchemy.Column(sqlalchemy.Integer, primary_key=True)
+    name = sqlalchemy.Column(sqlalchemy.String)
+    teamId = sqlalchemy.Column(sqlalchemy.Integer, sqlalchemy.ForeignKey('team.uid'))
+    team = sqlalchemy.orm.relationship(Team)
+
+class Venue(Base):
+    __tablename__ = 'venue'
+    uid = sqlalchemy.Column(sqlalchemy.Integer, primary_key=True)
+
+class RecordingSearch:
+    searchEngine = MeiliSearch
+
+    def __init__(self):
+        self.calls = []
+
+    def addDocumentsToIndex(self, index, documents):
+        self.calls.append(('add', index, documents))
+
+    def removeDocumentsFromIndex(self, index, ids):
+        self.calls.append(('remove', index, ids))
+
+@pytest.fixture()
+def syncedSession():
+    engine = sqlalchemy.create_engine('sqlite://')
+    Base.metadata.create_all(engine)
+    search = RecordingSearch()
+    searchSync = SearchSync(search)
+    searchSync.register(Member, 'members')
+    searchSync.register(Player, 'players')
+    sessionFactory = sqlalchemy.orm.sessionmaker(engine)
+    searchSync.init(sessionFactory)
+    searchSync.init(sessionFactory)
+    with sessionFactory() as session:
+        yield session, search
+
+def test_commit_pushes_one_batch(syncedSession):
+    session, search = syncedSession
+    session.add_all([Member(uid=1, name='Cosmo'), Member(uid=2, name='Wanda'), Venue(uid=1)])
+    session.flush()
+    assert search.calls == []
+
+    session.commit()
+    assert search.calls == [('add', 'members', [{'id': 1, 'name': 'Cosmo'}, {'id': 2, 'name': 'Wanda'}])]
+
+def test_update_and_delete(syncedSession):
+    session, search = syncedSession
+    cosmo, wanda = Member(uid=1, name='Cosmo'), Member(uid=2, name='Wanda')
+    session.add_all([cosmo, wanda])
+    session.commit()
+    search.calls.clear()
+
+    cosmo.name = 'Cosmo Cosma'
+    session.delete(wanda)
+    session.commit()
+    assert search.calls == [('add', 'members', [{'id': 1, 'name': 'Cosmo Cosma'}]),
+                            ('remove', 'members', [2])]
+
+def test_only_changed_fields_are_pushed(syncedSession):
+    session, search = syncedSession
+    cosmo = Member(uid=1, name='Cosmo', phone='555')
+    session.add(cosmo)
+    session.commit()
+    search.calls.clear()
+
+    # phone is not searchable
+    cosmo.phone = '556'
+    session.commit()
+    assert search.calls == []
+
+    cosmo.name = 'Cosmo Cosma'
+    cosmo.phone = '557'
+    session.commit()
+    assert search.calls == [('add', 'members', [{'id': 1, 'name': 'Cosmo Cosma'}])]
+
+def test_dotted_fields(syncedSession):
+    session, search = syncedSession
+    ertie, racing = Team(uid=1, name='Ertië'), Team(uid=2, name='Racing')
+    cosmo = Player(uid=1, name='Cosmo', team=ertie)
+    session.add_all([ertie, racing, cosmo])
+    session.commit()
+    search.calls.clear()
+
+    # a dotted field changes with its relationship
+    cosmo.team = racing
+    session.commit()
+    assert search.calls == [('add', 'players', [{'id': 1, 'team.name': 'Racing'}])]
+
+def test_facade_dotted_fields(mocker):
+    update = mocker.patch('app.factory.classes.fullTextSearch.meiliSearch.meiliSearch.MeiliSearch.addToIndex')
+    fullTextSearch = FullTextSearch()
+    ertie = Team(uid=1, name='Ertië')
+    assert fullTextSearch.addToIndex('players', Player(uid=1, name='Cosmo', team=ertie),
+                                     original=Player(uid=1, name='Cosmo', team=ertie)) is None
+    update.assert_not_called()
+
+    cosmo = Player(uid=1, name='Cosmo', team=Team(uid=2, name='Racing'))
+    fullTextSearch.addToIndex('players', cosmo, original=Player(uid=1, name='Cosmo', team=ertie))
+    update.assert_called_once_with('players', cosmo, ['team.name'])
+
+def test_facade_skips_unchanged_models(mocker):
+    update = mocker.patch('app.factory.classes.fullTextSearch.meiliSearch.meiliSearch.MeiliSearch.addToIndex')
+    fullTextSearch = FullTextSearch()
+    assert fullTextSearch.addToIndex('members', Member(uid=1, name='Cosmo', phone='556'),
+                                     original=Member(uid=1, name='Cosmo', phone='555')) is None
+    update.assert_not_called()
+
+    wanda = Member(uid=1, name='Wanda')
+    fullTextSearch.addToIndex('members', wanda, original=Member(uid=1, name='Cosmo'))
+    update.assert_called_once_with('members', wanda, ['name'])
+
+def test_rollback_pushes_nothing(syncedSession):
+    session, search = syncedSession
+    session.add(Member(uid=1, name='Cosmo'))
+    session.flush()
+    session.rollback()
+    session.commit()
+    assert search.calls == []
+
+def test_released_savepoint_rolled_back_pushes_nothing(syncedSession):
+    session, search = syncedSession
+    with session.begin_nested():
+        session.add(Member(uid=1, name='X'))
+    assert search.calls == []
+    session.rollback()
+    session.commit()
+    assert search.calls == []
+
+    # the released savepoint is pushed with the outer commit
+    with session.begin_nested():
+        session.add(Member(uid=2, name='Y'))
+    session.commit()
+    assert search.calls == [('add', 'members', [{'id': 2, 'name': 'Y'}])]
+
+def test_reindex_streams_rows(syncedSession, mocker):
+    session, search = syncedSession
+    session.add_all([Member(uid=uid, name=f'Member {uid}') for uid in range(5)])
+    session.commit()
+
+    reindex = mocker.patch('app.factory.classes.fullTextSearch.meiliSearch.meiliSearch.MeiliSearch.reindex',
+                           side_effect=lambda index, documents, progress: len(list(documents)))
+    assert FullTextSearch().reindex('members', Member, session, yieldPer=2) == 5
+    assert reindex.call_args.args[0] == 'members'
+
+def test_sql_fallback(syncedSession):
+    session, search = syncedSession
+    session.add_all([Member(uid=1, name='Cosmo'), Member(uid=2, name='Wanda'), Member(uid=3, name='cosmo_2')])
+    session.commit()
+    fallback = SQLFallback(session, {Member: 'members'})
+
+    assert fallback.queryIndex('members', 'COSMO') == ([1, 3], 2)
+    assert fallback.queryIndex('members', 'o_', limit=5) == ([3], 1)
+    assert fallback.queryIndex('members', '', page=2, hitsPerPage=2) == ([3], 3)
+    assert fallback.queryIndex('members', 'wanda', resync=True) == ([{'id': 2, 'name': 'Wanda'}], 1)
+    with pytest.raises(RuntimeError):
+        fallback.queryIndex('teams', 'cosmo')
+
+def test_sql_fallback_filter_sort_facets(syncedSession):
+    session, search = syncedSession
+    session.add_all([Member(uid=1, name='Cosmo', phone='555'), Member(uid=2, name='Wanda', phone='555'),
+                     Member(uid=3, name='Timmy', phone='556'), Member(uid=4, name='Vicky')])
+    session.commit()
+    fallback = SQLFallback(session, {Member: 'members'})
+
+    assert fallback.queryIndex('members', '', filter={'phone': '555'}, sort=['name:desc']) == ([2, 1], 2)
+    assert fallback.queryIndex('members', '', filter={'phone': ['556', '557']}) == ([3], 1)
+    assert fallback.queryIndex('members', '', filter={'phone': None}) == ([4], 1)
+    assert fallback.queryIndex('members', 'm', facets=['phone']) == ([1, 3], 2, {'phone': {'555': 1, '556': 1}})
+    with pytest.raises(RuntimeError):
+        fallback.queryIndex('members', '', filter='phone = 555')
+
+def test_sql_fallback_dotted_fields(syncedSession):
+    session, search = syncedSession
+    session.add_all([Team(uid=1, name='Fairies'), Team(uid=2, name='Pixies')])
+    session.add_all([Player(uid=1, name='Cosmo', teamId=1), Player(uid=2, name='Sanderson', teamId=2),
+                     Player(uid=3, name='Jorgen')])
+    session.commit()
+    fallback = SQLFallback(session, {Player: 'players'})
+
+    # the dotted fields are matched and filtered through the relationship
+    assert fallback.queryIndex('players', 'pix') == ([2], 1)
+    assert fallback.queryIndex('players', '', filter={'team.name': 'Fairies'}) == ([1], 1)
+    assert fallback.queryIndex('players', 'cosmo', resync=True) == \
+        ([{'id': 1, 'name': 'Cosmo', 'team.name': 'Fairies'}], 1)
+    with pytest.raises(RuntimeError):
+        fallback.queryIndex('players', '', sort=['team.name:asc'])
+
+def test_register_requires_searchable():
+    with pytest.raises(ValueError):
+        SearchSync(RecordingSearch()).register(Venue)
+    assert SearchSync(RecordingSearch()).searchable()(Member) is Member
@@ -0,0 +1,128 @@
+"""
+Tests for the SQL-native full-text search provider.
+
+SPDX-FileCopyrightText: © 2024 Gilles Bellot <gilles.bellot@bell0bytes.eu>
+SPDX-License-Identifier: AGPL-3.0-or-later
+"""
+
+########################################################################################################################
+# IMPORTS ##############################################################################################################
+########################################################################################################################
+import concurrent.futures
+import pytest
+import sqlalchemy
+import sqlalchemy.exc
+import sqlalchemy.orm
+from app.factory.classes.fullTextSearch import FullTextSearch
+from app.factory.classes.fullTextSearch.sqlSearch import SQLSearch
+from app.factory.classes.database.database import _includeObject
+
+########################################################################################################################
+# TESTS ################################################################################################################
+########################################################################################################################
+class Base(sqlalchemy.orm.DeclarativeBase):
+    pass
+
+class Member(Base):
+    __tablename__ = 'member'
+    __searchable__ = ['name', 'city', 'active']
+    uid = sqlalchemy.Column(sqlalchemy.Integer, primary_key=True)
+    name = sqlalchemy.Column(sqlalchemy.String)
+    city = sqlalchemy.Column(sqlalchemy.String)
+    active = sqlalchemy.Column(sqlalchemy.Boolean)
+
+@pytest.fixture()
+def sqlSearch():
+    engine = sqlalchemy.create_engine('sqlite://', poolclass=sqlalchemy.pool.StaticPool)
+    Base.metadata.create_all(engine)
+    search = SQLSearch(engine)
+    search.addManyToIndex('members', [Member(uid=1, name='Cosmo Cosma', city='Dimmsdale', active=True),
+                                      Member(uid=2, name='Wanda Cosma', city='Dimmsdale', active=False),
+                                      Member(uid=3, name='Timmy Turner', city='Fairy World', active=True)])
+    yield search, engine
+
+def test_query(sqlSearch):
+    search, engine = sqlSearch
+    assert search.queryIndex('members', 'cosma') == ([1, 2], 2)
+    assert search.queryIndex('members', 'tim') == ([3], 1)
+    assert search.queryIndex('members', 'cosma dimm')[1] == 2
+    assert search.queryIndex('members', 'wanda timmy') == ([], 0)
+    assert search.queryIndex('members', '', limit=2, offset=1) == ([2, 3], 3)
+    assert search.queryIndex('members', '', page=2, hitsPerPage=2) == ([3], 3)
+    assert search.queryIndex('members', '', limit=2, offset=2, exactTotal=True) == ([3], 3)
+    with pytest.raises(ValueError):
+        search.queryIndex('members', '', limit=2, offset=1, exactTotal=True)
+    assert search.queryIndex('members', 'wanda', resync=True, attributesToRetrieve=['id', 'name']) == \
+           ([{'id': 2, 'name': 'Wanda Cosma'}], 1)
+
+def test_filter_sort_facets(sqlSearch):
+    search, engine = sqlSearch
+    assert search.queryIndex('members', '', filter={'active': True}, sort=['name:desc']) == ([3, 1], 2)
+    assert search.queryIndex('members', '', filter={'city': ['Fairy World', 'Paris']}) == ([3], 1)
+    assert search.queryIndex('members', 'cosma', facets=['city']) == ([1, 2], 2, {'city': {'Dimmsdale': 2}})
+    with pytest.raises(RuntimeError):
+        search.queryIndex('members', '', filter='active = true')
+
+def test_partial_updates_and_removal(sqlSearch):
+    search, engine = sqlSearch
+    search.addDocumentsToIndex('members', [{'id': 1, 'name': 'Cosmo Julius'}])
+    assert search.queryIndex('members', 'julius', resync=True) == \
+           ([{'id': 1, 'name': 'Cosmo Julius', 'city': 'Dimmsdale', 'active': True}], 1)
+    assert search.queryIndex('members', 'cosma') == ([2], 1)
+
+    search.removeDocumentsFromIndex('members', [2, 3])
+    assert search.queryIndex('members', '') == ([1], 1)
+
+def test_search_statement_joins_models(sqlSearch):
+    search, engine = sqlSearch
+    with sqlalchemy.orm.Session(engine) as session:
+        session.add_all([Member(uid=1, name='Cosmo Cosma'), Member(uid=2, name='Wanda Cosma')])
+        session.commit()
+
+        hits = search.searchStatement('members', 'cosma').subquery()
+        members = session.scalars(sqlalchemy.select(Member).join(hits, Member.uid == hits.c.id)
+                                  .order_by(hits.c.rank, Member.uid)).all()
+        assert [member.name for member in members] == ['Cosmo Cosma', 'Wanda Cosma']
+
+def test_reindex(sqlSearch):
+    search, engine = sqlSearch
+    progress = []
+    count = search.reindex('members', iter([{'id': 7, 'name': 'Vicky'}]), lambda n, t: progress.append(n))
+    assert count == 1
+    assert progress == [1]
+    assert search.queryIndex('members', '') == ([7], 1)
+
+    search.deleteIndex('members')
+    assert search.queryIndex('members', '') == ([], 0)
+
+def test_health(sqlSearch):
+    search, engine = sqlSearch
+    assert search.isHealthy() is True
+    assert search.diffSettings('members', search.declaredSettings(Member)) == {}
+    assert search.isTransientError(RuntimeError('lost')) is False
+    assert search.isTransientError(sqlalchemy.exc.OperationalError('SELECT 1', {}, Exception('gone'))) is True
+
+def test_provider_selection(mocker):
+    mocker.patch('app.factory.conf.Config.FULLTEXT_SEARCH_PROVIDER', 'sql')
+    assert isinstance(FullTextSearch().searchEngine, SQLSearch)
+
+def test_engine_binding(tmp_path):
+    engine = sqlalchemy.create_engine(f'sqlite:///{tmp_path}/search.db')
+
+    # the provider must be bound to the application database before use
+    unbound = SQLSearch()
+    with pytest.raises(RuntimeError):
+        unbound.queryIndex('members', '')
+
+    # once bound, threads without an app context, i.e. the circuit breaker probe, can use it
+    unbound.init(engine)
+    with concurrent.futures.ThreadPoolExecutor(1) as executor:
+        assert executor.submit(unbound.isHealthy).result() is True
+
+def test_search_tables_are_not_migrated():
+    metadata = sqlalchemy.MetaData()
+    table = sqlalchemy.Table('search_test_members', metadata, sqlalchemy.Column('id', sqlalchemy.Integer))
+    index = sqlalchemy.Index('search_test_members_vector', table.c.id)
+    assert _includeObject(table, table.name, 'table', True, None) is False
+    assert _includeObject(index, index.name, 'index', True, None) is False
+    assert _includeObject(Member.__table__, 'member', 'table', False, None) is True
@@ -0,0 +1,100 @@
+"""
+Tests for the circuit breaker of the FTS component.
+
+SPDX-FileCopyrightText: © 2024 Gilles Bellot <gilles.bellot@bell0bytes.eu>
+SPDX-License-Identifier: AGPL-3.0-or-later
+"""
+
+########################################################################################################################
+# IMPORTS ##############################################################################################################
+########################################################################################################################
+import time
+import pytest
+import meilisearch.errors
+from app.factory.classes.fullTextSearch import FullTextSearch
+from app.factory.classes.fullTextSearch.circuitBreaker import CircuitBreaker, CircuitOpenError
+from app.factory.classes.fullTextSearch.meiliSearch import MeiliSearch
+
+########################################################################################################################
+# TESTS ################################################################################################################
+########################################################################################################################
+def test_opens_after_threshold():
+    breaker = CircuitBreaker(threshold=2, probeInterval=60, probe=lambda: False)
+    for _ in range(2):
+        with pytest.raises(ConnectionError):
+            breaker.call(_fail)
+    assert breaker.isOpen is True
+
+    with pytest.raises(CircuitOpenError):
+        breaker.call(lambda: 'success')
+    breaker.reset()
+    assert breaker.call(lambda: 'success') == 'success'
+
+def test_success_resets_failures():
+    breaker = CircuitBreaker(threshold=2, probeInterval=60, probe=lambda: False)
+    with pytest.raises(ConnectionError):
+        breaker.call(_fail)
+    breaker.call(lambda: 'success')
+    assert breaker.failures == 0
+
+def test_ignores_non_failures():
+    breaker = CircuitBreaker(threshold=1, probeInterval=60, probe=lambda: False, isFailure=lambda e: False)
+    with pytest.raises(ConnectionError):
+        breaker.call(_fail)
+    assert breaker.isOpen is False
+
+def test_probe_recovers():
+    events = []
+    breaker = CircuitBreaker(threshold=1, probeInterval=0.01, probe=lambda: True,
+                             onRecovery=lambda: events.append(breaker.isOpen))
+    breaker.trip()
+    _waitFor(lambda: breaker.isOpen is False)
+    assert events == [True]
+
+def test_transient_errors():
+    assert MeiliSearch.isTransientError(RuntimeError()) is False
+    try:
+        try:
+            raise meilisearch.errors.MeilisearchCommunicationError('down')
+        except Exception as e:
+            raise RuntimeError(e)
+    except RuntimeError as e:
+        assert MeiliSearch.isTransientError(e) is True
+
+def test_facade_degrades_while_open(mocker):
+    mocker.patch('app.factory.conf.Config.FULLTEXT_SEARCH_BREAKER_PROBE_INTERVAL', 60.0)
+    mocker.patch('app.factory.conf.Config.FULLTEXT_SEARCH_QUEUE_INTERVAL', 60.0)
+    query = mocker.patch('app.factory.classes.fullTextSearch.meiliSearch.meiliSearch.MeiliSearch.queryIndex')
+    add = mocker.patch('app.factory.classes.fullTextSearch.meiliSearch.meiliSearch.MeiliSearch.addDocumentsToIndex',
+                       return_value=[1])
+    fallback = mocker.Mock()
+    fallback.queryIndex.return_value = ([2], 1)
+
+    fullTextSearch = FullTextSearch()
+    fullTextSearch.circuitBreaker.trip()
+    with pytest.raises(CircuitOpenError):
+        fullTextSearch.queryIndex('members', 'cosmo')
+
+    fullTextSearch.enableFallback(fallback)
+    assert fullTextSearch.queryIndex('members', 'cosmo', limit=5) == ([2], 1)
+    assert fullTextSearch.multiQuery([('members', 'cosmo', None)]) == [([2], 1)]
+    query.assert_not_called()
+
+    # writes are held until the engine is back
+    assert fullTextSearch.addDocumentsToIndex('members', [{'id': 1}]) == []
+    add.assert_not_called()
+    fullTextSearch._onRecovery()
+    add.assert_called_once_with('members', [{'id': 1}])
+    fullTextSearch.shutdown()
+
+########################################################################################################################
+# HELPERS ##############################################################################################################
+########################################################################################################################
+def _fail():
+    raise ConnectionError('down')
+
+def _waitFor(condition, timeout: float = 2.0):
+    deadline = time.monotonic() + timeout
+    while not condition() and time.monotonic() < deadline:
+        time.sleep(0.005)
+    assert condition()
@@ -0,0 +1,94 @@
+"""
+Tests for the compiled document serializers of the FTS component.
+
+SPDX-FileCopyrightText: © 2024 Gilles Bellot <gilles.bellot@bell0bytes.eu>
+SPDX-License-Identifier: AGPL-3.0-or-later
+"""
+
+########################################################################################################################
+# IMPORTS ##############################################################################################################
+########################################################################################################################
+import datetime
+import decimal
+import enum
+import json
+import uuid
+import sqlalchemy
+import sqlalchemy.orm
+from app.factory.classes.fullTextSearch import documentSerializer
+from app.factory.classes.fullTextSearch.documentSerializer import DocumentSerializer
+
+########################################################################################################################
+# TESTS ################################################################################################################
+########################################################################################################################
+class Base(sqlalchemy.orm.DeclarativeBase):
+    pass
+
+class Role(enum.Enum):
+    PLAYER = 'player'
+    COACH = 'coach'
+
+class Team(Base):
+    __tablename__ = 'team'
+    uid = sqlalchemy.Column(sqlalchemy.Integer, primary_key=True)
+    name = sqlalchemy.Column(sqlalchemy.String)
+    members = sqlalchemy.orm.relationship('Member', back_populates='team')
+
+class Member(Base):
+    __tablename__ = 'member'
+    __searchable__ = ['name', 'joined', 'fee', 'role', 'team.name']
+    uid = sqlalchemy.Column(sqlalchemy.Integer, primary_key=True)
+    name = sqlalchemy.Column(sqlalchemy.String)
+    joined = sqlalchemy.Column(sqlalchemy.Date)
+    fee = sqlalchemy.Column(sqlalchemy.Numeric)
+    role = sqlalchemy.Column(sqlalchemy.Enum(Role))
+    teamId = sqlalchemy.Column(sqlalchemy.Integer, sqlalchemy.ForeignKey('team.uid'))
+    team = sqlalchemy.orm.relationship('Team', back_populates='members')
+
+class Untyped:
+    __searchable__ = ['tags', 'token', 'created']
+
+    def __init__(self):
+        self.uid = 7
+        self.tags = {'b'}
+        self.token = uuid.UUID(int=1)
+        self.created = datetime.datetime(2024, 5, 1, 12, 30)
+
+def test_typed_conversions():
+    team = Team(uid=1, name='Fairies')
+    member = Member(uid=2, name='Cosmo', joined=datetime.date(2024, 1, 31), fee=decimal.Decimal('12.5'),
+                    role=Role.COACH, team=team)
+
+    serializer = DocumentSerializer()
+    assert serializer.serialize(member) == {'id': 2, 'name': 'Cosmo', 'joined': '2024-01-31', 'fee': 12.5,
+                                            'role': 'coach', 'team.name': 'Fairies'}
+    assert serializer.serialize(Member(uid=3)) == {'id': 3, 'name': None, 'joined': None, 'fee': None, 'role': None,
+                                                   'team.name': None}
+    assert serializer.serialize(member, ['fee']) == {'id': 2, 'fee': 12.5}
+
+def test_collections_are_flattened():
+    team = Team(uid=1, name='Fairies', members=[Member(uid=2, name='Cosmo'), Member(uid=3, name='Wanda')])
+    team.__searchable__ = ['name', 'members.name']
+    assert DocumentSerializer().serialize(team) == {'id': 1, 'name': 'Fairies', 'members.name': ['Cosmo', 'Wanda']}
+
+def test_untyped_models():
+    assert DocumentSerializer().serialize(Untyped()) == {'id': 7, 'tags': ['b'],
+                                                         'token': '00000000-0000-0000-0000-000000000001',
+                                                         'created': '2024-05-01T12:30:00'}
+
+def test_extractors_are_compiled_once(mocker):
+    compile = mocker.spy(documentSerializer, '_compile')
+    serializer = DocumentSerializer()
+    for uid in range(3):
+        serializer.serialize(Member(uid=uid, name='Cosmo'))
+    serializer.serialize(Member(uid=4, name='Wanda'), ['name'])
+    assert compile.call_count == 2
+
+def test_encode(mocker):
+    document = {'id': 1, 'fee': decimal.Decimal('1.5'), 'name': 'Čosmo'}
+    batch = DocumentSerializer.encodeBatch([DocumentSerializer.encode(document), DocumentSerializer.encode({'id': 2})])
+    assert json.loads(batch) == [{'id': 1, 'fee': 1.5, 'name': 'Čosmo'}, {'id': 2}]
+
+    # without orjson, the standard library encoder is used
+    mocker.patch.object(documentSerializer, 'orjson', None)
+    assert json.loads(DocumentSerializer.encode(document)) == {'id': 1, 'fee': 1.5, 'name': 'Čosmo'}
@@ -10,6 +10,7 @@ SPDX-License-Identifier: AGPL-3.0-or-later
 # IMPORTS ##############################################################################################################
 ########################################################################################################################
 from app.factory.extensions import fullTextSearch
+from app.factory.classes.fullTextSearch import FullTextSearch
 from app.factory.classes.fullTextSearch.meiliSearch import MeiliSearch
 from app.factory.conf import Config
 
@@ -32,6 +33,16 @@ def test_add_to_index(mocker):
                  return_value='success')
     assert fullTextSearch.addToIndex('ertie_dev', {'uid': 1}) == 'success'
 
+def test_add_many_to_index(mocker):
+    mocker.patch('app.factory.classes.fullTextSearch.meiliSearch.meiliSearch.MeiliSearch.addManyToIndex',
+                 return_value=[1])
+    assert fullTextSearch.addManyToIndex('ertie_dev', [{'uid': 1}]) == [1]
+
+def test_remove_many_from_index(mocker):
+    mocker.patch('app.factory.classes.fullTextSearch.meiliSearch.meiliSearch.MeiliSearch.removeManyFromIndex',
+                 return_value=[1])
+    assert fullTextSearch.removeManyFromIndex('ertie_dev', [{'uid': 1}]) == [1]
+
 def test_remove_from_index(mocker):
     mocker.patch('app.factory.classes.fullTextSearch.meiliSearch.meiliSearch.MeiliSearch.removeFromIndex',
                  return_value='success')
@@ -40,4 +51,50 @@ def test_remove_from_index(mocker):
 def test_query_index(mocker):
     mocker.patch('app.factory.classes.fullTextSearch.meiliSearch.meiliSearch.MeiliSearch.queryIndex',
                  return_value='success')
-    assert fullTextSearch.queryIndex('ertie_dev', 'search', False) == 'success'
\ No newline at end of file
+    assert fullTextSearch.queryIndex('ertie_dev', 'search', False) == 'success'
+
+def test_multi_query(mocker):
+    mocker.patch('app.factory.classes.fullTextSearch.meiliSearch.meiliSearch.MeiliSearch.multiQuery',
+                 return_value=[([1], 1), ([2], 1)])
+    assert fullTextSearch.multiQuery([('members', 'search', None), ('teams', 'search', None)]) == [([1], 1), ([2], 1)]
+
+def test_multi_query_fallback(mocker):
+    class Engine:
+        @staticmethod
+        def queryIndex(index, query, **options):
+            return [index], options.get('limit')
+
+    mocker.patch.object(fullTextSearch, '_engine', Engine())
+    assert fullTextSearch.multiQuery([('members', 'search', {'limit': 5}), ('teams', 'search', None)]) == \
+           [(['members'], 5), (['teams'], None)]
+
+def test_cache_invalidated_once_searchable(mocker):
+    mocker.patch('app.factory.conf.Config.FULLTEXT_SEARCH_CACHE', 'memory')
+    mocker.patch('app.factory.classes.fullTextSearch.meiliSearch.meiliSearch.MeiliSearch.addDocumentsToIndex',
+                 return_value=[5])
+    finished = mocker.patch('app.factory.classes.fullTextSearch.meiliSearch.meiliSearch.MeiliSearch.onTasksFinished')
+    query = mocker.patch('app.factory.classes.fullTextSearch.meiliSearch.meiliSearch.MeiliSearch.queryIndex',
+                         side_effect=[([1], 1), ([1], 1), ([1, 2], 2), ([1, 2], 2)])
+    fts = FullTextSearch()
+    assert fts.queryIndex('members', 'cosmo') == ([1], 1)
+    assert fts.queryIndex('members', 'cosmo') == ([1], 1) and query.call_count == 1
+
+    # while the task is processed, the old results are not cached again
+    fts.addDocumentsToIndex('members', [{'id': 2, 'name': 'Cosmo'}])
+    assert finished.call_args.args[0] == [5]
+    assert fts.queryIndex('members', 'cosmo') == ([1], 1) and query.call_count == 2
+    assert fts.queryIndex('members', 'cosmo') == ([1, 2], 2) and query.call_count == 3
+
+    # once it is processed, the results are cached again
+    finished.call_args.args[1]()
+    assert fts.queryIndex('members', 'cosmo') == ([1, 2], 2)
+    assert fts.queryIndex('members', 'cosmo') == ([1, 2], 2) and query.call_count == 4
+
+def test_no_provider(mocker):
+    # Ertië runs without full-text search if no provider is configured
+    mocker.patch('app.factory.conf.Config.FULLTEXT_SEARCH_PROVIDER', 'none')
+    fts = FullTextSearch()
+    assert fts.searchEngine is None
+    assert fts.circuitBreaker is None
+    assert fts.queryCache is None
+    assert fts.indexingQueue is None
@@ -0,0 +1,168 @@
+"""
+Tests for the indexing queue of the FTS component.
+
+SPDX-FileCopyrightText: © 2024 Gilles Bellot <gilles.bellot@bell0bytes.eu>
+SPDX-License-Identifier: AGPL-3.0-or-later
+"""
+
+########################################################################################################################
+# IMPORTS ##############################################################################################################
+########################################################################################################################
+import time
+import pytest
+from app.factory.classes.fullTextSearch import FullTextSearch
+from app.factory.classes.fullTextSearch.indexingQueue import IndexingQueue
+from app.factory.classes.fullTextSearch.circuitBreaker import CircuitBreaker
+
+########################################################################################################################
+# TESTS ################################################################################################################
+########################################################################################################################
+class RecordingEngine:
+    def __init__(self, fail: bool = False):
+        self.fail = fail
+        self.calls = []
+
+    def addDocumentsToIndex(self, index, documents):
+        if self.fail:
+            raise ConnectionError('down')
+        self.calls.append(('add', index, list(documents)))
+        return [len(self.calls)]
+
+    def removeDocumentsFromIndex(self, index, ids):
+        self.calls.append(('remove', index, list(ids)))
+        return [len(self.calls)]
+
+def test_last_write_wins():
+    engine = RecordingEngine()
+    queue = IndexingQueue(engine)
+    queue.add('members', {'id': 1, 'name': 'old'})
+    queue.add('members', {'id': 1, 'name': 'new'})
+    queue.add('members', {'id': 2, 'name': 'other'})
+    queue.remove('members', 2)
+    assert queue.pending == 2
+
+    assert queue.flush() == [1, 2]
+    assert engine.calls == [('add', 'members', [{'id': 1, 'name': 'new'}]),
+                            ('remove', 'members', [2])]
+    assert queue.pending == 0
+    queue.close()
+
+def test_partial_documents_are_merged():
+    engine = RecordingEngine()
+    queue = IndexingQueue(engine)
+    queue.add('members', {'id': 1, 'name': 'Cosmo', 'city': 'Dimmsdale'})
+    queue.add('members', {'id': 1, 'city': 'Fairy World'})
+    queue.flush()
+    assert engine.calls == [('add', 'members', [{'id': 1, 'name': 'Cosmo', 'city': 'Fairy World'}])]
+    queue.close()
+
+def test_flush_on_size(mocker):
+    mocker.patch('app.factory.conf.Config.FULLTEXT_SEARCH_QUEUE_SIZE', 2)
+    mocker.patch('app.factory.conf.Config.FULLTEXT_SEARCH_QUEUE_INTERVAL', 60.0)
+    engine = RecordingEngine()
+    queue = IndexingQueue(engine)
+    queue.add('members', {'id': 1})
+    queue.add('members', {'id': 2})
+
+    _waitFor(lambda: len(engine.calls) == 1)
+    assert engine.calls == [('add', 'members', [{'id': 1}, {'id': 2}])]
+    queue.close()
+
+def test_flush_on_time(mocker):
+    mocker.patch('app.factory.conf.Config.FULLTEXT_SEARCH_QUEUE_INTERVAL', 0.01)
+    engine = RecordingEngine()
+    queue = IndexingQueue(engine)
+    queue.remove('teams', 3)
+
+    _waitFor(lambda: len(engine.calls) == 1)
+    assert engine.calls == [('remove', 'teams', [3])]
+    queue.close()
+
+def test_close_drains_queue(mocker):
+    mocker.patch('app.factory.conf.Config.FULLTEXT_SEARCH_QUEUE_INTERVAL', 60.0)
+    engine = RecordingEngine()
+    queue = IndexingQueue(engine)
+    queue.add('members', {'id': 1})
+    queue.close()
+
+    assert engine.calls == [('add', 'members', [{'id': 1}])]
+    with pytest.raises(RuntimeError):
+        queue.add('members', {'id': 2})
+
+def test_failed_flush_keeps_operations(mocker):
+    mocker.patch('app.factory.conf.Config.FULLTEXT_SEARCH_QUEUE_INTERVAL', 60.0)
+    engine = RecordingEngine(fail=True)
+    queue = IndexingQueue(engine)
+    queue.add('members', {'id': 1})
+
+    with pytest.raises(RuntimeError):
+        queue.flush()
+    assert queue.pending == 1
+
+    engine.fail = False
+    queue.close()
+    assert engine.calls == [('add', 'members', [{'id': 1}])]
+
+def test_failed_flush_trips_the_circuit(mocker):
+    mocker.patch('app.factory.conf.Config.FULLTEXT_SEARCH_QUEUE_INTERVAL', 60.0)
+    engine = RecordingEngine(fail=True)
+    breaker = CircuitBreaker(threshold=2, probeInterval=60, probe=lambda: False)
+    queue = IndexingQueue(engine, breaker)
+    queue.add('members', {'id': 1})
+
+    for _ in range(2):
+        with pytest.raises(RuntimeError):
+            queue.flush()
+    assert breaker.isOpen and queue.pending == 1
+
+    # the recovery hook flushes the queue while the circuit is still open
+    engine.fail = False
+    assert queue.flush() == [1]
+    breaker.reset()
+    queue.close()
+
+def test_failed_flush_merges_newer_partial_documents(mocker):
+    mocker.patch('app.factory.conf.Config.FULLTEXT_SEARCH_QUEUE_INTERVAL', 60.0)
+    engine = RecordingEngine()
+    queue = IndexingQueue(engine)
+    queue.add('members', {'id': 1, 'name': 'Cosmo', 'phone': '555'})
+
+    # a partial update arrives while the batch is sent, which fails
+    addDocumentsToIndex = engine.addDocumentsToIndex
+    def failingAdd(index, documents):
+        engine.addDocumentsToIndex = addDocumentsToIndex
+        queue.add('members', {'id': 1, 'phone': '556'})
+        raise ConnectionError('down')
+    engine.addDocumentsToIndex = failingAdd
+
+    with pytest.raises(RuntimeError):
+        queue.flush()
+    queue.close()
+    assert engine.calls == [('add', 'members', [{'id': 1, 'name': 'Cosmo', 'phone': '556'}])]
+
+def test_facade_uses_queue(mocker):
+    mocker.patch('app.factory.conf.Config.FULLTEXT_SEARCH_QUEUE_INTERVAL', 60.0)
+    add = mocker.patch('app.factory.classes.fullTextSearch.meiliSearch.meiliSearch.MeiliSearch.addDocumentsToIndex',
+                       return_value=[7])
+    fullTextSearch = FullTextSearch()
+    assert fullTextSearch.flush() == []
+
+    fullTextSearch.enableIndexingQueue()
+    model = mocker.Mock(uid=1, __searchable__=['name'])
+    model.name = 'test'
+    assert fullTextSearch.addToIndex('members', model) is None
+    add.assert_not_called()
+
+    assert fullTextSearch.flush() == [7]
+    add.assert_called_once_with('members', [{'id': 1, 'name': 'test'}])
+    fullTextSearch.shutdown()
+    assert fullTextSearch.indexingQueue is None
+
+########################################################################################################################
+# HELPERS ##############################################################################################################
+########################################################################################################################
+def _waitFor(condition, timeout: float = 2.0):
+    deadline = time.monotonic() + timeout
+    while not condition() and time.monotonic() < deadline:
+        time.sleep(0.005)
+    assert condition()
@@ -8,7 +8,9 @@ SPDX-License-Identifier: AGPL-3.0-or-later
 ########################################################################################################################
 # IMPORTS ##############################################################################################################
 ########################################################################################################################
+import io
 import logging
+from app.components.logging.logger import QueueFileHandler
 
 ########################################################################################################################
 # TESTS ################################################################################################################
@@ -27,6 +29,29 @@ def test_logger_debug(debugApp):
     """
     _testLoggers(debugApp, debug=True)
 
+def test_queue_overflow():
+    """
+    GIVEN a queue handler whose listener cannot keep up
+    THEN check that the oldest records are dropped and counted, and the remaining ones written
+    """
+    stream = io.StringIO()
+    handler = QueueFileHandler(logging.StreamHandler(stream), maxSize=2)
+    logger = logging.getLogger('ErtieQueueTest')
+    logger.addHandler(handler)
+
+    # stop the listener, such that the queue fills up
+    handler._listener.stop()
+    for number in range(5):
+        logger.error(f'Record {number}')
+    assert handler.dropped == 3
+
+    handler._start()
+    handler.flush()
+    assert stream.getvalue().split() == ['Record', '3', 'Record', '4']
+
+    logger.removeHandler(handler)
+    handler.close()
+
 ########################################################################################################################
 # HELPERS ##############################################################################################################
 ########################################################################################################################
@@ -44,6 +69,8 @@ def _testLoggers(app, debug=False):
     app.logger.error('Error Test Message')
     app.logger.critical('Critical Test Message')
 
+    # the records are written by a background listener
+    app.logger.flush()
     with open('logs/ertie.log', 'r') as file:
         content = file.read()
         # assert that the strings printed above are actually there
@@ -58,6 +85,8 @@ def _testLoggers(app, debug=False):
     app.logger.dbLogger.error('Error Test Message')
     app.logger.dbLogger.critical('Critical Test Message')
 
+    # the records are written by a background listener
+    app.logger.flush()
     with open('logs/db.log', 'r') as file:
         content = file.read()
         # assert that the strings printed above are actually there
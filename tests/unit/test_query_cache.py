@@ -0,0 +1,106 @@
+"""
+Tests for the query cache of the FTS component.
+
+SPDX-FileCopyrightText: © 2024 Gilles Bellot <gilles.bellot@bell0bytes.eu>
+SPDX-License-Identifier: AGPL-3.0-or-later
+"""
+
+########################################################################################################################
+# IMPORTS ##############################################################################################################
+########################################################################################################################
+import concurrent.futures
+import pytest
+from app.factory.classes.fullTextSearch import FullTextSearch
+from app.factory.classes.fullTextSearch.queryCache import QueryCache, MemoryQueryCache, SQLiteQueryCache
+
+########################################################################################################################
+# FIXTURES #############################################################################################################
+########################################################################################################################
+@pytest.fixture(params=['memory', 'sqlite'])
+def queryCache(request, tmp_path):
+    if request.param == 'memory':
+        return MemoryQueryCache(maxSize=2, ttl=60)
+    return SQLiteQueryCache(maxSize=2, ttl=60, path=tmp_path / 'search.sqlite')
+
+########################################################################################################################
+# TESTS ################################################################################################################
+########################################################################################################################
+def test_hit_and_miss(queryCache):
+    key = queryCache.key('members', 'cosmo', resync=False)
+    assert queryCache.get('members', key) is None
+
+    queryCache.set('members', key, ([1, 2], 2))
+    assert queryCache.get('members', key) == ([1, 2], 2)
+    assert queryCache.statistics == {'hits': 1, 'misses': 1, 'size': 1}
+
+def test_lru_eviction(queryCache):
+    queryCache.set('members', 'a', 1)
+    queryCache.set('members', 'b', 2)
+    assert queryCache.get('members', 'a') == 1
+    queryCache.set('members', 'c', 3)
+
+    assert queryCache.get('members', 'b') is None
+    assert queryCache.get('members', 'a') == 1
+    assert queryCache.get('members', 'c') == 3
+
+def test_ttl(queryCache, mocker):
+    mocker.patch.object(queryCache, '_ttl', -1)
+    queryCache.set('members', 'a', 1)
+    assert queryCache.get('members', 'a') is None
+
+def test_invalidate(queryCache):
+    queryCache.set('members', 'a', 1)
+    queryCache.set('teams', 'b', 2)
+    queryCache.invalidate('members')
+
+    assert queryCache.get('members', 'a') is None
+    assert queryCache.get('teams', 'b') == 2
+    queryCache.clear()
+    assert len(queryCache) == 0
+
+def test_shared_sqlite_cache(tmp_path):
+    first = SQLiteQueryCache(maxSize=8, ttl=60, path=tmp_path / 'search.sqlite')
+    second = SQLiteQueryCache(maxSize=8, ttl=60, path=tmp_path / 'search.sqlite')
+    first.set('members', 'a', {'hits': [1]})
+    assert second.get('members', 'a') == {'hits': [1]}
+
+def test_facade_cache(mocker):
+    mocker.patch('app.factory.conf.Config.FULLTEXT_SEARCH_CACHE', 'memory')
+    query = mocker.patch('app.factory.classes.fullTextSearch.meiliSearch.meiliSearch.MeiliSearch.queryIndex',
+                         return_value=([1], 1))
+    mocker.patch('app.factory.classes.fullTextSearch.meiliSearch.meiliSearch.MeiliSearch.addToIndex')
+    fullTextSearch = FullTextSearch()
+
+    assert fullTextSearch.queryIndex('members', 'cosmo') == ([1], 1)
+    assert fullTextSearch.queryIndex('members', 'cosmo') == ([1], 1)
+    assert query.call_count == 1
+
+    fullTextSearch.addToIndex('members', mocker.Mock())
+    fullTextSearch.queryIndex('members', 'cosmo')
+    assert query.call_count == 2
+    assert fullTextSearch.queryCache.statistics == {'hits': 1, 'misses': 2, 'size': 1}
+
+def test_abstract_base():
+    with pytest.raises(TypeError):
+        QueryCache(maxSize=2, ttl=60)
+
+def test_concurrent_statistics(queryCache):
+    # the counters are updated under the lock, thus no lookup is lost
+    queryCache.set('members', 'a', 1)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=8) as executor:
+        list(executor.map(lambda n: queryCache.get('members', 'a' if n % 2 else 'b'), range(400)))
+    assert queryCache.statistics == {'hits': 200, 'misses': 200, 'size': 1}
+
+def test_facade_multi_query_cache(mocker):
+    mocker.patch('app.factory.conf.Config.FULLTEXT_SEARCH_CACHE', 'memory')
+    mocker.patch('app.factory.classes.fullTextSearch.meiliSearch.meiliSearch.MeiliSearch.queryIndex',
+                 return_value=([1], 1))
+    multiQuery = mocker.patch('app.factory.classes.fullTextSearch.meiliSearch.meiliSearch.MeiliSearch.multiQuery',
+                              return_value=[([2], 1)])
+    fullTextSearch = FullTextSearch()
+    fullTextSearch.queryIndex('members', 'cosmo')
+
+    assert fullTextSearch.multiQuery([('members', 'cosmo', {}), ('teams', 'cosmo', None)]) == [([1], 1), ([2], 1)]
+    multiQuery.assert_called_once_with([('teams', 'cosmo', None)])
+    assert fullTextSearch.multiQuery([('members', 'cosmo', None), ('teams', 'cosmo', None)]) == [([1], 1), ([2], 1)]
+    assert multiQuery.call_count == 1
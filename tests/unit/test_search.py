@@ -0,0 +1,90 @@
+"""
+Unit test for the search blueprint.
+
+SPDX-FileCopyrightText: © 2024 Gilles Bellot <gilles.bellot@bell0bytes.eu>
+SPDX-License-Identifier: AGPL-3.0-or-later
+"""
+
+########################################################################################################################
+# IMPORTS ##############################################################################################################
+########################################################################################################################
+import sqlalchemy
+import sqlalchemy.pool
+from app.factory.classes.fullTextSearch.sqlSearch import SQLSearch
+from app.factory.extensions import searchSync
+
+########################################################################################################################
+# TESTS ################################################################################################################
+########################################################################################################################
+class Member:
+    __tablename__ = 'member'
+    __searchable__ = ['name']
+
+def test_reindex_command(testApp, mocker):
+    """
+    GIVEN a Flask factory with a registered searchable model
+    WHEN the reindex command is invoked
+    THEN the index is rebuilt and the progress is reported
+    """
+    mocker.patch.dict(searchSync.registry, {Member: 'members'})
+
+    def reindex(index, modelClass, session, yieldPer, progress):
+        progress(10, 0.5)
+        return 10
+    mocker.patch('app.factory.extensions.fullTextSearch.reindex', side_effect=reindex)
+
+    result = testApp.test_cli_runner().invoke(args=['search', 'reindex', 'members', '--batch-size', '5'])
+    assert result.exit_code == 0
+    assert '10 document(s) indexed (20 documents/s)' in result.output
+    assert 'Reindexed 10 Member document(s) into members.' in result.output
+
+def test_reindex_command_unknown_index(testApp):
+    """
+    GIVEN a Flask factory
+    WHEN the reindex command is invoked for an index without a registered model
+    THEN the command fails
+    """
+    result = testApp.test_cli_runner().invoke(args=['search', 'reindex', 'unknown'])
+    assert result.exit_code != 0
+    assert 'No searchable model is registered' in result.output
+
+def test_settings_command(testApp, mocker):
+    """
+    GIVEN a Flask factory with registered searchable models
+    WHEN the settings command is invoked
+    THEN the changed settings are reported and applied
+    """
+    class Team:
+        __searchable__ = ['name']
+
+    mocker.patch.dict(searchSync.registry, {Member: 'members', Team: 'teams'})
+    mocker.patch('app.factory.extensions.fullTextSearch.diffSettings',
+                 side_effect=lambda index, model: {'sortableAttributes': ([], ['name'])} if index == 'members' else {})
+    apply = mocker.patch('app.factory.extensions.fullTextSearch.applySettings')
+
+    result = testApp.test_cli_runner().invoke(args=['search', 'settings', '--dry-run'])
+    assert result.exit_code == 0
+    assert "members: sortableAttributes [] -> ['name'] (requires reindexing all documents)" in result.output
+    assert 'teams: up to date.' in result.output
+    apply.assert_not_called()
+
+    result = testApp.test_cli_runner().invoke(args=['search', 'settings'])
+    assert 'members: 1 setting(s) applied.' in result.output
+    apply.assert_called_once_with('members', {'sortableAttributes': ([], ['name'])})
+
+def test_benchmark_command(testApp, mocker):
+    """
+    GIVEN a Flask factory
+    WHEN the benchmark command is invoked
+    THEN the available providers are timed and the unavailable ones are skipped
+    """
+    sqlSearch = SQLSearch(sqlalchemy.create_engine('sqlite://', poolclass=sqlalchemy.pool.StaticPool))
+    unavailable = mocker.Mock(**{'isHealthy.return_value': False})
+    mocker.patch('app.components.search.search._benchmarkProviders',
+                 return_value=[('sql (sqlite)', sqlSearch), ('meilisearch', unavailable)])
+
+    result = testApp.test_cli_runner().invoke(args=['search', 'benchmark', '--documents', '50', '--queries', '5'])
+    assert result.exit_code == 0
+    assert 'sql (sqlite): 50 document(s) indexed in' in result.output
+    assert 'meilisearch: unavailable, skipped.' in result.output
+    assert sqlSearch.queryIndex('benchmark', '') == ([], 0)
@@ -0,0 +1,108 @@
+"""
+Tests for the monitor of the asynchronous search engine tasks.
+
+SPDX-FileCopyrightText: © 2024 Gilles Bellot <gilles.bellot@bell0bytes.eu>
+SPDX-License-Identifier: AGPL-3.0-or-later
+"""
+
+########################################################################################################################
+# IMPORTS ##############################################################################################################
+########################################################################################################################
+import types
+import pytest
+from app.factory.classes.fullTextSearch.meiliSearch.taskMonitor import TaskMonitor
+from app.factory.classes.fullTextSearch.circuitBreaker import CircuitBreaker
+
+########################################################################################################################
+# TESTS ################################################################################################################
+########################################################################################################################
+class TaskClient:
+    def __init__(self, finishedAfter: int = 0):
+        self.statuses = {}
+        self.requests = []
+        self._finishedAfter = finishedAfter
+
+    def get_tasks(self, parameters):
+        # tasks are finished after a number of polls
+        uids = [int(uid) for uid in parameters['uids']]
+        self.requests.append(uids)
+        status = 'succeeded' if len(self.requests) > self._finishedAfter else 'processing'
+        return types.SimpleNamespace(results=[types.SimpleNamespace(uid=uid, status=status)
+                                              for uid in uids if uid in self.statuses])
+
+@pytest.fixture(autouse=True)
+def fastPolling(mocker):
+    mocker.patch('app.factory.conf.Config.FULLTEXT_SEARCH_TASK_POLL_INTERVAL', 0.001)
+
+def test_wait_for_tasks():
+    client = TaskClient(finishedAfter=2)
+    client.statuses = {5: None, 7: None}
+    monitor = TaskMonitor(client)
+
+    assert monitor.wait([5, 7], timeout=5) is True
+    assert client.requests[0] == [5, 7]
+    assert monitor.finished == 7
+    assert monitor.pending == 0
+
+    # tasks are processed in order, so earlier tasks are not polled again
+    polls = len(client.requests)
+    assert monitor.wait([6], timeout=5) is True
+    assert len(client.requests) == polls
+
+def test_wait_times_out():
+    client = TaskClient(finishedAfter=10 ** 6)
+    client.statuses = {3: None}
+    monitor = TaskMonitor(client)
+
+    assert monitor.wait([3], timeout=0.05) is False
+    assert monitor.pending == 0
+    assert monitor.finished == -1
+
+def test_unknown_tasks_are_finished():
+    monitor = TaskMonitor(TaskClient())
+    assert monitor.wait([42], timeout=5) is True
+    assert monitor.finished == -1
+
+def test_on_finished(mocker):
+    client = TaskClient(finishedAfter=1)
+    client.statuses = {4: None, 9: None}
+    monitor = TaskMonitor(client)
+    callback = mocker.Mock()
+
+    # only the last task is polled ; the callback is called once it is processed
+    monitor.onFinished([4, 9], callback)
+    assert monitor.wait([9], timeout=5) is True
+    assert client.requests[0] == [9]
+    callback.assert_called_once_with()
+
+    # tasks which are already processed call back at once
+    monitor.onFinished([7], callback)
+    assert callback.call_count == 2 and monitor.pending == 0
+
+def test_failed_polls_back_off():
+    monitor = TaskMonitor(TaskClient())
+    assert [monitor._delay(failures) for failures in range(3)] == [0.001, 0.002, 0.004]
+    assert monitor._delay(10 ** 6) == 5.0
+
+def test_open_circuit_skips_polls():
+    client = TaskClient()
+    client.statuses = {3: None}
+    breaker = CircuitBreaker(threshold=1, probeInterval=60, probe=lambda: False)
+    monitor = TaskMonitor(client, breaker)
+
+    # no polls while the circuit is open
+    breaker.trip()
+    assert monitor.wait([3], timeout=0.05) is False
+    assert client.requests == []
+    breaker.reset()
+
+def test_failed_polls_trip_the_circuit(mocker):
+    client = TaskClient()
+    client.get_tasks = mocker.Mock(side_effect=ConnectionError)
+    breaker = CircuitBreaker(threshold=2, probeInterval=60, probe=lambda: False)
+    monitor = TaskMonitor(client)
+    monitor.useCircuitBreaker(breaker)
+
+    assert monitor.wait([3], timeout=0.5) is False
+    assert breaker.isOpen and client.get_tasks.call_count == 2
+    breaker.reset()
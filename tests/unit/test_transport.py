@@ -0,0 +1,82 @@
+"""
+Tests for the pooled HTTP transport of the Meilisearch wrapper.
+
+SPDX-FileCopyrightText: © 2024 Gilles Bellot <gilles.bellot@bell0bytes.eu>
+SPDX-License-Identifier: AGPL-3.0-or-later
+"""
+
+########################################################################################################################
+# IMPORTS ##############################################################################################################
+########################################################################################################################
+import pytest
+import requests
+import meilisearch.config
+import meilisearch.errors
+from app.factory.classes.fullTextSearch.meiliSearch.transport import PooledHttpRequests
+from app.factory.extensions import fullTextSearch
+
+########################################################################################################################
+# FIXTURES #############################################################################################################
+########################################################################################################################
+@pytest.fixture()
+def transport(mocker):
+    mocker.patch('app.factory.conf.Config.FULLTEXT_SEARCH_RETRY_BACKOFF', 0.0)
+    mocker.patch('app.factory.conf.Config.FULLTEXT_SEARCH_RETRIES', 2)
+    return PooledHttpRequests(meilisearch.config.Config('http://localhost:7700', 'key', timeout=(1, 2)))
+
+########################################################################################################################
+# TESTS ################################################################################################################
+########################################################################################################################
+def test_search_is_retried(transport, mocker):
+    request = mocker.patch('requests.Session.request',
+                           side_effect=[requests.exceptions.ConnectionError, _response(200, b'{"hits": []}')])
+
+    assert transport.post('indexes/members/search', {'q': 'cosmo'}) == {'hits': []}
+    assert request.call_count == 2
+    assert request.call_args.kwargs['timeout'] == (1, 2)
+    assert transport.metrics['calls'] == 2
+    assert transport.metrics['retries'] == 1
+
+def test_retries_are_bounded(transport, mocker):
+    request = mocker.patch('requests.Session.request', return_value=_response(503, b''))
+
+    with pytest.raises(meilisearch.errors.MeilisearchApiError):
+        transport.get('health')
+    assert request.call_count == 3
+    assert transport.metrics['errors'] == 3
+
+def test_non_idempotent_calls_are_not_retried(transport, mocker):
+    request = mocker.patch('requests.Session.request', side_effect=requests.exceptions.Timeout)
+
+    with pytest.raises(meilisearch.errors.MeilisearchTimeoutError):
+        transport.post('swap-indexes', [])
+    assert request.call_count == 1
+
+def test_client_errors_are_not_retried(transport, mocker):
+    request = mocker.patch('requests.Session.request', return_value=_response(404, b''))
+
+    with pytest.raises(meilisearch.errors.MeilisearchApiError):
+        transport.put('indexes/members/documents', [])
+    assert request.call_count == 1
+
+def test_session_is_recreated_after_fork(transport, mocker):
+    session = transport.session
+    assert transport.session is session
+
+    mocker.patch('os.getpid', return_value=-1)
+    assert transport.session is not session
+
+def test_engine_uses_transport():
+    engine = fullTextSearch.searchEngine
+    assert isinstance(engine._client.http, PooledHttpRequests)
+    assert engine._getIndex('members').http is engine._client.http
+    assert 'calls' in engine.transportMetrics
+
+########################################################################################################################
+# HELPERS ##############################################################################################################
+########################################################################################################################
+def _response(statusCode: int, content: bytes) -> requests.Response:
+    response = requests.Response()
+    response.status_code = statusCode
+    response._content = content
+    return response